@@ -0,0 +1,132 @@
+import hashlib
+import os
+
+import pandas as pd
+
+from libpysat.fileio.io_json import read_json, write_json
+from libpysat.utils.utils import file_signature
+
+
+class IngestCache(object):
+    """
+    A persistent cache of parsed input files, used by the batch readers so
+    that re-ingesting a directory only parses files that are new or changed.
+
+    The cache directory holds a JSON manifest and one binary (pickled)
+    data frame (or other parsed object, e.g. a label) per entry. Each
+    manifest entry records the path, size and modification time of the
+    source file(s) it was parsed from, along with any extra information
+    (e.g. sclock and version) passed in by the reader.
+
+    Attributes
+    ----------
+    cache_dir : str
+                PATH to the cache directory
+
+    manifest : dict
+               Entry key -> {'files': [...], 'store': str, ...}
+    """
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self, cache_dir):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+                    PATH to the cache directory, created if it does not exist
+        """
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.manifest_file = os.path.join(cache_dir, self.manifest_name)
+        self.manifest = {}
+        if os.path.exists(self.manifest_file):
+            self.manifest = read_json(self.manifest_file) or {}
+        self.hits = 0
+        self.misses = 0
+
+    file_signature = staticmethod(file_signature)
+
+    def _store_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.md5(key.encode('utf-8')).hexdigest() + '.pkl')
+
+    def get(self, key, files):
+        """
+        Return the cached object for key, or None if there is no entry,
+        the source files have changed, or the stored frame is missing.
+
+        Parameters
+        ----------
+        key : str
+              The entry key
+
+        files : list
+                PATHs of the source files the entry was parsed from
+        """
+        entry = self.manifest.get(key)
+        try:
+            current = [self.file_signature(f) for f in files]
+        except OSError:
+            current = None
+        store = self._store_path(key)
+        if entry is None or current is None or entry['files'] != current or not os.path.exists(store):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pd.read_pickle(store)
+
+    def put(self, key, files, frame, **info):
+        """
+        Store a parsed data frame (or other picklable object) and record the
+        source file signatures.
+        Call save() to persist the manifest.
+
+        Parameters
+        ----------
+        key : str
+              The entry key
+
+        files : list
+                PATHs of the source files the frame was parsed from
+
+        frame : DataFrame
+                The parsed data, any picklable object can be stored
+
+        info : dict
+               Extra (JSON serializable) values to record in the manifest
+        """
+        store = self._store_path(key)
+        pd.to_pickle(frame, store)
+        entry = {'files': [self.file_signature(f) for f in files],
+                 'store': os.path.basename(store)}
+        entry.update(info)
+        self.manifest[key] = entry
+
+    def _is_current(self, entry):
+        try:
+            return entry['files'] == [self.file_signature(f['path']) for f in entry['files']]
+        except OSError:
+            return False
+
+    def save(self):
+        """
+        Drop the entries whose source files were deleted or have changed since
+        they were parsed, along with their stored frames, and write the
+        manifest to disk.
+
+        Entries written to the manifest on disk since it was loaded (e.g. by
+        another IngestCache open on the same directory) are merged in rather
+        than overwritten; entries put in this session take precedence.
+        """
+        if os.path.exists(self.manifest_file):
+            on_disk = read_json(self.manifest_file) or {}
+            for key, entry in on_disk.items():
+                self.manifest.setdefault(key, entry)
+        for key in [k for k, entry in self.manifest.items() if not self._is_current(entry)]:
+            store = os.path.join(self.cache_dir, self.manifest.pop(key)['store'])
+            if os.path.exists(store):
+                os.remove(store)
+        tmp = self.manifest_file + '.tmp'
+        write_json(self.manifest, tmp)
+        os.replace(tmp, self.manifest_file)
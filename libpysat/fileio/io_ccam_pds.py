@@ -2,51 +2,96 @@
 # Header data is stored as attributes of the data frame
 # White space is stripped from the column names
 import os
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 import scipy.io as io
 
+from libpysat.fileio.ingest_cache import IngestCache
 from libpysat.fileio.lookup import lookup
 from libpysat.fileio.utils import file_search
 from libpysat.spectral.spectral_data import spectral_data
+from libpysat.utils.utils import effective_n_jobs
 
 
-def CCAM_CSV(input_data, ave=True):
-    try:
-        df = pd.read_csv(input_data, header=14, engine='c')
-        cols = list(df.columns.values)
-        df.columns = [i.strip().replace('# ', '') for i in cols]  # strip whitespace from column names
-        df.set_index(['wave'], inplace=True)  # use wavelengths as indices
-        # read the file header and put information into the dataframe as new columns
-        metadata = pd.read_csv(input_data, sep='=', nrows=14, comment=',', engine='c', index_col=0, header=None)
-    except:
-        try:  # handle files with an extra header row containing temperature
-            df = pd.read_csv(input_data, header=15, engine='c')
-            cols = list(df.columns.values)
-            df.columns = [i.strip().replace('# ', '') for i in cols]  # strip whitespace from column names
-            df.set_index(['wave'], inplace=True)  # use wavelengths as indices
-            # read the file header and put information into the dataframe as new columns
-            metadata = pd.read_csv(input_data, sep='=', nrows=15, comment=',', engine='c', index_col=0, header=None)
-        except:  # handle files with an extra header row containing temperature and target name
-            df = pd.read_csv(input_data, header=16, engine='c')
-            cols = list(df.columns.values)
-            df.columns = [i.strip().replace('# ', '') for i in cols]  # strip whitespace from column names
-            df.set_index(['wave'], inplace=True)  # use wavelengths as indices
-            # read the file header and put information into the dataframe as new columns
-            metadata = pd.read_csv(input_data, sep='=', nrows=16, comment=',', engine='c', index_col=0, header=None)
+def read_ccam_csv(input_data):
+    """
+    Read a ChemCam CCS csv file in a single pass.
 
-    if ave:
-        df = pd.DataFrame(df['mean'])
-    else:
-        df = df.drop(['mean', 'median'], axis=1)
-    df.index = [['wvl'] * len(df.index),
-                df.index.values.round(4)]  # create multiindex so spectra can be easily extracted with a single key
-    df = df.T  # transpose so that each spectrum is a row
+    The header is scanned line by line to collect the '=' separated metadata
+    and to find the row that names the table columns (14, 15 or 16 header rows
+    depending on whether temperature and target name are present). The
+    numeric block that follows is decoded directly into a float array.
+
+    Parameters
+    ----------
+    input_data : str
+                 PATH to the CCS csv file
+
+    Returns
+    -------
+    metadata : OrderedDict
+               The header entries with cleaned, lower case keys
+
+    columns : list
+              The names of the table columns (the first one is 'wave')
+
+    data : ndarray
+           (n wavelengths, n columns) array of the table values
+    """
+    metadata = OrderedDict()
+    with open(input_data, 'r') as f:
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError('No wavelength table found in ' + input_data)
+            line = line.rstrip('\r\n')
+            fields = line.split(',')
+            if fields[0].strip().replace('# ', '') == 'wave':
+                columns = [i.strip().replace('# ', '') for i in fields]
+                break
+            # anything after a comma is ignored, as is anything without a key = value pair
+            entry = fields[0].split('=', 1)
+            if len(entry) == 2:
+                key = entry[0].strip().strip('# ').replace(' FLOAT', '').lower()
+                metadata[key] = entry[1]
+        data = pd.read_csv(f, header=None, engine='c').values[:, :len(columns)]
+    return metadata, columns, np.asarray(data, dtype=np.float64)
+
+
+def ccam_csv_frame(input_data, spectra_cols=None, exclude=()):
+    """
+    Build the combined metadata + spectra data frame for a CCS csv file.
+
+    Parameters
+    ----------
+    input_data : str
+                 PATH to the CCS csv file
+
+    spectra_cols : list
+                   The table columns to keep as spectra (rows of the result).
+                   Defaults to all of them.
+
+    exclude : iterable
+              Table columns to leave out when spectra_cols is not given
 
-    # remove extraneous stuff from the metadataindices
-    metadata.index = [i.strip().strip('# ').replace(' FLOAT', '').lower() for i in metadata.index.values]
-    metadata = metadata.T
+    Returns
+    -------
+     : DataFrame
+       One row per spectrum with ('meta', ...) and ('wvl', ...) columns
+    """
+    metadata, columns, data = read_ccam_csv(input_data)
+    colnames = columns[1:]
+    if spectra_cols is None:
+        spectra_cols = [c for c in colnames if c not in exclude]
+    keep = [colnames.index(c) + 1 for c in spectra_cols]
+
+    wvls = data[:, 0].round(4)
+    # transpose so that each spectrum is a row, with a multiindex so spectra can be extracted with a single key
+    df = pd.DataFrame(data[:, keep].T, index=spectra_cols,
+                      columns=pd.MultiIndex.from_arrays([['wvl'] * len(wvls), wvls]))
 
     # extract info from the file name
     fname = os.path.basename(input_data)
@@ -55,12 +100,15 @@ def CCAM_CSV(input_data, ave=True):
     metadata['Pversion'] = fname[34:36]
 
     # duplicate the metadata for each row in the df
-    if not ave:
-        metadata = metadata.append([metadata] * (len(df.index) - 1), ignore_index=True)
-    metadata.index = df.index  # make the indices match
-    metadata.columns = [['meta'] * len(metadata.columns), metadata.columns.values]  # make the columns into multiindex
-    df = pd.concat([metadata, df], axis=1)  # combine the spectra with the metadata
-    return df
+    metadata = pd.DataFrame([list(metadata.values())] * len(df.index), index=df.index,
+                            columns=[['meta'] * len(metadata), list(metadata.keys())])
+    return pd.concat([metadata, df], axis=1)  # combine the spectra with the metadata
+
+
+def CCAM_CSV(input_data, ave=True):
+    if ave:
+        return ccam_csv_frame(input_data, ['mean'])
+    return ccam_csv_frame(input_data, exclude=('mean', 'median'))
 
 
 def CCAM_SAV(input_data, ave=True):
@@ -146,19 +194,65 @@ def CCAM_SAV(input_data, ave=True):
     return df
 
 
-def ccam_batch(directory, searchstring='*.csv', to_csv=None, lookupfile=None, ave=True, progressbar=None):
-    # Determine if the file is a .csv or .SAV
-    if '.sav' in searchstring.lower():
-        is_sav = True
-    else:
-        is_sav = False
-    filelist = file_search(directory, searchstring)
+def _read_ccam_file(args):
+    # Read a single CSV or SAV file. Module level so it can be sent to worker processes.
+    file, is_sav, ave = args
+    if is_sav:
+        return CCAM_SAV(file, ave=ave)
+    return CCAM_CSV(file, ave=ave)
+
+
+def _parse_ccam_files(filelist, is_sav, ave, n_jobs=1, cache=None):
+    # Yield (file, data frame) for each file, in the order of filelist.
+    # Files found unchanged in the cache are not re-parsed, the rest are parsed
+    # in a process pool when n_jobs > 1 and added to the cache.
+    frames = [None] * len(filelist)
+    keys = ['{}|ave={}'.format(os.path.abspath(file), ave) for file in filelist]
+    if cache is not None:
+        frames = [cache.get(key, [file]) for key, file in zip(keys, filelist)]
+    tasks = iter([(file, is_sav, ave) for file, frame in zip(filelist, frames) if frame is None])
+
+    # Only a few files per worker are in flight at once, so that results are not
+    # buffered faster than the caller consumes them
+    n_jobs = effective_n_jobs(n_jobs)
+    pool = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else None
+    pending = deque()
+
+    def submit_next():
+        task = next(tasks, None)
+        if task is not None:
+            pending.append(pool.submit(_read_ccam_file, task))
+
+    try:
+        if pool is not None:
+            for _ in range(n_jobs * 4):
+                submit_next()
+        for key, file, frame in zip(keys, filelist, frames):
+            if frame is None:
+                if pool is not None:
+                    frame = pending.popleft().result()
+                    submit_next()
+                else:
+                    frame = _read_ccam_file(next(tasks))
+                if cache is not None:
+                    basename = os.path.basename(file)
+                    cache.put(key, [file], frame, sclock=basename[4:13], version=basename[-5:-4])
+            yield file, frame
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
+        if cache is not None:
+            cache.save()
+
+
+def _select_ccam_files(filelist):
+    # Ensure that only one file per sclock is being read, and that it is the one with the highest version number.
+    # The result is sorted by sclock.
     basenames = np.zeros_like(filelist)
     sclocks = np.zeros_like(filelist)
     P_version = np.zeros_like(filelist, dtype='int')
 
-    # Extract the sclock and version for each file and ensure that only one
-    # file per sclock is being read, and that it is the one with the highest version number
+    # Extract the sclock and version for each file
     for i, name in enumerate(filelist):
         basenames[i] = os.path.basename(name)
         sclocks[i] = basenames[i][4:13]  # extract the sclock
@@ -170,43 +264,103 @@ def ccam_batch(directory, searchstring='*.csv', to_csv=None, lookupfile=None, av
         match = (sclocks == i)  # find all instances with matching sclocks
         maxP = P_version[match] == max(P_version[match])  # find the highest version among these files
         filelist_new = np.append(filelist_new, filelist[match][maxP])  # keep only the file with thei highest version
+    return filelist_new
+
+
+def _iter_ccam_frames(directory, searchstring, ave, n_jobs=1, cache_dir=None, progressbar=None):
+    # Yield the per-file data frames of a directory of CCS files in sclock order,
+    # skipping any file whose wavelengths do not match the first one
+    # Determine if the file is a .csv or .SAV
+    if '.sav' in searchstring.lower():
+        is_sav = True
+    else:
+        is_sav = False
+    filelist = _select_ccam_files(file_search(directory, searchstring))
 
-    filelist = filelist_new
-    # Should add a progress bar for importing large numbers of files
-    dt = []
     if progressbar:
         from PyQt5 import QtCore  # only rely on PyQt5 if a progressbar object has been passed
         progressbar.setWindowTitle('ChemCam data progress')
         progressbar.setRange(0, filelist.size)
         progressbar.show()
-    filecount = 0
-    for i, file in enumerate(filelist):
-        filecount = filecount + 1
+
+    # Parse the files (in a process pool if n_jobs > 1, skipping files already in the ingest cache).
+    # Results come back in the same order as filelist, so the output is identical to the serial one.
+    cache = IngestCache(cache_dir) if cache_dir is not None else None
+    parsed = _parse_ccam_files(filelist, is_sav, ave, n_jobs=n_jobs, cache=cache)
+
+    wvls = None
+    for filecount, (file, tmp) in enumerate(parsed, start=1):
         print(file)
-        if is_sav:
-            tmp = CCAM_SAV(file, ave=ave)
-        else:
-            tmp = CCAM_CSV(file, ave=ave)
-        if i == 0:
-            combined = tmp
-        else:
+        if wvls is None:
+            wvls = set(tmp['wvl'].columns)
+            yield tmp
+        elif set(tmp['wvl'].columns) == wvls:
             # This ensures that rounding errors are not causing mismatches in columns
-            cols1 = list(combined['wvl'].columns)
-            cols2 = list(tmp['wvl'].columns)
-            if set(cols1) == set(cols2):
-                combined = pd.concat([combined, tmp])
-            else:
-                print("Wavelengths don't match!")
+            yield tmp
+        else:
+            print("Wavelengths don't match!")
         if progressbar:
             progressbar.setValue(filecount)
             QtCore.QCoreApplication.processEvents()
-        pass
 
+
+def _finish_ccam(combined, lookupfile, cache_dir=None):
     combined.loc[:, ('meta', 'sclock')] = pd.to_numeric(combined.loc[:, ('meta', 'sclock')])
 
     if lookupfile is not None:
 
-        combined = lookup(combined, lookupfile=lookupfile.replace('[','').replace(']','').replace("'",'').replace(' ','').split(','))
+        combined = lookup(combined, lookupfile=lookupfile.replace('[','').replace(']','').replace("'",'').replace(' ','').split(','),
+                          cache_dir=cache_dir)
+    return combined
+
+
+def ccam_batch(directory, searchstring='*.csv', to_csv=None, lookupfile=None, ave=True, progressbar=None,
+               n_jobs=1, cache_dir=None):
+    # Collect the per-file frames and concatenate them once at the end,
+    # rather than growing the combined frame one file at a time
+    frames = list(_iter_ccam_frames(directory, searchstring, ave, n_jobs=n_jobs, cache_dir=cache_dir,
+                                    progressbar=progressbar))
+    combined = _finish_ccam(pd.concat(frames), lookupfile, cache_dir)
     if to_csv is not None:
         combined.to_csv(to_csv)
     return spectral_data(combined)
+
+
+def ccam_batch_iter(directory, searchstring='*.csv', lookupfile=None, ave=True, chunksize=1000, n_jobs=1,
+                    cache_dir=None, progressbar=None):
+    """
+    Read a directory of ChemCam CCS files as a stream of spectral_data chunks.
+
+    Works like ccam_batch, but only holds about chunksize spectra (plus the
+    files being parsed) in memory at a time, so that downstream steps can run
+    out-of-core when every shot is kept (ave=False).
+
+    Parameters
+    ----------
+    chunksize : int
+                The maximum number of spectra in each chunk.  Spectra from one
+                file may be split across consecutive chunks.
+
+    All other parameters are as for ccam_batch.
+
+    Yields
+    ------
+     : spectral_data
+       Chunks of at most chunksize spectra, in sclock order
+    """
+    if chunksize < 1:
+        raise ValueError('chunksize must be at least 1')
+    buffered = []
+    nbuffered = 0
+    for tmp in _iter_ccam_frames(directory, searchstring, ave, n_jobs=n_jobs, cache_dir=cache_dir,
+                                 progressbar=progressbar):
+        buffered.append(tmp)
+        nbuffered += len(tmp.index)
+        while nbuffered >= chunksize:
+            combined = pd.concat(buffered) if len(buffered) > 1 else buffered[0]
+            rest = combined.iloc[chunksize:]
+            buffered = [rest] if len(rest.index) else []
+            nbuffered = len(rest.index)
+            yield spectral_data(_finish_ccam(combined.iloc[:chunksize].copy(), lookupfile, cache_dir))
+    if nbuffered:
+        yield spectral_data(_finish_ccam(pd.concat(buffered), lookupfile, cache_dir))
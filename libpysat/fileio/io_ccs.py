@@ -9,48 +9,15 @@ import pandas as pd
 import scipy.io as io
 from PyQt5 import QtCore
 
+from libpysat.fileio.io_ccam_pds import ccam_csv_frame
 from libpysat.fileio.lookup import lookup
 from libpysat.fileio.utils import file_search
 from libpysat.spectral.spectral_data import spectral_data
 
 
 def CCAM_CSV(input_data):
-    try:
-        df = pd.read_csv(input_data, header=14, engine='c')
-        cols = list(df.columns.values)
-        df.columns = [i.strip().replace('# ', '') for i in cols]  # strip whitespace from column names
-        df.set_index(['wave'], inplace=True)  # use wavelengths as indices
-        # read the file header and put information into the dataframe as new columns
-        metadata = pd.read_csv(input_data, sep='=', nrows=14, comment=',', engine='c', index_col=0, header=None)
-
-    except:  # handle files with an extra header row containing temperature
-        df = pd.read_csv(input_data, header=15, engine='c')
-        cols = list(df.columns.values)
-        df.columns = [i.strip().replace('# ', '') for i in cols]  # strip whitespace from column names
-        df.set_index(['wave'], inplace=True)  # use wavelengths as indices
-        # read the file header and put information into the dataframe as new columns
-        metadata = pd.read_csv(input_data, sep='=', nrows=15, comment=',', engine='c', index_col=0, header=None)
-
-    df.index = [['wvl'] * len(df.index),
-                df.index.values.round(4)]  # create multiindex so spectra can be easily extracted with a single key
-    df = df.T  # transpose so that each spectrum is a row
-
-    # remove extraneous stuff from the metadataindices
-    metadata.index = [i.strip().strip('# ').replace(' FLOAT', '').lower() for i in metadata.index.values]
-    metadata = metadata.T
-
-    # extract info from the file name
-    fname = os.path.basename(input_data)
-    metadata['sclock'] = fname[4:13]
-    metadata['seqid'] = fname[25:34].upper()
-    metadata['Pversion'] = fname[34:36]
-
-    # duplicate the metadata for each row in the df
-    metadata = metadata.append([metadata] * (len(df.index) - 1), ignore_index=True)
-    metadata.index = df.index  # make the indices match
-    metadata.columns = [['meta'] * len(metadata.columns), metadata.columns.values]  # make the columns into multiindex
-    df = pd.concat([metadata, df], axis=1)  # combine the spectra with the metadata
-    return df
+    # keep every table column (individual shots, mean and median) as a row
+    return ccam_csv_frame(input_data)
 
 
 def CCAM_SAV(input_data, ave=True):
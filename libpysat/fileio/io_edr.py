@@ -1,81 +1,179 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 
+from libpysat.fileio.utils import file_search, label_statements, read_label_text
+from libpysat.utils.utils import effective_n_jobs
+
+# number of channels in a ChemCam LIBS spectrum, used when the label doesn't list ITEMS
+CCAM_LIBS_CHANNELS = 6444
+
+
+def read_edr_label(input_file):
+    """
+    Parse the parts of a ChemCam EDR label needed to read the LIBS spectra
+
+    Parameters
+    ----------
+    input_file : str
+                 PATH to the EDR .dat file
+
+    Returns
+    -------
+    label : dict
+            with keys record_bytes, label_records, sclock, seqid, focus_dist,
+            temps (a list of (name, value) tuples), nshots, start_byte and nchannels
+    """
+    label = {'temps': [], 'nchannels': CCAM_LIBS_CHANNELS, 'sclock': None, 'seqid': None, 'focus_dist': None}
+    text = read_label_text(input_file)
+
+    temps = []
+    temp_names = []
+    objects = []  # stack of the names of the objects we are inside
+    in_libs_container = False
+    for key, value in label_statements(text):
+        if key == 'OBJECT':
+            objects.append(value)
+        elif key == 'END_OBJECT':
+            if objects:
+                objects.pop()
+            if value == 'CONTAINER':
+                in_libs_container = False
+        elif key == 'RECORD_BYTES':
+            label['record_bytes'] = int(value)
+        elif key == 'LABEL_RECORDS':
+            label['label_records'] = int(value)
+        elif key == 'SPACECRAFT_CLOCK_START_COUNT':
+            label['sclock'] = int(value.replace('"', '').split('.')[0])
+        elif key == 'SEQUENCE_ID':
+            label['seqid'] = value.replace('"', '').strip()
+        elif key == 'INSTRUMENT_FOCUS_DISTANCE':
+            label['focus_dist'] = int(value)
+        elif key == 'INSTRUMENT_TEMPERATURE':
+            temps = [float(i) for i in
+                     value.replace('<degC>', '').replace('(', '').replace(')', '').replace(' ', '').split(',')]
+        elif key == 'INSTRUMENT_TEMPERATURE_NAME':
+            temp_names = value.replace(' ', '').replace('(', '').replace(')', '').replace('"', '').split(',')
+        elif key == 'NAME' and 'CCAM_LIBS_DATA_CONTAINER' in value:
+            in_libs_container = True
+        elif in_libs_container and key == 'REPETITIONS':
+            label['nshots'] = int(value)
+        elif in_libs_container and key == 'START_BYTE' and objects[-1] == 'CONTAINER':
+            label['start_byte'] = int(value)
+        elif in_libs_container and key == 'ITEMS':
+            label['nchannels'] = int(value)
+
+    label['temps'] = list(zip(temp_names, temps))
+    return label
+
+
+def read_edr(input_file, mmap=False):
+    """
+    Read the LIBS spectra from a ChemCam EDR file
+
+    Parameters
+    ----------
+    input_file : str
+                 PATH to the EDR .dat file
+
+    mmap : bool
+           If True, return a read-only memory map of the spectra instead of
+           reading them into memory
+
+    Returns
+    -------
+    spectra : ndarray
+              (nshots, nchannels) array of big endian unsigned 16 bit counts
+
+    label : dict
+            The parsed label, see read_edr_label
+    """
+    label = read_edr_label(input_file)
+    header_skip = label['label_records'] * label['record_bytes']  # number of header bytes to skip to get to the data
+    offset = header_skip + label['start_byte'] - 1
+    shape = (label['nshots'], label['nchannels'])
+    if mmap:
+        spectra = np.memmap(input_file, dtype='>u2', mode='r', offset=offset, shape=shape)
+    else:
+        with open(input_file, 'rb') as f:
+            f.seek(offset, 0)
+            spectra = np.fromfile(f, dtype='>u2', count=shape[0] * shape[1]).reshape(shape)
+    return spectra, label
+
+
+def _edr_metadata(input_file, label, nshots):
+    metadata = pd.DataFrame({'EDR_file': os.path.basename(input_file),
+                             'Spacecraft_Clock': label['sclock'],
+                             'Shot': np.arange(1, nshots + 1),
+                             'SeqID': label['seqid'],
+                             'Focus_Distance': label['focus_dist']},
+                            columns=['EDR_file', 'Spacecraft_Clock', 'Shot', 'SeqID', 'Focus_Distance'],
+                            index=np.arange(1, nshots + 1))
+    for name, temp in label['temps']:
+        metadata[name + '_temp'] = temp
+    return metadata
+
 
 def EDR(input_file):
-    f = open(input_file, 'rb')  # read as bytes so python won't complain about the binary part of the file
-
-    # read lines of the header until reaching the end of the libs table (collecting other metadata along the way)
-    end_of_libs_table = False
-    while end_of_libs_table is False:
-        line = str(f.readline(), 'utf-8').replace('\r', '').replace('\n',
-                                                                    '')  # convert the current line to a string and get rid of newline characters
-        line = line.split('=')  # split the line on equals sign if present
-        # look for the name of the value we want, if the current line has it, then set the value
-        if 'RECORD_BYTES' in line[0]:
-            rbytes = int(line[1])
-        if 'LABEL_RECORDS' in line[0]:
-            lrecs = int(line[1])
-        if 'SPACECRAFT_CLOCK_START_COUNT' in line[0]:
-            sclock = int(line[1].replace('"', '').split('.')[0])
-        if 'SEQUENCE_ID' in line[0]:
-            seqID = line[1].replace('"', '')
-        if 'INSTRUMENT_FOCUS_DISTANCE' in line[0]:
-            focus_dist = int(line[1])
-
-        if 'INSTRUMENT_TEMPERATURE' in line[0]:
-            instrument_temps = line[1] \
-                               + str(f.readline(), 'utf-8').replace('\r', '').replace('\n', '') \
-                               + str(f.readline(), 'utf-8').replace('\r', '').replace('\n', '') \
-                               + str(f.readline(), 'utf-8').replace('\r', '').replace('\n', '')
-            instrument_temps = [float(i) for i in
-                                instrument_temps.replace('<degC>', '').replace('(', '').replace(')', '').replace(' ',
-                                                                                                                 '').split(
-                                    ',')]
-            instrument_temps_name = str(f.readline(), 'utf-8').replace('\r', '').replace('\n', '')
-            instrument_temps_name = instrument_temps_name.split('=')[1] \
-                                    + str(f.readline(), 'utf-8').replace('\r', '').replace('\n', '') \
-                                    + str(f.readline(), 'utf-8').replace('\r', '').replace('\n', '') \
-                                    + str(f.readline(), 'utf-8').replace('\r', '').replace('\n', '') \
-                                    + str(f.readline(), 'utf-8').replace('\r', '').replace('\n', '')
-            instrument_temps_name = instrument_temps_name.replace(' ', '').replace('(', '').replace(')', '').replace(
-                '"', '').split(',')
-            f.readline()
-            pass
-        try:
-            if 'CCAM_LIBS_DATA_CONTAINER' in line[1]:
-                nshots = int(str(f.readline(), 'utf-8').replace('\r', '').replace('\n', '').split('=')[1])
-                start_byte = int(str(f.readline(), 'utf-8').replace('\r', '').replace('\n', '').split('=')[1])
-            if 'END_OBJECT' in line[0] and 'CCAM_LIBS_TABLE' in line[1]:
-                end_of_libs_table = True
-        except:
-            pass
-
-    f.close()
-
-    header_skip = lrecs * rbytes  # calculate the number of header bytes to skip to get to the real data
-
-    with open(input_file, "rb") as f:
-        f.seek(header_skip + start_byte - 1, 0)
-        spectra = []
-        while spectra.__len__() < nshots:
-            spectrum = []
-            while spectrum.__len__() < 6444:
-                spectrum.append(int.from_bytes(f.read(2), byteorder='big', signed=False))
-            spectra.append(spectrum)
-    spectra = np.array(spectra, dtype='int')
-    cols = np.array(list(range(spectra.shape[1]))) + 1
-    cols = [('channel', i) for i in cols]
-    inds = np.array(list(range(spectra.shape[0]))) + 1
-    sp = pd.DataFrame(spectra, columns=pd.MultiIndex.from_tuples(cols), index=inds)
-    sp[('meta', 'EDR_file')] = os.path.basename(input_file)
-    sp[('meta', 'Spacecraft_Clock')] = sclock
-    sp[('meta', 'Shot')] = sp.index
-    sp[('meta', 'SeqID')] = seqID
-    sp[('meta', 'Focus_Distance')] = focus_dist
-    for ind, name in enumerate(instrument_temps_name):
-        sp[('meta', name + '_temp')] = instrument_temps[ind]
-    sp.to_csv('test.csv')
-    return sp
+    spectra, label = read_edr(input_file)
+    cols = [('channel', i) for i in range(1, spectra.shape[1] + 1)]
+    inds = np.arange(1, spectra.shape[0] + 1)
+    sp = pd.DataFrame(spectra.astype('int'), columns=pd.MultiIndex.from_tuples(cols), index=inds)
+    metadata = _edr_metadata(input_file, label, spectra.shape[0])
+    metadata.columns = pd.MultiIndex.from_arrays([['meta'] * len(metadata.columns), metadata.columns])
+    return pd.concat([sp, metadata], axis=1)
+
+
+def _read_edr_file(input_file):
+    spectra, label = read_edr(input_file)
+    return spectra, _edr_metadata(input_file, label, spectra.shape[0])
+
+
+def edr_batch(directory, searchstring='*edr*.dat', n_jobs=1):
+    """
+    Read a directory of ChemCam EDR files into a single array
+
+    Parameters
+    ----------
+    directory : str
+                The directory to (recursively) search for EDR files
+
+    searchstring : str
+                   The pattern the EDR file names must match
+
+    n_jobs : int
+             The number of worker processes used to read files, see
+             libpysat.utils.utils.effective_n_jobs
+
+    Returns
+    -------
+    spectra : ndarray
+              (nfiles, nshots, nchannels) array of counts. Files with fewer
+              shots than the largest file are padded with zeros.
+
+    metadata : DataFrame
+               One row per shot that was read, with the index of the file
+               along the first axis of spectra in the 'file_index' column
+    """
+    filelist = np.sort(file_search(directory, searchstring))
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs > 1 and len(filelist) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_read_edr_file, filelist, chunksize=max(1, len(filelist) // (n_jobs * 4))))
+    else:
+        results = [_read_edr_file(f) for f in filelist]
+    if not results:
+        return np.empty((0, 0, CCAM_LIBS_CHANNELS), dtype=np.uint16), pd.DataFrame()
+
+    nshots = max(s.shape[0] for s, m in results)
+    nchannels = results[0][0].shape[1]
+    spectra = np.zeros((len(results), nshots, nchannels), dtype=np.uint16)
+    for i, (s, m) in enumerate(results):
+        if s.shape[1] != nchannels:
+            raise ValueError('{} has {} channels, expected {}'.format(filelist[i], s.shape[1], nchannels))
+        spectra[i, :s.shape[0]] = s
+        m.insert(0, 'file_index', i)
+    metadata = pd.concat([m for s, m in results], ignore_index=True)
+    return spectra, metadata
@@ -1,11 +1,32 @@
 import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
-from pandas.core.common import array_equivalent
 
+try:
+    from pandas.core.dtypes.missing import array_equivalent
+except ImportError:  # older versions of pandas
+    from pandas.core.common import array_equivalent
+
+from libpysat.fileio.ingest_cache import IngestCache
 from libpysat.fileio.utils import file_search
 from libpysat.spectral.spectral_data import spectral_data
+from libpysat.utils.utils import effective_n_jobs
+
+# composition columns in the sample lookup table, these are split from the rest of the metadata
+JSC_COMP_COLS = ['SiO2', 'TiO2', 'Al2O3', 'Cr2O3', 'Fe2O3T', 'MnO', 'MgO', 'CaO', 'Na2O', 'K2O', 'P2O5',
+                 'SO3 LOI Residue', 'Total', 'Total Includes', '%LOI', 'FeO',
+                 'Fe2O3', 'SO3 Actual', 'Fe(3+)/Fe(Total)', 'Rb (ug/g)', 'Sr (ug/g)', 'Y (ug/g)', 'Zr (ug/g)',
+                 'V (ug/g)', 'Ni (ug/g)', 'Cr (ug/g)',
+                 'Nb (ug/g)', 'Ga (ug/g)', 'Cu (ug/g)', 'Zn (ug/g)', 'Co (ug/g)', 'Ba (ug/g)', 'La (ug/g)',
+                 'Ce (ug/g)', 'U (ug/g)', 'Th (ug/g)', 'Sc (ug/g)',
+                 'Pb (ug/g)', 'Ge (ug/g)', 'As (ug/g)', 'Cl (ug/g)']
+
+# The lookup tables as built by compile_refdata: a dict of metadata rows per table, the duplicated
+# sample IDs, and the memo of rows already looked up per combination of IDs
+CompiledRefdata = namedtuple('CompiledRefdata', ['ID', 'sample', 'dup_samples', 'laser', 'exp', 'spect', 'memo'])
 
 
 # This function reads the lookup tables used to expand metadata from the file names
@@ -28,6 +49,64 @@ def read_refdata(LUT_files):
     return refdata
 
 
+# This function compiles the lookup tables into plain dictionaries of ready-made metadata rows,
+# so that parsing a file name is a few dictionary lookups rather than a series of pandas
+# .loc / transpose / concat operations. Results for each combination of IDs are memoized.
+# Pass the result in place of refdata to jsc_filename_parse and JSC when parsing many files.
+def compile_refdata(refdata):
+    def rows(table):
+        table = table[~table.index.duplicated(keep='first')]
+        return table.to_dict('index')
+
+    sample = refdata['sample']
+    return CompiledRefdata(ID=refdata['ID'].iloc[:, 0].to_dict(),
+                           sample=rows(sample),
+                           dup_samples=set(sample.index[sample.index.duplicated()]),
+                           laser=rows(refdata['laser']),
+                           exp=rows(refdata['exp']),
+                           spect=rows(refdata['spect']),
+                           memo={})
+
+
+def _compiled_refdata(refdata):
+    # refdata is either already compiled, or a dict of tables that is compiled for this call only
+    if isinstance(refdata, CompiledRefdata):
+        return refdata
+    return compile_refdata(refdata)
+
+
+def _lookup_rows(compiled, libs_ID, laserID, expID, spectID):
+    # Build the (column, value) pairs that come from the lookup tables for one combination of IDs.
+    # None marks where the values parsed from each file name go.
+    key = (libs_ID, laserID, expID, spectID)
+    if key in compiled.memo:
+        return compiled.memo[key]
+
+    sampleID = compiled.ID.get(libs_ID, 'Unknown')
+    if sampleID not in compiled.sample:
+        sampleID = 'Unknown'
+    if sampleID in compiled.dup_samples:
+        print('More than one matching row for ' + sampleID + '!')
+        sample_info = compiled.sample['Unknown']
+    else:
+        sample_info = compiled.sample[sampleID]
+
+    items = list(sample_info.items())
+    items += [('Sample ID', sampleID), ('LIBS ID', libs_ID), ('loc', None), ('lab', None), ('gas', None),
+              ('pressure', None)]
+    if laserID in compiled.laser:
+        items += [('Laser Identifier', laserID)] + list(compiled.laser[laserID].items())
+    items.append(('laser_power', None))
+    if expID in compiled.exp:
+        items += [('Exp Identifier', expID)] + list(compiled.exp[expID].items())
+    items.append(('spectrometer', spectID))
+    if spectID in compiled.spect:
+        items += [('Spectrometer Identifier', spectID)] + list(compiled.spect[spectID].items())
+
+    compiled.memo[key] = items
+    return items
+
+
 # This function parses the file names to record metadata related to the observation
 def jsc_filename_parse(filename, refdata):
     filename = os.path.basename(filename)  # strip the path off of the file name
@@ -37,89 +116,68 @@ def jsc_filename_parse(filename, refdata):
     expID = filename[5]
     spectID = filename[6]
 
-    try:
-        sampleID = refdata['ID'].loc[libs_ID].values[0]
-        file_info = pd.DataFrame(refdata['sample'].loc[sampleID])
-        if file_info.columns.shape[0] < file_info.index.shape[0]:
-            file_info = file_info.T
-        if file_info.index.shape[0] > 1:
-            print('More than one matching row for ' + sampleID + '!')
-            tempID = 'Unknown'
-            file_info = pd.DataFrame(refdata['sample'].loc[tempID])
-            if file_info.columns.shape[0] < file_info.index.shape[0]:
-                file_info = file_info.T
-
-
-    except:
-        sampleID = 'Unknown'
-        file_info = pd.DataFrame(refdata['sample'].loc[sampleID])
-        if file_info.columns.shape[0] < file_info.index.shape[0]:
-            file_info = file_info.T
-
-    file_info['Sample ID'] = sampleID
-    file_info['LIBS ID'] = libs_ID
-    file_info.reset_index(level=0, inplace=True, drop=True)
-    file_info['loc'] = int(filename[1])
-    file_info['lab'] = filename[2]
-    file_info['gas'] = filename[3][0]
-    file_info['pressure'] = float(filename[3][1:])
-
-    if laserID in refdata['laser'].index:
-        laser_info = pd.DataFrame(refdata['laser'].loc[laserID]).T
-        laser_info.index.name = 'Laser Identifier'
-        laser_info.reset_index(level=0, inplace=True)
-        file_info = pd.concat([file_info, laser_info], axis=1)
-
-    file_info['laser_power'] = float(filename[4][1:])
-    if expID in refdata['exp'].index:
-        exp_info = pd.DataFrame(refdata['exp'].loc[expID]).T
-        exp_info.index.name = 'Exp Identifier'
-        exp_info.reset_index(level=0, inplace=True)
-        file_info = pd.concat([file_info, exp_info], axis=1)
-
-    file_info['spectrometer'] = spectID
-    if spectID in refdata['spect'].index:
-        temp = refdata['spect'].loc[spectID]
-        temp = [temp[2], temp[4:]]
-        spect_info = pd.DataFrame(refdata['spect'].loc[spectID]).T
-        spect_info.index.name = 'Spectrometer Identifier'
-        spect_info.reset_index(level=0, inplace=True)
-        file_info = pd.concat([file_info, spect_info], axis=1)
-
-    return file_info
+    file_values = {'loc': int(filename[1]),
+                   'lab': filename[2],
+                   'gas': filename[3][0],
+                   'pressure': float(filename[3][1:]),
+                   'laser_power': float(filename[4][1:])}
+
+    items = _lookup_rows(_compiled_refdata(refdata), libs_ID, laserID, expID, spectID)
+    columns = [k for k, v in items]
+    values = [file_values[k] if v is None and k in file_values else v for k, v in items]
+    return pd.DataFrame([values], columns=columns)
+
+
+def _read_jsc_spectra(file):
+    # Read the time columns and the spectra from one file. The spectra are read straight into
+    # a single array, read_csv is much slower when it has to build a column for every wavelength.
+    with open(file) as f:
+        for _ in range(14):
+            f.readline()
+        header = f.readline().rstrip('\r\n').split('\t')
+    time = pd.read_csv(file, skiprows=14, sep='\t', engine='c', usecols=[0, 1])
+    time.columns = ['time1', 'time2']
+    spectra = np.loadtxt(file, skiprows=15, delimiter='\t', usecols=range(2, len(header)), ndmin=2)
+    return time, header[2:], spectra
+
+
+def _join_spectrometers(parts):
+    # Join the spectra from each spectrometer on the time keys in a single aligned operation.
+    # Only times present in every file are kept, in the order of the first file (as an inner merge would).
+    keys = [pd.MultiIndex.from_arrays([time['time1'], time['time2']]) for time, wvls, spectra in parts]
+    if any(k.has_duplicates for k in keys):
+        # repeated time stamps can't be aligned on the index, fall back to merging file by file
+        frames = [pd.concat([time, pd.DataFrame(spectra, columns=wvls)], axis=1) for time, wvls, spectra in parts]
+        data = frames[0]
+        for datatemp in frames[1:]:
+            data = data.merge(datatemp)
+        return data[['time1', 'time2']], list(data.columns[2:]), data.iloc[:, 2:].values
+
+    common = keys[0]
+    for k in keys[1:]:
+        common = common[common.isin(k)]
+    rows = [k.get_indexer(common) for k in keys]
+    time = parts[0][0].iloc[rows[0]].reset_index(drop=True)
+    wvls = [w for part in parts for w in part[1]]
+    spectra = np.hstack([part[2][r] for part, r in zip(parts, rows)])
+    return time, wvls, spectra
 
 
 def JSC(input_files, refdata):
     try:
-        # read the first file
-        data = pd.read_csv(input_files[0], skiprows=14, sep='\t', engine='c')
-        data = data.rename(columns={data.columns[0]: 'time1', data.columns[1]: 'time2'})
-        metadata = pd.concat([jsc_filename_parse(input_files[0], refdata)] * len(data.index))
-        metadata.drop('spectrometer', axis=1, inplace=True)
-
-        # read the next files and merge them with the first
-        for file in input_files[1:]:
-            datatemp = pd.read_csv(file, skiprows=14, sep='\t', engine='c')
-            datatemp = datatemp.rename(columns={datatemp.columns[0]: 'time1', datatemp.columns[1]: 'time2'})
-            data = data.merge(datatemp)
-
-        time = data[['time1', 'time2']]  # split the two time columns from the data frame
-        data.drop(['time1', 'time2'], axis=1, inplace=True)  # trim the data frame so it is just the spectra
+        # read the spectra from each spectrometer and join them
+        time, wvls, spectra = _join_spectrometers([_read_jsc_spectra(file) for file in input_files])
 
         # make a multiindex for each wavlength column so they can be easily isolated from metadata later
-        data.columns = [['wvl'] * len(data.columns), np.array(data.columns.values, dtype='float').round(4)]
+        data = pd.DataFrame(spectra, columns=[['wvl'] * len(wvls), np.array(wvls, dtype='float').round(4)])
+
+        metadata = pd.concat([jsc_filename_parse(input_files[0], refdata)] * len(data.index))
+        metadata.drop('spectrometer', axis=1, inplace=True)
 
         metadata.index = data.index
         metadata = pd.concat([metadata, time], axis=1)
-        compcols = ['SiO2', 'TiO2', 'Al2O3', 'Cr2O3', 'Fe2O3T', 'MnO', 'MgO', 'CaO', 'Na2O', 'K2O', 'P2O5',
-                    'SO3 LOI Residue', 'Total', 'Total Includes', '%LOI', 'FeO',
-                    'Fe2O3', 'SO3 Actual', 'Fe(3+)/Fe(Total)', 'Rb (ug/g)', 'Sr (ug/g)', 'Y (ug/g)', 'Zr (ug/g)',
-                    'V (ug/g)', 'Ni (ug/g)', 'Cr (ug/g)',
-                    'Nb (ug/g)', 'Ga (ug/g)', 'Cu (ug/g)', 'Zn (ug/g)', 'Co (ug/g)', 'Ba (ug/g)', 'La (ug/g)',
-                    'Ce (ug/g)', 'U (ug/g)', 'Th (ug/g)', 'Sc (ug/g)',
-                    'Pb (ug/g)', 'Ge (ug/g)', 'As (ug/g)', 'Cl (ug/g)']
-        compdata = metadata[compcols]
-        metadata.drop(compcols, axis=1, inplace=True)
+        compdata = metadata[JSC_COMP_COLS]
+        metadata.drop(JSC_COMP_COLS, axis=1, inplace=True)
         metadata.columns = [['meta'] * len(metadata.columns), metadata.columns.values]
         compdata.columns = [['comp'] * len(compdata.columns), compdata.columns.values]
         data = pd.concat([data, metadata, compdata], axis=1)
@@ -128,50 +186,102 @@ def JSC(input_files, refdata):
         data.set_index(('meta', 'time2'), drop=False, inplace=True)
 
         return data
-    except:
-        print('Problem reading:' + input_file)
-        print('Moving to Problem_Files')
-        os.rename(input_file,
-                  r"C:\\Users\\rbanderson\\Documents\\Projects\\LIBS PDART\\Database\\LIBS USGS\\Problem_Files\\" + os.path.basename(
-                      input_file))
+    except Exception:
+        print('Problem reading: ' + ', '.join(input_files))
         return None
 
 
-def jsc_batch(directory, LUT_files, searchstring='*.txt', to_csv=None):
-    # Read in the lookup tables to expand filename metadata
-    refdata = read_refdata(LUT_files)
-    # get the list of files that match the search string in the given directory
-    filelist = file_search(directory, searchstring)
-    spectIDs = []  # create an empty list to hold the spectrometer IDs
+def _jsc_groups(filelist):
+    # Group the files by LIBS ID and then location, in sorted order. The files within a group are
+    # sorted too, so that every group joins its spectrometers in the same order.
+    filelist = np.sort(filelist)
     libsIDs = []
-    timestamps = []
     locs = []
     for file in filelist:
         filesplit = os.path.basename(file).split('_')
-        spectIDs.append(filesplit[6])  # get the spectrometer IDs for each file in the list
         libsIDs.append(filesplit[0])
-        timestamps.append(filesplit[-1].split('.')[0])
         locs.append(filesplit[1])
-    spectIDs_unique = np.unique(spectIDs)  # get the unique spectrometer IDs
-    libsIDs_unique = np.unique(libsIDs)
-    dfs = []  # create an empty list to hold the data frames for each spectrometer
-
-    # loop through each LIBS ID
-    alldata = []
-    for ID in libsIDs_unique:
-        print('Working on : ' + str(ID))
-        sublist = filelist[np.in1d(libsIDs, ID)]
-        locs = []
-        for file in sublist:
-            locs.append(os.path.basename(file).split('_')[1])
-        locs_unique = np.unique(locs)
-        # loop through each location for that libs ID
-        for loc in locs_unique:
-            print(loc)
-            sub_sublist = sublist[np.in1d(locs, loc)]  # get the files for that LIBSID and location
-            data = JSC(sub_sublist, refdata)
-            alldata.append(data)
-            pass
+    libsIDs = np.array(libsIDs)
+    locs = np.array(locs)
+
+    groups = []
+    for ID in np.unique(libsIDs):
+        in_ID = libsIDs == ID
+        for loc in np.unique(locs[in_ID]):
+            groups.append((ID, loc, filelist[in_ID & (locs == loc)]))  # the files for that LIBS ID and location
+    return groups
+
+
+def jsc_batch(directory, LUT_files, searchstring='*.txt', to_csv=None, cache_dir=None, n_jobs=1):
+    """
+    Read a directory of JSC LIBS files, combining the spectrometers for each
+    LIBS ID and location
+
+    Parameters
+    ----------
+    directory : str
+                The directory to (recursively) search for files
+
+    LUT_files : dict
+                PATHs of the 'ID', 'spect', 'laser', 'exp' and 'sample' lookup tables
+
+    searchstring : str
+                   The pattern the file names must match
+
+    to_csv : str
+             If given, PATH of a csv file to write the combined data to
+
+    cache_dir : str
+                If given, groups of files that have not changed since the last
+                run are read from an IngestCache in this directory
+
+    n_jobs : int
+             The number of worker processes used to read the groups of files,
+             see libpysat.utils.utils.effective_n_jobs. Results are combined in
+             the same order whatever the number of workers.
+
+    Returns
+    -------
+    data : spectral_data
+    """
+    # Read in the lookup tables to expand filename metadata
+    refdata = compile_refdata(read_refdata(LUT_files))
+    # groups of files that have not changed since the last run are read from the ingest cache
+    cache = IngestCache(cache_dir) if cache_dir is not None else None
+    LUT_paths = [LUT_files[k] for k in sorted(LUT_files.keys())]
+    # get the list of files that match the search string in the given directory
+    filelist = file_search(directory, searchstring)
+    groups = _jsc_groups(filelist)
+
+    alldata = [None] * len(groups)
+    keys = []
+    sources = []
+    for i, (ID, loc, files) in enumerate(groups):
+        # the lookup tables are part of the signature so that editing them invalidates the entry
+        keys.append('{}|{}|{}'.format(os.path.abspath(directory), ID, loc))
+        sources.append(list(files) + LUT_paths)
+        if cache is not None:
+            alldata[i] = cache.get(keys[i], sources[i])
+    todo = [i for i, data in enumerate(alldata) if data is None]
+
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = pool.map(JSC, [groups[i][2] for i in todo], [refdata] * len(todo),
+                               chunksize=max(1, len(todo) // (n_jobs * 4)))
+            results = list(results)
+    else:
+        results = []
+        for i in todo:
+            print('Working on : ' + str(groups[i][0]) + ' ' + str(groups[i][1]))
+            results.append(JSC(groups[i][2], refdata))
+
+    for i, data in zip(todo, results):
+        alldata[i] = data
+        if cache is not None and data is not None:
+            cache.put(keys[i], sources[i], data)
+    if cache is not None:
+        cache.save()
 
     combined = pd.concat(alldata)
     if to_csv is not None:
@@ -180,24 +290,64 @@ def jsc_batch(directory, LUT_files, searchstring='*.txt', to_csv=None):
     return spectral_data(combined)
 
 
-# got this function from stack overflow: http://stackoverflow.com/questions/14984119/python-pandas-remove-duplicate-columns
-# it's slow but doesn't crash python like combined.T.drop_duplicates().T does in some cases with very large sets of data
+def _column_fingerprints(values):
+    # Hash each column of a 2D array into a single uint64 in one vectorized pass. Equal columns
+    # (in the sense of array_equivalent) always get the same fingerprint, different columns
+    # almost always get different ones.
+    if values.dtype.kind in 'fc':
+        values = values + 0  # -0.0 == 0.0
+        values[np.isnan(values)] = np.nan  # there is more than one bit pattern for NaN
+    hashes = pd.util.hash_array(np.ascontiguousarray(values.T).ravel()).reshape(values.shape[1], values.shape[0])
+    weights = np.random.RandomState(0).randint(1, 2 ** 62, size=values.shape[0]).astype(np.uint64) | np.uint64(1)
+    with np.errstate(over='ignore'):
+        return (hashes * weights).sum(axis=1, dtype=np.uint64)
+
+
 def duplicate_columns(frame):
-    groups = frame.columns.to_series().groupby(frame.dtypes).groups
+    """
+    Find columns that hold the same values as a later column of the same dtype
+
+    Each column is fingerprinted by hashing its values, and only columns whose fingerprints
+    collide are compared directly, so this scales to frames with tens of thousands of columns.
+    (This replaces a pairwise comparison from stack overflow: http://stackoverflow.com/questions/14984119,
+    which was used because combined.T.drop_duplicates().T can crash python with very large sets of data.)
+
+    Parameters
+    ----------
+    frame : DataFrame
+
+    Returns
+    -------
+    dups : list
+           Labels of the columns that have a later duplicate, so that dropping them keeps
+           the last of each set of equal columns
+    """
+    positions = pd.Series(np.arange(len(frame.columns)))
+    groups = positions.groupby(frame.dtypes.values).groups
     dups = []
 
     for t, v in groups.items():
-
-        cs = frame[v].columns
-        vs = frame[v]
-        lcs = len(cs)
-
-        for i in range(lcs):
-            ia = vs.iloc[:, i].values
-            for j in range(i + 1, lcs):
-                ja = vs.iloc[:, j].values
-                if array_equivalent(ia, ja):
-                    dups.append(cs[i])
-                    break
+        cols = np.asarray(v)
+        values = frame.iloc[:, cols].values
+        fingerprints = _column_fingerprints(values)
+        order = np.argsort(fingerprints, kind='mergesort')
+        starts = np.flatnonzero(np.r_[True, fingerprints[order][1:] != fingerprints[order][:-1]])
+        is_dup = np.zeros(len(cols), dtype=bool)
+        for bucket in np.split(order, starts[1:]):
+            if len(bucket) < 2:
+                continue
+            # split the columns that share a fingerprint into sets of equal columns, every column
+            # but the last of each set is a duplicate
+            classes = []
+            for i in bucket:
+                for members in classes:
+                    if array_equivalent(values[:, members[0]], values[:, i]):
+                        members.append(i)
+                        break
+                else:
+                    classes.append([i])
+            for members in classes:
+                is_dup[members[:-1]] = True
+        dups.extend(frame.columns[cols[is_dup]])
 
     return dups
@@ -43,6 +43,6 @@ def write_json(outdata, outputfile):
     """
     try:
         with open(outputfile, 'w') as f:
-            f.write(json.dumps(outdata, outputfile))
+            f.write(json.dumps(outdata))
     except:  # pragma: no cover
         raise IOError('Unable to write data to {}'.format(outputfile))
@@ -1,6 +1,192 @@
+import os
+import re
+
 import numpy as np
+import pandas as pd
 from osgeo import gdal
 
+# ENVI header data type codes -> numpy types
+ENVI_DTYPES = {1: 'u1', 2: 'i2', 3: 'i4', 4: 'f4', 5: 'f8', 12: 'u2', 13: 'u4', 14: 'i8', 15: 'u8'}
+
+# The order of the (line, sample, band) axes in the file for each interleave
+ENVI_INTERLEAVE_AXES = {'bsq': ('bands', 'lines', 'samples'),
+                        'bil': ('lines', 'bands', 'samples'),
+                        'bip': ('lines', 'samples', 'bands')}
+
+
+def _pair_files(input_data):
+    # Return the (.hdr, .img) PATHs for either file of an M3 pair
+    base, ext = os.path.splitext(input_data)
+    if ext.lower() == '.hdr':
+        candidates = [base + '.img', base + '.IMG']
+        img = next((c for c in candidates if os.path.exists(c)), candidates[0])
+        return input_data, img
+    candidates = [base + '.hdr', base + '.HDR', input_data + '.hdr']
+    hdr = next((c for c in candidates if os.path.exists(c)), candidates[0])
+    return hdr, input_data
+
+
+def read_envi_header(hdr):
+    """
+    Parse an ENVI style .hdr file
+
+    Parameters
+    ----------
+    hdr : str
+          PATH to the header
+
+    Returns
+    -------
+    header : dict
+             Keyed on the lower case field names. Numeric fields are converted
+             to int or float, {} lists are returned as lists (of floats where
+             possible, e.g. the wavelength list).
+    """
+    with open(hdr) as f:
+        text = f.read()
+    header = {}
+    for key, value in re.findall(r'^\s*([^=\n]+?)\s*=\s*(\{[^}]*\}|[^\n]*)', text, re.MULTILINE):
+        key = key.strip().lower()
+        value = value.strip()
+        if value.startswith('{'):
+            items = [i.strip() for i in value[1:-1].split(',')]
+            try:
+                value = [float(i) for i in items]
+            except ValueError:
+                value = items
+        else:
+            for convert in (int, float):
+                try:
+                    value = convert(value)
+                    break
+                except ValueError:
+                    pass
+        header[key] = value
+    return header
+
+
+class M3Cube(object):
+    """
+    A memory mapped Moon Mineralogy Mapper (or other ENVI style) image cube.
+    Nothing is read from the image until a window is requested.
+
+    Attributes
+    ----------
+    header : dict
+             The parsed .hdr file
+
+    wavelengths : ndarray
+                  The wavelength of each band
+
+    shape : tuple
+            (lines, samples, bands)
+
+    data : ndarray
+           A (line, sample, band) ordered, read only view of the memory mapped image.
+           Indexing it reads only the requested window.
+    """
+
+    def __init__(self, input_data):
+        """
+        Parameters
+        ----------
+        input_data : str
+                     PATH to the .img or the .hdr of the cube
+        """
+        self.hdr_file, self.img_file = _pair_files(input_data)
+        self.header = header = read_envi_header(self.hdr_file)
+        lines, samples, bands = header['lines'], header['samples'], header['bands']
+        self.shape = (lines, samples, bands)
+
+        byteorder = '>' if header.get('byte order', 0) == 1 else '<'
+        self.dtype = np.dtype(byteorder + ENVI_DTYPES[header.get('data type', 4)])
+        self.interleave = header.get('interleave', 'bsq').lower()
+        axes = ENVI_INTERLEAVE_AXES[self.interleave]
+        sizes = {'lines': lines, 'samples': samples, 'bands': bands}
+        self._memmap = np.memmap(self.img_file, dtype=self.dtype, mode='r', offset=header.get('header offset', 0),
+                                 shape=tuple(sizes[a] for a in axes))
+        self.data = self._memmap.transpose([axes.index(a) for a in ('lines', 'samples', 'bands')])
+
+        if 'wavelength' in header:
+            self.wavelengths = np.asarray(header['wavelength'], dtype=np.float64)
+        else:
+            self.wavelengths = np.arange(1, bands + 1, dtype=np.float64)
+
+    def __getitem__(self, key):
+        """
+        Read a (line, sample, band) window into memory, e.g. cube[100:200, :, 10:20]
+        """
+        return np.array(self.data[key])
+
+    def read(self, lines=slice(None), samples=slice(None), bands=slice(None)):
+        """
+        Read a window of the cube into memory
+
+        Parameters
+        ----------
+        lines, samples, bands : slice
+                                The window along each axis
+
+        Returns
+        -------
+        arr : ndarray
+              The window, in (line, sample, band) order
+        """
+        return self[lines, samples, bands]
+
+    def spectrum(self, line, sample):
+        """
+        Return the spectrum of one pixel as a Series indexed by wavelength
+        """
+        return pd.Series(np.array(self.data[line, sample]), index=self.wavelengths)
+
+    def spectra(self, lines, samples):
+        """
+        Return the spectra of many pixels
+
+        Parameters
+        ----------
+        lines, samples : array_like
+                         The line and sample of each pixel
+
+        Returns
+        -------
+        arr : ndarray
+              (npixels, bands) array, in the order of the pixels given
+        """
+        lines = np.asarray(lines)
+        samples = np.asarray(samples)
+        out = np.empty((len(lines), self.shape[2]), dtype=self.dtype.newbyteorder('='))
+        # read the pixels line by line, so that each line of the file is touched once
+        order = np.argsort(lines, kind='mergesort')
+        for line in np.unique(lines):
+            idx = order[lines[order] == line]
+            out[idx] = self.data[line][samples[idx]]
+        return out
+
+    def iter_blocks(self, max_bytes=2 ** 26):
+        """
+        Iterate over the cube in blocks of whole lines
+
+        Parameters
+        ----------
+        max_bytes : int
+                    The maximum size of each block in memory. At least one line
+                    is read at a time.
+
+        Yields
+        ------
+        start : int
+                The first line of the block
+
+        block : ndarray
+                (lines, samples, bands) array of the block
+        """
+        lines, samples, bands = self.shape
+        step = max(1, int(max_bytes // (samples * bands * self.dtype.itemsize)))
+        for start in range(0, lines, step):
+            yield start, self[start:start + step]
+
 
 def openm3(input_data):
     if input_data.split('.')[-1] == 'hdr':
@@ -14,12 +200,21 @@ def openm3(input_data):
 
 
 def metadatatoband(metadata):
+    # The GDAL metadata has one entry per band, e.g. {'Band_1': '540.84'} or {'Band_1': 'Band 1 (540.84)'}.
+    # Return the wavelengths in band order, skipping entries that aren't band wavelengths.
     wv2band = []
-    for k, v in metadata.iteritems():
+    for k, v in metadata.items():
+        try:
+            band = int(k.split('_')[-1])
+        except ValueError:
+            continue
         try:
-            wv2band.append(float(value))
-        except:
-            v = v.split(" ")[-1].split("(")[1].split(")")[0]
-            wv2band.append(float(v))
-    wv2band.sort(key=int)
-    return np.asarray(wv2band)
+            wv2band.append((band, float(v)))
+        except ValueError:
+            try:
+                v = v.split(" ")[-1].split("(")[1].split(")")[0]
+                wv2band.append((band, float(v)))
+            except (IndexError, ValueError):
+                continue
+    wv2band.sort()
+    return np.asarray([wv for band, wv in wv2band])
@@ -26,3 +26,72 @@ def getspectra(x, y, ds):
     mergedref[4] = (reflectance[4] + reflectance[5]) / 2
     mergedref[5:] = reflectance[6:]
     return mergedref
+
+
+def merge_bands(reflectance):
+    """
+    Merge bands 5 and 6 (which cover the same wavelength) by averaging them
+
+    Parameters
+    ----------
+    reflectance : ndarray
+                  (..., nbands) array
+
+    Returns
+    -------
+    mergedref : ndarray
+                (..., nbands - 1) array
+    """
+    merged = (reflectance[..., 4] + reflectance[..., 5]) / 2
+    return np.concatenate([reflectance[..., :4], merged[..., np.newaxis], reflectance[..., 6:]], axis=-1)
+
+
+def getspectra_many(coords, ds):
+    """
+    Extract the spectra of many pixels, reading each raster block that
+    contains a requested pixel once per band. Raises a ValueError if any of
+    the pixels are outside the raster.
+
+    Parameters
+    ----------
+    coords : array_like
+             (n_points, 2) array of (x, y) pixel coordinates, with the same
+             meaning as the x and y arguments of getspectra (x is the line
+             and y is the sample)
+
+    ds : object
+         The GDAL dataset
+
+    Returns
+    -------
+    mergedref : ndarray
+                (n_points, nbands - 1) array of the spectra, with bands 5 and 6 merged
+    """
+    coords = np.asarray(coords, dtype=int).reshape(-1, 2)
+    lines, samples = coords[:, 0], coords[:, 1]
+    outside = (lines < 0) | (lines >= ds.RasterYSize) | (samples < 0) | (samples >= ds.RasterXSize)
+    if outside.any():
+        raise ValueError('{} of the coordinates are outside the {} x {} raster, the first is {}'.format(
+            outside.sum(), ds.RasterYSize, ds.RasterXSize, tuple(coords[outside][0])))
+    nbands = ds.RasterCount
+    reflectance = np.empty((len(coords), nbands))
+
+    # group the points by the raster block they fall in
+    block_samples, block_lines = ds.GetRasterBand(1).GetBlockSize()
+    nblock_samples = (ds.RasterXSize + block_samples - 1) // block_samples
+    blockid = (lines // block_lines) * nblock_samples + samples // block_samples
+    order = np.argsort(blockid, kind='mergesort')
+    blocks, starts = np.unique(blockid[order], return_index=True)
+    groups = np.split(order, starts[1:])
+
+    for b in range(1, nbands + 1):
+        band = ds.GetRasterBand(b)
+        for block, idx in zip(blocks, groups):
+            xoff = (block % nblock_samples) * block_samples
+            yoff = (block // nblock_samples) * block_lines
+            xsize = min(block_samples, ds.RasterXSize - xoff)
+            ysize = min(block_lines, ds.RasterYSize - yoff)
+            arr = band.ReadAsArray(int(xoff), int(yoff), int(xsize), int(ysize))
+            reflectance[idx, b - 1] = arr[lines[idx] - yoff, samples[idx] - xoff]
+
+    return merge_bands(reflectance)
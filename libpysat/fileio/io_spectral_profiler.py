@@ -1,9 +1,118 @@
+import os
+import re
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 import pvl
 
+from libpysat.fileio.ingest_cache import IngestCache
+from libpysat.fileio.utils import file_search, label_statements, read_label_text
 from libpysat.spectral.spectra import Spectra
-from libpysat.utils.utils import find_in_dict
+from libpysat.spectral.spectral_data import spectral_data
+from libpysat.utils.utils import effective_n_jobs
+
+# The products (image objects) that can be in an SP file, in the order they are read
+SP_PRODUCTS = ['WAV', 'RAW', 'REF', 'REF1', 'REF2', 'DAR', 'QA']
+
+
+def _label_value(value):
+    # Convert a label value to an int, float or string, dropping any units
+    value = re.sub(r'<[^>]*>', '', value).strip().strip('"')
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_sp_label(text):
+    """
+    Parse the parts of a Spectral Profiler label needed to read the file into
+    a flat index
+
+    Parameters
+    ----------
+    text : str
+           The label text
+
+    Returns
+    -------
+    index : dict
+            'pointers' maps each object name (without the ^) to its start
+            byte, and 'objects' maps each top level object name to a dict of
+            its keywords. Nested COLUMN objects are collected, in order, in a
+            list under the 'COLUMN' key of their parent.
+    """
+    index = {'pointers': {}, 'objects': {}}
+    stack = []  # the dicts of the objects we are inside
+    for key, value in label_statements(text):
+        if key.startswith('^'):
+            index['pointers'][key[1:]] = _label_value(value)
+        elif key == 'OBJECT':
+            if stack:
+                obj = {}
+                stack[-1].setdefault(value, []).append(obj)
+            else:
+                obj = index['objects'].setdefault(value, {})
+            stack.append(obj)
+        elif key == 'END_OBJECT':
+            if stack:
+                stack.pop()
+        elif stack:
+            stack[-1][key] = _label_value(value)
+    return index
+
+
+def read_sp_label(input_data, cache=None):
+    """
+    Read the label of a Spectral Profiler file, see parse_sp_label. Only the
+    label at the start of the file is read.
+
+    Parameters
+    ----------
+    input_data : str
+                 The PATH to the .spc file
+
+    cache : IngestCache
+            If given, labels of files that have not changed are read from
+            the cache and newly parsed labels are added to it
+
+    Returns
+    -------
+    index : dict
+    """
+    key = 'sp_label|{}'.format(os.path.abspath(input_data))
+    if cache is not None:
+        index = cache.get(key, [input_data])
+        if index is not None:
+            return index
+    index = parse_sp_label(read_label_text(input_data))
+    if cache is not None:
+        cache.put(key, [input_data], index)
+    return index
+
+
+class _ObservationSpectra(Mapping):
+    # A read only dict of observation id -> Spectra, where each Spectra is built the first time it is accessed
+    def __init__(self, profiler):
+        self._profiler = profiler
+        self._spectra = {}
+
+    def __getitem__(self, i):
+        if i not in self._spectra:
+            if not 0 <= i < self._profiler.nobs:
+                raise KeyError(i)
+            self._spectra[i] = self._profiler.observation(i)
+        return self._spectra[i]
+
+    def __iter__(self):
+        return iter(range(self._profiler.nobs))
+
+    def __len__(self):
+        return self._profiler.nobs
 
 
 # TODO: The spectra should inhert from a SpectraABC, monkey patch smoothing in.
@@ -12,20 +121,35 @@ class Spectral_Profiler(object):
     Attributes
     ----------
 
-    spectra : dict
-              A dictionary with k as the integer observation id and value
-              as a pandas DataFrame.
+    spectra : Mapping
+              A read only dictionary with k as the integer observation id and value
+              as a Spectra object. Each Spectra is built when it is first accessed.
 
     ancillary_data : dataframe
                      A pandas DataFrame of the parsed ancillary data (PVL label)
 
     label : object
-            The raw PVL label object
+            The raw PVL label object, parsed on first access
+
+    label_index : dict
+                  The parts of the label used to read the file, see parse_sp_label
+
+    products : list
+               The names of the products in the file, other than WAV, in
+               the order of the last axis of data
+
+    wavelengths : Series
+                  The wavelength of each band
+
+    nobs : int
+           The number of observations
     """
 
-    def __init__(self, input_data, cleaned=True, qa_threshold=2000):
+    def __init__(self, input_data, cleaned=True, qa_threshold=2000, cache_dir=None, label_index=None):
         """
-        Read the .spc file, parse the label, and extract the spectra
+        Read the .spc file and parse the label. Only the parts of the label
+        needed to read the data are parsed, the spectra are memory mapped
+        and only scaled when they are used.
 
         Parameters
         ----------
@@ -35,89 +159,257 @@ class Spectral_Profiler(object):
 
         cleaned : boolean
                   If True, mask the data based on the QA array.
+
+        qa_threshold : int
+                       Bands with a QA value at or above this are masked
+
+        cache_dir : str
+                    If given, the parsed label is cached in an IngestCache
+                    in this directory and reused while the file is unchanged
+
+        label_index : dict
+                      An already parsed label (see read_sp_label), in which
+                      case the label is not read again
         """
 
         label_dtype_map = {'IEEE_REAL': 'f',
                            'MSB_INTEGER': 'i',
                            'MSB_UNSIGNED_INTEGER': 'u'}
 
-        label = pvl.load(input_data)
-        self.label = label
+        self.input_data = input_data
+        if label_index is not None:
+            self.label_index = label_index
+        elif cache_dir is not None:
+            cache = IngestCache(cache_dir)
+            self.label_index = read_sp_label(input_data, cache)
+            cache.save()
+        else:
+            self.label_index = read_sp_label(input_data)
+        self._label = None
+        self.cleaned = cleaned
+        self.qa_threshold = qa_threshold
+        pointers = self.label_index['pointers']
+        objects = self.label_index['objects']
+
+        # Extract and handle the ancillary data
+        ancillary_data = objects['ANCILLARY_AND_SUPPLEMENT_DATA']
+        nrows = ancillary_data['ROWS']
+        ncols = ancillary_data['COLUMNS']
+
+        columns = []
+        bytelengths = []
+        datatypes = []
+        for entry in ancillary_data.get('COLUMN', []):
+            # Level 2B2 PVL has entries with 0 bytes, e.g. omitted.
+            if entry['BYTES'] > 0:
+                columns.append(str(entry['NAME']))
+                datatypes.append(label_dtype_map[entry['DATA_TYPE']])
+                bytelengths.append(entry['BYTES'])
+            else:
+                ncols -= 1
+        strbytes = map(str, bytelengths)
+        rowdtype = list(zip(columns, map(''.join, zip(['>'] * ncols, datatypes, strbytes))))
         with open(input_data, 'rb') as indata:
-            # Extract and handle the ancillary data
-            ancillary_data = find_in_dict(label, "ANCILLARY_AND_SUPPLEMENT_DATA")
-            nrows = ancillary_data['ROWS']
-            ncols = ancillary_data['COLUMNS']
-            rowbytes = ancillary_data['ROW_BYTES']
-
-            columns = []
-            bytelengths = []
-            datatypes = []
-            ancillary_data_offset = find_in_dict(label, "^ANCILLARY_AND_SUPPLEMENT_DATA").value
-            indata.seek(ancillary_data_offset - 1)
-            for i in ancillary_data.items():
-                if i[0] == 'COLUMN':
-                    entry = i[1]
-                    # Level 2B2 PVL has entries with 0 bytes, e.g. omitted.
-                    if entry['BYTES'] > 0:
-                        columns.append(str(entry['NAME']))
-                        datatypes.append(label_dtype_map[entry['DATA_TYPE']])
-                        bytelengths.append(entry['BYTES'])
-                    else:
-                        ncols -= 1
-            strbytes = map(str, bytelengths)
-            rowdtype = list(zip(columns, map(''.join, zip(['>'] * ncols, datatypes, strbytes))))
-            d = np.fromstring(indata.read(rowbytes * nrows), dtype=rowdtype,
-                              count=nrows)
-            self.ancillary_data = pd.DataFrame(d, columns=columns,
-                                               index=np.arange(nrows))
-
-            assert (ncols == len(columns))
-
-            keys = []
-            array_offsets = []
-            for d in ['WAV', 'RAW', 'REF', 'REF1', 'REF2', 'DAR', 'QA']:
-                search_key = '^SP_SPECTRUM_{}'.format(d)
-                result = find_in_dict(label, search_key)
-                if result:
-                    array_offsets.append(result.value)
-                    keys.append('SP_SPECTRUM_{}'.format(d))
-
-            offsets = dict(zip(keys, array_offsets))
-
-            arrays = {}
-            for k, offset in offsets.items():
-                indata.seek(offset - 1)
-                newk = k.split('_')[-1]
-
-                d = find_in_dict(label, k)
-                unit = d['UNIT']
-                lines = d['LINES']
-                scaling_factor = d['SCALING_FACTOR']
-
-                arr = np.fromstring(indata.read(lines * 296 * 2), dtype='>H').astype(np.float64)
-                arr = arr.reshape(lines, -1)
-
-                # If the data is scaled, apply the scaling factor
-                if isinstance(scaling_factor, float):
-                    arr *= scaling_factor
-                arrays[newk] = arr
-
-            self.wavelengths = pd.Series(arrays['WAV'][0])
-
-            self.spectra = {}
-            for i in range(nrows):
-                self.spectra[i] = pd.DataFrame(index=self.wavelengths)
-                for k in keys:
-                    k = k.split('_')[-1]
-                    if k == 'WAV':
-                        continue
-                    self.spectra[i][k] = arrays[k][i]
-
-                if cleaned:
-                    self.spectra[i] = self.spectra[i][self.spectra[i]['QA'] < qa_threshold]
-
-                self.spectra[i] = Spectra(self.spectra[i])
+            indata.seek(pointers['ANCILLARY_AND_SUPPLEMENT_DATA'] - 1)
+            d = np.fromfile(indata, dtype=rowdtype, count=nrows)
+        self.ancillary_data = pd.DataFrame(d, columns=columns,
+                                           index=np.arange(nrows))
+
+        assert (ncols == len(columns))
+
+        self.nobs = nrows
+
+        # Memory map each product, the scaling factors are applied when the data are used
+        self._arrays = {}
+        self._scaling = {}
+        for k in SP_PRODUCTS:
+            name = 'SP_SPECTRUM_{}'.format(k)
+            if name not in pointers:
+                continue
+            d = objects[name]
+            self._arrays[k] = np.memmap(input_data, dtype='>H', mode='r', offset=pointers[name] - 1,
+                                        shape=(d['LINES'], d['LINE_SAMPLES']))
+            self._scaling[k] = d['SCALING_FACTOR']
+        self.products = [k for k in SP_PRODUCTS if k in self._arrays and k != 'WAV']
+
+        self.wavelengths = pd.Series(self.product('WAV')[0])
+        self.spectra = _ObservationSpectra(self)
+        self._data = None
+
+    @property
+    def label(self):
+        """
+        The full PVL label, parsed on first access
+        """
+        if self._label is None:
+            self._label = pvl.load(self.input_data)
+        return self._label
+
+    def product(self, name, obs=slice(None)):
+        """
+        Return the scaled values of one product
+
+        Parameters
+        ----------
+        name : str
+               The product, e.g. 'REF1' or 'QA'
+
+        obs : int or slice
+              The observation(s) to return, by default all of them
+
+        Returns
+        -------
+        arr : ndarray
+              (nobs, nwavelengths) float array, or (nwavelengths,) for a single observation
+        """
+        arr = self._arrays[name][obs].astype(np.float64)
+        # If the data is scaled, apply the scaling factor
+        if isinstance(self._scaling[name], float):
+            arr *= self._scaling[name]
+        return arr
+
+    @property
+    def data(self):
+        """
+        (nobs, nwavelengths, nproducts) array of the scaled data, with the
+        products in the order of the products attribute. Built on first access.
+        """
+        if self._data is None:
+            self._data = np.stack([self.product(k) for k in self.products], axis=2)
+        return self._data
+
+    @property
+    def qa_mask(self):
+        """
+        (nobs, nwavelengths) boolean array, True where the QA value is below
+        qa_threshold (i.e. the band is kept when the data are cleaned)
+        """
+        if 'QA' not in self._arrays:
+            return np.ones((self.nobs, len(self.wavelengths)), dtype=bool)
+        return self.product('QA') < self.qa_threshold
+
+    def observation(self, i):
+        """
+        Build the Spectra for one observation, with the wavelengths as the
+        index and one column per product. If cleaned is True, bands that fail
+        the QA test are dropped.
+        """
+        df = pd.DataFrame({k: self.product(k, i) for k in self.products}, index=self.wavelengths,
+                          columns=self.products)
+        if self.cleaned and 'QA' in self._arrays:
+            df = df[df['QA'].values < self.qa_threshold]
+        return Spectra(df)
+
+
+def _read_sp_file(args):
+    input_data, label_index, product, cleaned, qa_threshold = args
+    dataset = Spectral_Profiler(input_data, cleaned=cleaned, qa_threshold=qa_threshold, label_index=label_index)
+    spectra = dataset.product(product)
+    qa_mask = dataset.qa_mask
+    if cleaned:
+        spectra[~qa_mask] = np.nan
+    ancillary = dataset.ancillary_data
+    ancillary['QA_GOOD_BANDS'] = qa_mask.sum(axis=1)
+    return dataset.wavelengths.values, spectra, ancillary
+
+
+def _resample(wavelengths, spectra, new_wavelengths):
+    # Linearly interpolate each spectrum onto new_wavelengths, ignoring masked (NaN) bands.
+    # SP wavelengths are not monotonic (the detectors overlap), so sort them first.
+    order = np.argsort(wavelengths)
+    wavelengths = wavelengths[order]
+    resampled = np.full((spectra.shape[0], len(new_wavelengths)), np.nan)
+    for i, spectrum in enumerate(spectra[:, order]):
+        valid = np.isfinite(spectrum)
+        if valid.any():
+            resampled[i] = np.interp(new_wavelengths, wavelengths[valid], spectrum[valid], left=np.nan, right=np.nan)
+    return resampled
+
+
+def sp_batch(directory, searchstring='*.spc', product='REF1', wavelengths=None, cleaned=True, qa_threshold=2000,
+             n_jobs=1, cache_dir=None, outpath=None):
+    """
+    Read a directory of Spectral Profiler files into a single spectral_data
+    object, with every observation on a common wavelength axis
+
+    Parameters
+    ----------
+    directory : str
+                The directory to (recursively) search for .spc files
+
+    searchstring : str
+                   The pattern the file names must match
+
+    product : str
+              The product to read the spectra from, e.g. 'REF1', 'REF2' or 'RAW'
+
+    wavelengths : array_like
+                  The common wavelength axis. By default the wavelengths of the
+                  first file are used. Spectra from files with different
+                  wavelengths are linearly interpolated onto this axis.
+
+    cleaned : boolean
+              If True, bands with a QA value at or above qa_threshold are set to NaN
+
+    qa_threshold : int
+                   See Spectral_Profiler
+
+    n_jobs : int
+             The number of worker processes used to read files, see
+             libpysat.utils.utils.effective_n_jobs
+
+    cache_dir : str
+                If given, the file labels are cached in an IngestCache in this directory
+
+    outpath : str
+              If given, the combined data are also written to this directory with
+              spectral_data.save, so that they can be memory mapped with spectral_data.load
+
+    Returns
+    -------
+    data : spectral_data
+           One row per observation. The spectra are in the 'wvl' columns, and the
+           ancillary data of each observation (plus the file name, the observation
+           number within the file and the number of bands that passed the QA test)
+           are in the 'meta' columns.
+    """
+    filelist = np.sort(file_search(directory, searchstring))
+    # the labels are read (or fetched from the cache) here so that the workers don't need to share the cache
+    cache = IngestCache(cache_dir) if cache_dir is not None else None
+    labels = [read_sp_label(f, cache) for f in filelist]
+    if cache is not None:
+        cache.save()
+    tasks = [(f, label, product, cleaned, qa_threshold) for f, label in zip(filelist, labels)]
+
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_read_sp_file, tasks, chunksize=max(1, len(tasks) // (n_jobs * 4))))
+    else:
+        results = [_read_sp_file(t) for t in tasks]
+
+    if wavelengths is None:
+        wavelengths = results[0][0] if results else np.array([])
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+
+    spectra = np.empty((sum(r[1].shape[0] for r in results), len(wavelengths)))
+    ancillary = []
+    row = 0
+    for f, (wvl, file_spectra, file_ancillary) in zip(filelist, results):
+        if wvl.shape != wavelengths.shape or not np.allclose(wvl, wavelengths):
+            file_spectra = _resample(wvl, file_spectra, wavelengths)
+        spectra[row:row + file_spectra.shape[0]] = file_spectra
+        row += file_spectra.shape[0]
+        file_ancillary.insert(0, 'FILE', os.path.basename(f))
+        file_ancillary.insert(1, 'OBSERVATION', np.arange(file_spectra.shape[0]))
+        ancillary.append(file_ancillary)
+
+    metadata = pd.concat(ancillary, ignore_index=True) if ancillary else pd.DataFrame()
+    metadata.columns = pd.MultiIndex.from_arrays([['meta'] * len(metadata.columns), metadata.columns])
+    data = spectral_data.from_arrays(spectra, wavelengths.round(4), metadata)
+    if outpath is not None:
+        data.save(outpath)
+    return data
 
 
 """
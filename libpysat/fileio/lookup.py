@@ -4,30 +4,144 @@ Created on Mon Nov 30 09:51:51 2015
 
 @author: rbanderson
 
-This function uses the pandas merge ability to look up metadata for an existing dataframe in a csv file
+This function looks up metadata for an existing dataframe in a csv file
 If lookupfile is a list, then each file will be read and concatenated together. Alternatively, a dataframe can be provided directly.
 The default settings are for looking up ChemCam CCS csv data in the ChemCam master list files, matching on sclock value
+
+The master lists are parsed once per process (and optionally stored in an IngestCache) and sorted on their key column,
+so that matching rows are found with a binary search rather than a full merge.
 """
+import os
+from collections import OrderedDict
+
+import numpy as np
 import pandas as pd
-def lookup(df,lookupfile=None,lookupdf=None,sep=',',skiprows=1,left_on='sclock',right_on='Spacecraft Clock'):
-#TODO: automatically determine the number of rows to skip to handle ccam internal master list and PDS "official" master list formats
-    if lookupfile is not None:
-        # this loop concatenates together multiple lookup files if provided
+
+from libpysat.fileio.ingest_cache import IngestCache
+from libpysat.utils.utils import file_signature
+
+# parsed lookup tables, keyed on the files and read options, so that repeated calls in one process
+# (e.g. several ccam_batch runs, or each chunk of ccam_batch_iter) only read the files once.
+# Most recently used last; the master lists are large, so only a few are kept.
+_tables = OrderedDict()
+_MAX_TABLES = 4
+
+
+class LookupTable(object):
+    """
+    A lookup table with a sorted index on its key column
+
+    Attributes
+    ----------
+    df : DataFrame
+         The table, in its original row order
+
+    key : str
+          Name of the key column
+    """
+
+    def __init__(self, df, key):
+        self.df = df.reset_index(drop=True)
+        self.key = key
+        keys = self.df[key].values
+        # a stable sort, so that the first of any repeated keys is found
+        self._order = np.argsort(keys, kind='mergesort')
+        self._keys = keys[self._order]
+
+    def rows(self, values):
+        """
+        Return the position in df of the first row matching each value, or -1 if there is none
+        """
+        values = np.asarray(values)
+        if len(self._keys) == 0:
+            return np.full(len(values), -1, dtype=int)
+        pos = np.searchsorted(self._keys, values, side='left')
+        pos = np.minimum(pos, len(self._keys) - 1)
+        found = self._keys[pos] == values
+        return np.where(found, self._order[pos], -1)
+
+    def join(self, values):
+        """
+        Return the rows of the table matching values, in the same order. Values with no match give a row of NaNs.
+        """
+        return self.df.reindex(self.rows(values)).reset_index(drop=True)
+
+
+def read_lookup(lookupfile, sep=',', skiprows=1, key='Spacecraft Clock', cache_dir=None):
+    """
+    Read and index one or more lookup files, reusing the table from earlier calls if the files are unchanged
+
+    Parameters
+    ----------
+    lookupfile : list
+                 PATHs of the files to read and concatenate
+
+    sep : str
+          The field separator
+
+    skiprows : int
+               The number of rows to skip at the top of each file
+
+    key : str
+          The column to index the table on
+
+    cache_dir : str
+                If given, the parsed table is also stored in an IngestCache in this directory,
+                so that it is reused by later processes
+
+    Returns
+    -------
+    table : LookupTable
+    """
+    files = [os.path.abspath(x) for x in lookupfile]
+    signature = [file_signature(x) for x in files]
+    name = (tuple(files), sep, skiprows, key)
+    cached = _tables.pop(name, None)
+    if cached is not None and cached[0] == signature:
+        _tables[name] = cached
+        return cached[1]
+
+    cache = IngestCache(cache_dir) if cache_dir is not None else None
+    cache_key = 'lookup|{}|sep={}|skiprows={}'.format('|'.join(files), sep, skiprows)
+    lookupdf = cache.get(cache_key, files) if cache is not None else None
+    if lookupdf is None:
+        # concatenate together multiple lookup files if provided
         # (mostly to handle the three different master lists for chemcam)
-        for x in lookupfile:
-            try:
-                tmp = pd.read_csv(x, sep=sep, skiprows=skiprows, error_bad_lines=False)
-                lookupdf = pd.concat([lookupdf, tmp])
-            except:
-                lookupdf = pd.read_csv(x, sep=sep, skiprows=skiprows, error_bad_lines=False)
+        lookupdf = pd.concat([pd.read_csv(x, sep=sep, skiprows=skiprows, error_bad_lines=False) for x in files])
+        if cache is not None:
+            cache.put(cache_key, files, lookupdf)
+            cache.save()
+
+    table = LookupTable(lookupdf, key)
+    _tables[name] = (signature, table)
+    while len(_tables) > _MAX_TABLES:
+        _tables.popitem(last=False)
+    return table
+
+
+def lookup(df, lookupfile=None, lookupdf=None, sep=',', skiprows=1, left_on='sclock', right_on='Spacecraft Clock',
+           cache_dir=None):
+    # TODO: automatically determine the number of rows to skip to handle ccam internal master list and PDS "official" master list formats
+    if lookupfile is not None:
+        table = read_lookup(lookupfile, sep=sep, skiprows=skiprows, key=right_on, cache_dir=cache_dir)
+    else:
+        table = LookupTable(lookupdf, right_on)
     metadata = df['meta']
 
-    metadata = metadata.merge(lookupdf, left_on=left_on, right_on=right_on, how='left')
+    # if a key appears more than once in the lookup table, the first matching row is used
+    new = table.join(metadata[left_on].values)
+    if left_on == right_on:
+        new = new.drop(right_on, axis=1)
+
+    # columns in both frames are kept from each, with suffixes (as pandas merge does)
+    clash = [c for c in new.columns if c in metadata.columns]
+    if clash:
+        left = metadata[clash].reset_index(drop=True)
+        left.columns = [c + '_x' for c in clash]
+        new = pd.concat([left, new.rename(columns={c: c + '_y' for c in clash})], axis=1)
 
     # remove metadata columns that already exist in the data frame to avoid non-unique columns
-    meta_cols = set(metadata.columns.values)
-    meta_cols_keep = list(meta_cols - set(df['meta'].columns.values))
-    metadata = metadata[meta_cols_keep]
+    metadata = new[[c for c in new.columns if c not in set(df['meta'].columns.values)]]
 
     # make metadata into a multiindex
     metadata.columns = [['meta'] * len(metadata.columns), metadata.columns.values]
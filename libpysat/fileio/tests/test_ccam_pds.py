@@ -0,0 +1,100 @@
+import os
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from .. import io_ccam_pds
+from .. import io_utils
+
+
+def write_ccs(directory, sclock, version, nshots=3, extra_header=0, seed=0):
+    """
+    Write a small synthetic ChemCam CCS csv file and return its PATH.
+    extra_header adds the optional temperature / target name header rows.
+    """
+    rng = np.random.RandomState(seed)
+    name = 'CL5_{}CCS_F0030004CCAM01014P{}.csv'.format(sclock, version)
+    keys = ['Original Spectrum File', 'Distance (m)', 'Laser Energy', 'Spectrum Total', 'Total UV',
+            'Total VIO', 'Total VNIR', 'Max UV', 'Max VIO', 'Max VNIR', 'Continuum UV FLOAT',
+            'Continuum VIO FLOAT', 'Continuum VNIR FLOAT', 'Number of shots',
+            'Temperature', 'Target'][:14 + extra_header]
+    values = ['CL5_{}EDR_F0030004CCAM01014M1.DAT'.format(sclock), '2.65', '14', '1.9e+14', '5e13',
+              '4e13', '6e13', '100.5', '200.5', '300', '1.5', '2.5', '3.5', str(nshots),
+              '-10.5', 'Bathurst'][:14 + extra_header]
+    lines = ['# {} = {},'.format(k, v) for k, v in zip(keys, values)]
+    cols = ['wave'] + ['shot{}'.format(i + 1) for i in range(nshots)] + ['mean', 'median']
+    lines.append('# ' + ', '.join(cols))
+    spectra = rng.rand(50, nshots)
+    for wave, row in zip(np.linspace(240.811, 905.5, 50), spectra):
+        row = [wave] + list(row) + [row.mean(), np.median(row)]
+        lines.append(', '.join('{:.5f}'.format(v) for v in row))
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+
+class TestCCAMCSV(unittest.TestCase):
+    def setUp(self):
+        self.directory = io_utils.create_dir()
+
+    def tearDown(self):
+        io_utils.delete_dir(self.directory)
+
+    def test_header_length_detection(self):
+        for extra in range(3):
+            path = write_ccs(self.directory, '39873680{}'.format(extra), 1, extra_header=extra)
+            metadata, columns, data = io_ccam_pds.read_ccam_csv(path)
+            self.assertEqual(len(metadata), 14 + extra)
+            self.assertEqual(columns, ['wave', 'shot1', 'shot2', 'shot3', 'mean', 'median'])
+            self.assertEqual(data.shape, (50, 6))
+            self.assertIn('continuum uv', metadata)
+            self.assertAlmostEqual(data[0, 0], 240.811)
+
+    def test_ccam_csv(self):
+        path = write_ccs(self.directory, '398736801', 2, extra_header=2)
+        df = io_ccam_pds.CCAM_CSV(path)
+        self.assertEqual(list(df.index), ['mean'])
+        self.assertEqual(df['meta'].loc['mean', 'target'].strip(), 'Bathurst')
+        self.assertEqual(df[('meta', 'Pversion')].iloc[0], 'P2')
+
+        df = io_ccam_pds.CCAM_CSV(path, ave=False)
+        self.assertEqual(list(df.index), ['shot1', 'shot2', 'shot3'])
+        self.assertEqual(df['wvl'].shape, (3, 50))
+
+
+class TestCCAMBatch(unittest.TestCase):
+    def setUp(self):
+        self.directory = io_utils.create_dir()
+        write_ccs(self.directory, '398736801', 1)
+        write_ccs(self.directory, '398736801', 3, seed=1)
+        write_ccs(self.directory, '398736900', 2, extra_header=1, seed=2)
+        write_ccs(self.directory, '398737000', 1, extra_header=2, seed=3)
+
+    def tearDown(self):
+        io_utils.delete_dir(self.directory)
+
+    def test_latest_version_per_sclock(self):
+        data = io_ccam_pds.ccam_batch(self.directory)
+        self.assertEqual(len(data.df.index), 3)
+        self.assertEqual(list(data.df[('meta', 'Pversion')]), ['P3', 'P2', 'P1'])
+
+    def test_parallel_matches_serial(self):
+        for ave in (True, False):
+            serial = io_ccam_pds.ccam_batch(self.directory, ave=ave)
+            parallel = io_ccam_pds.ccam_batch(self.directory, ave=ave, n_jobs=2)
+            pd.testing.assert_frame_equal(serial.df, parallel.df)
+
+    def test_chunked_iterator(self):
+        combined = io_ccam_pds.ccam_batch(self.directory, ave=False)
+        chunks = list(io_ccam_pds.ccam_batch_iter(self.directory, ave=False, chunksize=4))
+        self.assertEqual([len(c.df.index) for c in chunks], [4, 4, 1])
+        streamed = pd.concat([c.df for c in chunks])
+        pd.testing.assert_frame_equal(streamed, combined.df)
+        sclocks = streamed[('meta', 'sclock')].values
+        self.assertTrue((np.diff(sclocks) >= 0).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import unittest
+
+import numpy as np
+
+from .. import io_edr
+from .. import io_utils
+
+
+def write_edr(path, nshots=3, sclock=398736801, seed=0, nchannels=6444):
+    """
+    Write a minimal synthetic ChemCam EDR file and return its spectra
+    """
+    rng = np.random.RandomState(seed)
+    record_bytes = 100
+    label = ['PDS_VERSION_ID = PDS3',
+             'RECORD_BYTES = {}'.format(record_bytes),
+             'LABEL_RECORDS = 30',
+             'SPACECRAFT_CLOCK_START_COUNT = "{}.123"'.format(sclock),
+             'SEQUENCE_ID = "CCAM01014"',
+             'INSTRUMENT_FOCUS_DISTANCE = 2650',
+             'INSTRUMENT_TEMPERATURE = (1.5 <degC>, 2.5 <degC>,',
+             '    -3.0 <degC>)',
+             'INSTRUMENT_TEMPERATURE_NAME = ("MU", "SH",',
+             '    "CCD")',
+             'OBJECT = CCAM_LIBS_TABLE',
+             '   OBJECT = CONTAINER',
+             '      NAME = "CCAM_LIBS_DATA_CONTAINER"',
+             '      REPETITIONS = {}'.format(nshots),
+             '      START_BYTE = 33',
+             '      OBJECT = COLUMN',
+             '         START_BYTE = 1',
+             '         ITEMS = {}'.format(nchannels),
+             '      END_OBJECT = COLUMN',
+             '   END_OBJECT = CONTAINER',
+             'END_OBJECT = CCAM_LIBS_TABLE',
+             'END']
+    header = ('\r\n'.join(label) + '\r\n').encode('ascii').ljust(30 * record_bytes, b' ')
+    spectra = rng.randint(0, 65535, size=(nshots, nchannels)).astype('>u2')
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(b'\x00' * 32)  # the LIBS header that precedes the spectra
+        f.write(spectra.tobytes())
+    return spectra
+
+
+class TestEDR(unittest.TestCase):
+    def setUp(self):
+        self.directory = io_utils.create_dir()
+        self.path = os.path.join(self.directory, 'cl5_398736801edr_f0030004ccam01014m1.dat')
+        self.spectra = write_edr(self.path)
+
+    def tearDown(self):
+        io_utils.delete_dir(self.directory)
+
+    def test_read_edr(self):
+        for mmap in (False, True):
+            spectra, label = io_edr.read_edr(self.path, mmap=mmap)
+            np.testing.assert_array_equal(spectra, self.spectra)
+        self.assertEqual(label['sclock'], 398736801)
+        self.assertEqual(label['seqid'], 'CCAM01014')
+        self.assertEqual(label['temps'], [('MU', 1.5), ('SH', 2.5), ('CCD', -3.0)])
+
+    def test_edr_frame(self):
+        df = io_edr.EDR(self.path)
+        np.testing.assert_array_equal(df['channel'].values, self.spectra)
+        self.assertEqual(list(df[('meta', 'Shot')]), [1, 2, 3])
+        self.assertEqual(df[('meta', 'CCD_temp')].iloc[0], -3.0)
+        self.assertFalse(os.path.exists('test.csv'))
+
+    def test_edr_batch(self):
+        second = write_edr(os.path.join(self.directory, 'cl5_398736900edr_f0030004ccam01014m1.dat'),
+                           nshots=5, sclock=398736900, seed=1)
+        spectra, metadata = io_edr.edr_batch(self.directory, n_jobs=2)
+        self.assertEqual(spectra.shape, (2, 5, 6444))
+        np.testing.assert_array_equal(spectra[0, :3], self.spectra)
+        np.testing.assert_array_equal(spectra[0, 3:], 0)
+        np.testing.assert_array_equal(spectra[1], second)
+        self.assertEqual(list(metadata['file_index']), [0] * 3 + [1] * 5)
+        self.assertEqual(spectra.dtype, np.uint16)
+
+    def test_edr_batch_empty(self):
+        spectra, metadata = io_edr.edr_batch(self.directory, searchstring='*.none')
+        self.assertEqual(spectra.shape, (0, 0, 6444))
+        self.assertEqual(spectra.dtype, np.uint16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import unittest
+
+import pandas as pd
+
+from .. import io_ccam_pds
+from .. import io_utils
+from ..ingest_cache import IngestCache
+from .test_ccam_pds import write_ccs
+from .test_lookup import write_master_list
+
+
+class TestIngestCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = io_utils.create_dir()
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        self.source = os.path.join(self.directory, 'source.txt')
+        with open(self.source, 'w') as f:
+            f.write('a')
+
+    def tearDown(self):
+        io_utils.delete_dir(self.directory)
+
+    def test_round_trip(self):
+        cache = IngestCache(self.cache_dir)
+        self.assertIsNone(cache.get('key', [self.source]))
+        frame = pd.DataFrame({'a': [1.0, 2.0]})
+        cache.put('key', [self.source], frame, sclock='398736801')
+        cache.save()
+
+        cache = IngestCache(self.cache_dir)
+        pd.testing.assert_frame_equal(cache.get('key', [self.source]), frame)
+        self.assertEqual(cache.manifest['key']['sclock'], '398736801')
+
+    def test_invalidated_by_change(self):
+        cache = IngestCache(self.cache_dir)
+        cache.put('key', [self.source], pd.DataFrame({'a': [1.0]}))
+        with open(self.source, 'w') as f:
+            f.write('changed')
+        self.assertIsNone(cache.get('key', [self.source]))
+
+    def test_save_drops_stale_entries(self):
+        other = os.path.join(self.directory, 'other.txt')
+        with open(other, 'w') as f:
+            f.write('b')
+        cache = IngestCache(self.cache_dir)
+        cache.put('changed', [self.source], pd.DataFrame({'a': [1.0]}))
+        cache.put('deleted', [other], pd.DataFrame({'a': [2.0]}))
+        cache.put('kept', [self.source], pd.DataFrame({'a': [3.0]}))
+        cache.save()
+        stores = {key: os.path.join(self.cache_dir, entry['store']) for key, entry in cache.manifest.items()}
+
+        os.remove(other)
+        with open(self.source, 'w') as f:
+            f.write('changed')
+        cache = IngestCache(self.cache_dir)
+        cache.put('kept', [self.source], pd.DataFrame({'a': [4.0]}))
+        cache.save()
+
+        cache = IngestCache(self.cache_dir)
+        cache.save()  # unchanged entries are kept across sessions
+        self.assertEqual(list(IngestCache(self.cache_dir).manifest), ['kept'])
+        self.assertFalse(os.path.exists(stores['changed']))
+        self.assertFalse(os.path.exists(stores['deleted']))
+        self.assertTrue(os.path.exists(stores['kept']))
+
+    def test_save_merges_entries_on_disk(self):
+        first = IngestCache(self.cache_dir)
+        other = IngestCache(self.cache_dir)
+        other.put('other', [self.source], pd.DataFrame({'a': [1.0]}))
+        other.save()
+        first.put('first', [self.source], pd.DataFrame({'a': [2.0]}))
+        first.save()
+        self.assertEqual(sorted(IngestCache(self.cache_dir).manifest), ['first', 'other'])
+
+
+class TestCCAMBatchCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = io_utils.create_dir()
+        self.cache_dir = io_utils.create_dir()
+        write_ccs(self.directory, '398736801', 1)
+        write_ccs(self.directory, '398736900', 2, seed=2)
+
+    def tearDown(self):
+        io_utils.delete_dir(self.directory)
+        io_utils.delete_dir(self.cache_dir)
+
+    def test_only_new_files_parsed(self):
+        first = io_ccam_pds.ccam_batch(self.directory, cache_dir=self.cache_dir)
+        self.assertEqual(len(IngestCache(self.cache_dir).manifest), 2)
+
+        # a new sol arrives and one file is reprocessed
+        write_ccs(self.directory, '398737000', 1, seed=3)
+        write_ccs(self.directory, '398736900', 2, nshots=4, seed=4)
+        parsed = []
+        original = io_ccam_pds._read_ccam_file
+
+        def tracking_reader(args):
+            parsed.append(os.path.basename(args[0]))
+            return original(args)
+
+        io_ccam_pds._read_ccam_file = tracking_reader
+        try:
+            second = io_ccam_pds.ccam_batch(self.directory, cache_dir=self.cache_dir)
+        finally:
+            io_ccam_pds._read_ccam_file = original
+
+        self.assertEqual(sorted(parsed), ['CL5_398736900CCS_F0030004CCAM01014P2.csv',
+                                          'CL5_398737000CCS_F0030004CCAM01014P1.csv'])
+        self.assertEqual(len(second.df.index), 3)
+        pd.testing.assert_frame_equal(second.df.iloc[:1], first.df.iloc[:1])
+        fresh = io_ccam_pds.ccam_batch(self.directory)
+        pd.testing.assert_frame_equal(second.df, fresh.df)
+
+    def test_iterator_keeps_lookup_entry(self):
+        lookupfile = os.path.join(self.cache_dir, 'master.csv')
+        write_master_list(lookupfile, [398736801, 398736900])
+        chunks = list(io_ccam_pds.ccam_batch_iter(self.directory, lookupfile=lookupfile,
+                                                  cache_dir=self.cache_dir, chunksize=1))
+        self.assertEqual(len(chunks), 2)
+        keys = list(IngestCache(self.cache_dir).manifest)
+        self.assertEqual(len(keys), 3)
+        self.assertEqual(len([k for k in keys if k.startswith('lookup|')]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from .. import io_jsc
+from .. import io_utils
+
+
+def write_luts(directory):
+    """
+    Write a set of small lookup tables and return the LUT_files dict
+    """
+    rng = np.random.RandomState(0)
+    files = {k: os.path.join(directory, k + '.csv') for k in ['ID', 'sample', 'laser', 'exp', 'spect']}
+    pd.DataFrame({'Sample ID': ['BHVO2', 'GBW07105', 'DUP']},
+                 index=pd.Index(['L1', 'L2', 'L3'], name='LIBS ID')).to_csv(files['ID'])
+    sample = pd.DataFrame(rng.rand(5, len(io_jsc.JSC_COMP_COLS)), columns=io_jsc.JSC_COMP_COLS,
+                          index=pd.Index(['BHVO2', 'GBW07105', 'DUP', 'Unknown', 'DUP'], name='Sample ID'))
+    sample.insert(0, 'Mineral', ['basalt', 'rock', 'x', 'unknown', 'y'])
+    sample.to_csv(files['sample'])
+    pd.DataFrame({'Laser': ['Quantel', 'Big Sky'], 'Wavelength': [1064, 1064]},
+                 index=pd.Index(['F', 'G'], name='ID')).to_csv(files['laser'])
+    pd.DataFrame({'Delay': [0.0, 1.0], 'Gate': [1000.0, 2000.0]},
+                 index=pd.Index(['E1', 'E2'], name='ID')).to_csv(files['exp'])
+    pd.DataFrame({'Model': ['a', 'b'], 'Range': ['UV', 'VIS']},
+                 index=pd.Index(['UV', 'VIS'], name='ID')).to_csv(files['spect'])
+    return files
+
+
+def write_jsc(directory, name, wvls, times, seed=0):
+    """
+    Write a synthetic JSC spectrometer file and return its spectra
+    """
+    rng = np.random.RandomState(seed)
+    spectra = rng.rand(len(times), len(wvls)).round(5)
+    with open(os.path.join(directory, name), 'w') as f:
+        f.write('header\n' * 14)
+        f.write('\t'.join(['Time', 'Time2'] + ['{:.4f}'.format(w) for w in wvls]) + '\n')
+        for (t1, t2), row in zip(times, spectra):
+            f.write('\t'.join([str(t1), str(t2)] + ['{:.5f}'.format(v) for v in row]) + '\n')
+    return spectra
+
+
+class TestFilenameParse(unittest.TestCase):
+    def setUp(self):
+        self.directory = io_utils.create_dir()
+        self.refdata = io_jsc.read_refdata(write_luts(self.directory))
+
+    def tearDown(self):
+        io_utils.delete_dir(self.directory)
+
+    def test_known_sample(self):
+        info = io_jsc.jsc_filename_parse('L1_3_USGS_A7_F100_E1_UV_x_1.txt', self.refdata)
+        self.assertEqual(list(info.columns),
+                         ['Mineral'] + io_jsc.JSC_COMP_COLS + ['Sample ID', 'LIBS ID', 'loc', 'lab', 'gas',
+                          'pressure', 'Laser Identifier', 'Laser', 'Wavelength', 'laser_power',
+                          'Exp Identifier', 'Delay', 'Gate', 'spectrometer', 'Spectrometer Identifier',
+                          'Model', 'Range'])
+        row = info.iloc[0]
+        self.assertEqual(row['Sample ID'], 'BHVO2')
+        self.assertEqual(row['loc'], 3)
+        self.assertEqual(row['pressure'], 7.0)
+        self.assertEqual(row['laser_power'], 100.0)
+        self.assertEqual(row['Laser'], 'Quantel')
+
+    def test_unknown_and_duplicate_samples(self):
+        info = io_jsc.jsc_filename_parse('L9_2_USGS_A7_F100_E1_UV_x_1.txt', self.refdata)
+        self.assertEqual(info['Sample ID'].iloc[0], 'Unknown')
+        self.assertEqual(info['Mineral'].iloc[0], 'unknown')
+
+        info = io_jsc.jsc_filename_parse('L3_1_USGS_V0.5_Z50_E9_IR_x_2.txt', self.refdata)
+        self.assertEqual(info['Sample ID'].iloc[0], 'DUP')
+        self.assertEqual(info['Mineral'].iloc[0], 'unknown')
+        self.assertNotIn('Laser Identifier', info.columns)
+        self.assertNotIn('Spectrometer Identifier', info.columns)
+
+    def test_memoized_rows_take_file_values(self):
+        compiled = io_jsc.compile_refdata(self.refdata)
+        first = io_jsc.jsc_filename_parse('L1_3_USGS_A7_F100_E1_UV_x_1.txt', compiled)
+        second = io_jsc.jsc_filename_parse('L1_4_JSC_V0.5_F50_E1_UV_x_2.txt', compiled)
+        self.assertEqual(len(compiled.memo), 1)
+        self.assertEqual(first['loc'].iloc[0], 3)
+        self.assertEqual(second['loc'].iloc[0], 4)
+        self.assertEqual(second['lab'].iloc[0], 'JSC')
+        self.assertEqual(second['laser_power'].iloc[0], 50.0)
+
+    def test_compiled_refdata(self):
+        name = 'L1_3_USGS_A7_F100_E1_UV_x_1.txt'
+        compiled = io_jsc.compile_refdata(self.refdata)
+        pd.testing.assert_frame_equal(io_jsc.jsc_filename_parse(name, compiled),
+                                      io_jsc.jsc_filename_parse(name, self.refdata))
+        self.assertEqual(len(compiled.memo), 1)
+        # the tables passed in are left as they were read
+        self.assertEqual(sorted(self.refdata), ['ID', 'exp', 'laser', 'sample', 'spect'])
+
+
+class TestJSCBatch(unittest.TestCase):
+    def setUp(self):
+        self.directory = io_utils.create_dir()
+        self.lut_dir = io_utils.create_dir()
+        self.LUT_files = write_luts(self.lut_dir)
+        self.uv = np.linspace(240, 340, 8)
+        self.vis = np.linspace(380, 470, 6)
+        times = [(i, 100 + i) for i in range(4)]
+        self.spectra = {}
+        for ID, loc in [('L1', 1), ('L1', 2), ('L2', 1)]:
+            seed = len(self.spectra)
+            uv = write_jsc(self.directory, '{}_{}_USGS_A7_F100_E1_UV_x_1.txt'.format(ID, loc), self.uv, times, seed)
+            # the VIS file lists the shots in a different order and is missing the first one
+            vis = write_jsc(self.directory, '{}_{}_USGS_A7_F100_E1_VIS_x_1.txt'.format(ID, loc), self.vis,
+                            times[:0:-1], seed + 10)
+            self.spectra[(ID, loc)] = np.hstack([uv[1:], vis[::-1]])
+
+    def tearDown(self):
+        io_utils.delete_dir(self.directory)
+        io_utils.delete_dir(self.lut_dir)
+
+    def test_spectrometers_joined_on_time(self):
+        data = io_jsc.JSC(sorted(io_jsc.file_search(self.directory, 'L1_2_*')),
+                          io_jsc.read_refdata(self.LUT_files))
+        self.assertEqual(list(data[('meta', 'time1')]), [1, 2, 3])
+        np.testing.assert_array_almost_equal(data['wvl'].values, self.spectra[('L1', 2)])
+        np.testing.assert_array_almost_equal(data['wvl'].columns.values, np.hstack([self.uv, self.vis]).round(4))
+        self.assertEqual(data[('meta', 'loc')].iloc[0], 2)
+
+    def test_parallel_matches_serial(self):
+        serial = io_jsc.jsc_batch(self.directory, self.LUT_files)
+        parallel = io_jsc.jsc_batch(self.directory, self.LUT_files, n_jobs=2)
+        pd.testing.assert_frame_equal(parallel.df, serial.df)
+        np.testing.assert_array_almost_equal(serial.df['wvl'].values,
+                                             np.vstack([self.spectra[k] for k in sorted(self.spectra)]))
+
+
+class TestDuplicateColumns(unittest.TestCase):
+    def test_duplicate_columns(self):
+        rng = np.random.RandomState(0)
+        values = rng.rand(10, 4)
+        values[2, 1] = np.nan
+        frame = pd.DataFrame(values[:, [0, 1, 2, 1, 0, 3, 1]], columns=list('abcdefg'))
+        frame['zero'] = 0.0
+        frame['negzero'] = -0.0
+        frame['name'] = ['x'] * 10
+        frame['name2'] = ['x'] * 10
+        frame['int'] = np.arange(10)
+        frame['int_as_float'] = np.arange(10.0)  # same values but a different dtype
+        self.assertEqual(io_jsc.duplicate_columns(frame), ['a', 'b', 'd', 'zero', 'name'])
+        self.assertEqual(io_jsc.duplicate_columns(frame[['a', 'c', 'f']]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
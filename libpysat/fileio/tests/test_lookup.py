@@ -0,0 +1,74 @@
+import os
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from .. import io_utils
+from .. import lookup
+from ..ingest_cache import IngestCache
+
+
+def write_master_list(path, sclocks, seed=0):
+    rng = np.random.RandomState(seed)
+    master = pd.DataFrame({'Spacecraft Clock': sclocks,
+                           'Target': ['Target{}'.format(i) for i in range(len(sclocks))],
+                           'Sol': rng.randint(0, 2000, len(sclocks))},
+                          columns=['Spacecraft Clock', 'Target', 'Sol'])
+    with open(path, 'w') as f:
+        f.write('ChemCam master list\n')
+    master.to_csv(path, mode='a', index=False)
+    return master
+
+
+class TestLookup(unittest.TestCase):
+    def setUp(self):
+        self.directory = io_utils.create_dir()
+        self.files = [os.path.join(self.directory, 'master{}.csv'.format(i)) for i in range(2)]
+        self.masters = [write_master_list(self.files[0], [398736801, 398736950, 398736900]),
+                        write_master_list(self.files[1], [398737000, 398736801], seed=1)]
+        self.df = pd.DataFrame({('meta', 'sclock'): [398736900, 398737000, 12345, 398736801],
+                                ('meta', 'Target'): ['a', 'b', 'c', 'd'],
+                                ('wvl', 240.811): [1.0, 2.0, 3.0, 4.0]}, index=[5, 6, 7, 8])
+
+    def tearDown(self):
+        io_utils.delete_dir(self.directory)
+
+    def test_lookup(self):
+        result = lookup.lookup(self.df, lookupfile=self.files)
+        meta = result['meta']
+        self.assertEqual(list(result.index), [5, 6, 7, 8])
+        self.assertEqual(list(meta['Sol'].iloc[[0, 1, 3]]),
+                         [self.masters[0]['Sol'][2], self.masters[1]['Sol'][0], self.masters[0]['Sol'][0]])
+        self.assertTrue(np.isnan(meta['Sol'].iloc[2]))
+        # columns in both frames get suffixes, as a pandas merge would give them
+        self.assertEqual(list(meta['Target_x']), ['a', 'b', 'c', 'd'])
+        self.assertEqual(meta['Target_y'].iloc[0], 'Target2')
+        pd.testing.assert_frame_equal(result['wvl'], self.df['wvl'])
+
+    def test_table_reused_until_files_change(self):
+        cache_dir = os.path.join(self.directory, 'cache')
+        first = lookup.read_lookup(self.files, cache_dir=cache_dir)
+        self.assertIs(lookup.read_lookup(self.files, cache_dir=cache_dir), first)
+        self.assertEqual(len(IngestCache(cache_dir).manifest), 1)
+
+        write_master_list(self.files[1], [398737000, 398737100], seed=2)
+        os.utime(self.files[1], (0, 0))
+        second = lookup.read_lookup(self.files, cache_dir=cache_dir)
+        self.assertIsNot(second, first)
+        np.testing.assert_array_equal(second.rows([398737100, 398736801, 1]), [4, 0, -1])
+
+    def test_tables_bounded(self):
+        others = [os.path.join(self.directory, 'other{}.csv'.format(i)) for i in range(lookup._MAX_TABLES)]
+        first = lookup.read_lookup(self.files)
+        for path in others:
+            write_master_list(path, [398736801])
+            lookup.read_lookup([path])
+            # the first table is used again, so it stays most recent
+            self.assertIs(lookup.read_lookup(self.files), first)
+        self.assertEqual(len(lookup._tables), lookup._MAX_TABLES)
+        self.assertNotIn((os.path.abspath(others[0]),), [name[0] for name in lookup._tables])
+
+
+if __name__ == '__main__':
+    unittest.main()
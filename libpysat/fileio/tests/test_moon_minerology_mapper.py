@@ -0,0 +1,68 @@
+import os
+import unittest
+
+import numpy as np
+
+from .. import io_moon_minerology_mapper as m3
+from .. import io_utils
+
+
+def write_envi(directory, cube, interleave='bil', byteorder='<', wavelengths=None, header_offset=0):
+    """
+    Write a (lines, samples, bands) cube as an ENVI .img/.hdr pair and return the .hdr PATH
+    """
+    lines, samples, bands = cube.shape
+    axes = {'bsq': (2, 0, 1), 'bil': (0, 2, 1), 'bip': (0, 1, 2)}[interleave]
+    base = os.path.join(directory, 'M3G20090101T000000_V03_RFL')
+    with open(base + '.img', 'wb') as f:
+        f.write(b'\0' * header_offset)
+        f.write(np.ascontiguousarray(cube.transpose(axes)).astype(byteorder + 'f4').tobytes())
+    if wavelengths is None:
+        wavelengths = np.linspace(460.99, 2976.2, bands)
+    with open(base + '.hdr', 'w') as f:
+        f.write('ENVI\ndescription = {M3 test cube}\n')
+        f.write('samples = {}\nlines = {}\nbands = {}\n'.format(samples, lines, bands))
+        f.write('header offset = {}\nfile type = ENVI Standard\ndata type = 4\n'.format(header_offset))
+        f.write('interleave = {}\nbyte order = {}\n'.format(interleave, 1 if byteorder == '>' else 0))
+        f.write('wavelength = {\n ' + ',\n '.join('{:.6f}'.format(w) for w in wavelengths) + '}\n')
+    return base + '.hdr'
+
+
+class TestM3Cube(unittest.TestCase):
+    def setUp(self):
+        self.directory = io_utils.create_dir()
+        self.cube = np.random.RandomState(0).rand(7, 5, 4).astype('f4')
+
+    def tearDown(self):
+        io_utils.delete_dir(self.directory)
+
+    def test_interleaves(self):
+        for interleave, byteorder in [('bsq', '<'), ('bil', '>'), ('bip', '<')]:
+            hdr = write_envi(self.directory, self.cube, interleave, byteorder, header_offset=16)
+            cube = m3.M3Cube(hdr)
+            self.assertEqual(cube.shape, (7, 5, 4))
+            np.testing.assert_array_equal(cube[:], self.cube)
+            np.testing.assert_array_equal(cube.read(slice(2, 4), slice(1, 3), slice(0, 2)), self.cube[2:4, 1:3, :2])
+
+    def test_spectra(self):
+        hdr = write_envi(self.directory, self.cube, wavelengths=[540.84, 580.76, 620.69, 660.61])
+        cube = m3.M3Cube(hdr[:-4] + '.img')
+        spectrum = cube.spectrum(3, 2)
+        np.testing.assert_array_equal(spectrum.index.values, [540.84, 580.76, 620.69, 660.61])
+        np.testing.assert_array_equal(spectrum.values, self.cube[3, 2])
+        lines, samples = [6, 0, 6, 2], [1, 4, 0, 2]
+        np.testing.assert_array_equal(cube.spectra(lines, samples), self.cube[lines, samples])
+
+    def test_iter_blocks(self):
+        cube = m3.M3Cube(write_envi(self.directory, self.cube))
+        blocks = list(cube.iter_blocks(max_bytes=2 * 5 * 4 * 4))
+        self.assertEqual([start for start, block in blocks], [0, 2, 4, 6])
+        np.testing.assert_array_equal(np.concatenate([block for start, block in blocks]), self.cube)
+
+    def test_metadatatoband(self):
+        metadata = {'Band_2': '580.76', 'Band_10': 'Band 10 (900.0)', 'Band_1': '540.84', 'wavelength_units': 'nm'}
+        np.testing.assert_array_equal(m3.metadatatoband(metadata), [540.84, 580.76, 900.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
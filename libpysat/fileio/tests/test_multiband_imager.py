@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+
+from .. import io_multibandimager as mi
+
+
+class FakeBand(object):
+    def __init__(self, data, block_size, reads):
+        self.data = data
+        self.block_size = block_size
+        self.reads = reads
+
+    def GetBlockSize(self):
+        return list(self.block_size)
+
+    def ReadAsArray(self, xoff, yoff, xsize, ysize):
+        self.reads.append((xoff, yoff, xsize, ysize))
+        return self.data[yoff:yoff + ysize, xoff:xoff + xsize].copy()
+
+
+class FakeDataset(object):
+    """
+    The parts of a GDAL dataset used by the multiband imager reader
+    """
+
+    def __init__(self, cube, block_size):
+        self.cube = cube
+        self.reads = []
+        self.RasterCount = cube.shape[0]
+        self.RasterYSize, self.RasterXSize = cube.shape[1:]
+        self.bands = [FakeBand(b, block_size, self.reads) for b in cube]
+
+    def GetRasterBand(self, b):
+        return self.bands[b - 1]
+
+
+class TestGetSpectra(unittest.TestCase):
+    def setUp(self):
+        self.cube = np.random.RandomState(0).rand(9, 50, 70)
+        self.ds = FakeDataset(self.cube, (32, 16))
+
+    def test_getspectra_many(self):
+        coords = np.array([[0, 0], [49, 69], [20, 40], [21, 41], [3, 65], [20, 40]])
+        spectra = mi.getspectra_many(coords, self.ds)
+        self.assertEqual(spectra.shape, (6, 8))
+        for (x, y), spectrum in zip(coords, spectra):
+            np.testing.assert_array_equal(spectrum, mi.getspectra(x, y, self.ds))
+
+    def test_each_block_read_once_per_band(self):
+        coords = np.array([[1, 1], [2, 3], [15, 31], [16, 32], [16, 33]])
+        mi.getspectra_many(coords, self.ds)
+        self.assertEqual(len(self.ds.reads), 2 * self.cube.shape[0])
+        self.assertIn((32, 16, 32, 16), self.ds.reads)
+
+    def test_coordinates_outside_raster(self):
+        for coords in ([[-1, 0]], [[0, -1]], [[50, 0]], [[0, 70]], [[2, 3], [49, 70]]):
+            with self.assertRaises(ValueError):
+                mi.getspectra_many(coords, self.ds)
+        self.assertEqual(self.ds.reads, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
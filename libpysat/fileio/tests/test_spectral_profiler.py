@@ -1,8 +1,17 @@
+import os
+import shutil
 import unittest
 
+import numpy as np
+import pandas as pd
+
 from libpysat.examples import get_path
+from libpysat.spectral.spectral_data import spectral_data
+from libpysat.utils.utils import find_in_dict
 
 from .. import io_spectral_profiler as sp
+from .. import io_utils
+from ..ingest_cache import IngestCache
 
 
 class Test_Spectral_Profiler_IO(unittest.TestCase):
@@ -11,7 +20,71 @@ class Test_Spectral_Profiler_IO(unittest.TestCase):
 
     def test_openspc(self):
         dataset = sp.Spectral_Profiler(self.examplefile)
-        # self.assertTrue(False)
+        self.assertEqual(len(dataset.spectra), 38)
+        self.assertEqual(dataset.products, ['RAW', 'REF1', 'REF2', 'QA'])
+        self.assertEqual(dataset.data.shape, (38, 296, 4))
+        # spectra are only built when they are used
+        self.assertEqual(len(dataset.spectra._spectra), 0)
+        spectrum = dataset.spectra[3]
+        self.assertEqual(list(dataset.spectra._spectra), [3])
+        self.assertTrue((spectrum.df['QA'] < 2000).all())
+        np.testing.assert_array_equal(spectrum.df.values, dataset.data[3][dataset.qa_mask[3]])
+
+    def test_uncleaned(self):
+        dataset = sp.Spectral_Profiler(self.examplefile, cleaned=False)
+        df = dataset.spectra[0].df
+        self.assertEqual(df.shape, (296, 4))
+        np.testing.assert_array_equal(df.index.values, dataset.wavelengths.values)
+        np.testing.assert_array_almost_equal(df['REF1'].values, dataset.product('REF1', 0))
+
+    def test_label_index_matches_pvl(self):
+        dataset = sp.Spectral_Profiler(self.examplefile)
+        index = dataset.label_index
+        for k in ['ANCILLARY_AND_SUPPLEMENT_DATA', 'SP_SPECTRUM_WAV', 'SP_SPECTRUM_QA']:
+            self.assertEqual(index['pointers'][k], find_in_dict(dataset.label, '^' + k).value)
+        for k in ['SP_SPECTRUM_WAV', 'SP_SPECTRUM_REF1']:
+            self.assertEqual(index['objects'][k]['SCALING_FACTOR'], find_in_dict(dataset.label, k)['SCALING_FACTOR'])
+        ancillary = index['objects']['ANCILLARY_AND_SUPPLEMENT_DATA']
+        self.assertEqual(len(ancillary['COLUMN']), ancillary['COLUMNS'])
+        self.assertEqual(ancillary['COLUMN'][0]['NAME'], 'SPACECRAFT_CLOCK_COUNT')
+
+    def test_label_cache(self):
+        cache_dir = io_utils.create_dir()
+        try:
+            first = sp.Spectral_Profiler(self.examplefile, cache_dir=cache_dir)
+            cache = IngestCache(cache_dir)
+            self.assertEqual(sp.read_sp_label(self.examplefile, cache), first.label_index)
+            self.assertEqual(cache.hits, 1)
+        finally:
+            io_utils.delete_dir(cache_dir)
+
+
+class Test_SP_Batch(unittest.TestCase):
+    def setUp(self):
+        self.directory = io_utils.create_dir()
+        for name in ['SP_A.spc', 'SP_B.spc']:
+            shutil.copy(get_path('SP_2C_02_02358_S138_E3586.spc'), os.path.join(self.directory, name))
+
+    def tearDown(self):
+        io_utils.delete_dir(self.directory)
+
+    def test_sp_batch(self):
+        outpath = os.path.join(self.directory, 'store')
+        data = sp.sp_batch(self.directory, n_jobs=2, outpath=outpath)
+        self.assertEqual(data.df['wvl'].shape, (76, 296))
+        self.assertEqual(list(data.df[('meta', 'FILE')].iloc[[0, 38]]), ['SP_A.spc', 'SP_B.spc'])
+        self.assertEqual(data.df[('meta', 'OBSERVATION')].iloc[38], 0)
+
+        dataset = sp.Spectral_Profiler(os.path.join(self.directory, 'SP_B.spc'))
+        # the spectra are stored in wavelength order, and the detectors overlap
+        order = np.argsort(dataset.wavelengths.values, kind='mergesort')
+        qa_mask = dataset.qa_mask[:, order]
+        spectra = data.df['wvl'].values[38:]
+        np.testing.assert_array_equal(np.isnan(spectra), ~qa_mask)
+        np.testing.assert_array_equal(spectra[qa_mask], dataset.product('REF1')[:, order][qa_mask])
+
+        pd.testing.assert_frame_equal(spectral_data.load(outpath).df, data.df)
+        pd.testing.assert_frame_equal(sp.sp_batch(self.directory).df, data.df)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,44 @@
+import os
 import unittest
 
+from .. import utils
+
 
 class TestUtils(unittest.TestCase):
     def setUp(self):
-        pass
+        self.directory = utils.create_dir()
+        self.path = os.path.join(self.directory, 'label.dat')
+
+    def tearDown(self):
+        utils.delete_dir(self.directory)
+
+    def test_read_label_text(self):
+        label = b'PDS_VERSION_ID = PDS3\r\nEND\r\n'
+        with open(self.path, 'wb') as f:
+            f.write(label + b'\x00' * 100)
+        # The END statement straddles the blocks for every blocksize
+        for blocksize in range(1, len(label) + 1):
+            text = utils.read_label_text(self.path, blocksize=blocksize)
+            self.assertTrue(text.startswith('PDS_VERSION_ID = PDS3\r\nEND\r'))
+            self.assertLess(len(text), len(label) + blocksize)
+
+    def test_read_label_text_without_end(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'PDS_VERSION_ID = PDS3\r\n' * 10)
+        self.assertEqual(len(utils.read_label_text(self.path, blocksize=16)), 230)
+        with self.assertRaises(ValueError):
+            utils.read_label_text(self.path, blocksize=16, max_size=64)
+
+    def test_label_statements(self):
+        text = '\r\n'.join(['PDS_VERSION_ID = PDS3',
+                            '/*** A COMMENT = NOT A STATEMENT ***/',
+                            'NAMES = ("A",',
+                            '         "B")',
+                            'DESCRIPTION = "A description that',
+                            '               wraps"',
+                            'END',
+                            'AFTER = END'])
+        self.assertEqual(list(utils.label_statements(text)),
+                         [('PDS_VERSION_ID', 'PDS3'),
+                          ('NAMES', '("A", "B")'),
+                          ('DESCRIPTION', '"A description that wraps"')])
@@ -5,6 +5,9 @@ import tempfile
 
 import numpy as np
 
+# Longest attached PDS3 label read_label_text searches for an END statement
+MAX_LABEL_BYTES = 1 << 20
+
 
 def create_dir(basedir=''):
     """
@@ -38,3 +41,76 @@ def file_search(searchdir, searchstring):
             filelist.append(os.path.join(root, filename))
     filelist = np.array(filelist)
     return filelist
+
+
+def read_label_text(input_file, blocksize=65536, max_size=MAX_LABEL_BYTES):
+    """
+    Read the attached PDS3 label at the start of a file, up to and including
+    the END statement, without reading the rest of the file
+
+    Parameters
+    ----------
+    input_file : str
+                 PATH to the file
+
+    max_size : int
+               The most bytes to read looking for the END statement. A file
+               without one is read up to its end if it is smaller than this.
+
+    Returns
+    -------
+    text : str
+    """
+    blocks = []
+    size = 0
+    tail = b''
+    with open(input_file, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            blocks.append(block)
+            size += len(block)
+            # Only the new block is searched, with the end of the previous
+            # one in case the END statement straddles them
+            window = tail + block
+            if b'\nEND\r' in window or b'\nEND\n' in window:
+                break
+            if size >= max_size:
+                raise ValueError('No END statement in the first {} bytes of {}'.format(max_size, input_file))
+            tail = window[-4:]  # one byte short of b'\nEND\n'
+    return b''.join(blocks).decode('latin-1')
+
+
+def label_statements(text):
+    """
+    Split PDS3 label text into (key, value) statements, stopping at the END
+    statement. Comment lines are skipped and values that continue over several
+    lines (parenthesized lists or quoted strings) are joined with spaces.
+
+    Parameters
+    ----------
+    text : str
+           The label text
+
+    Yields
+    ------
+    key, value : str
+                 The stripped keyword and (unparsed) value of each statement
+    """
+    statement = None
+    for line in text.splitlines():
+        if statement is not None:
+            statement[1] += ' ' + line.strip()
+        else:
+            stripped = line.strip()
+            if stripped == 'END':
+                return
+            if '=' not in line or stripped.startswith('/*'):
+                continue
+            key, value = line.split('=', 1)
+            statement = [key.strip(), value.strip()]
+        value = statement[1]
+        if value.count('(') <= value.count(')') and value.count('"') % 2 == 0:
+            yield statement[0], value
+            statement = None
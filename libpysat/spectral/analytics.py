@@ -106,3 +106,107 @@ def band_asymmetry(spectrum, low_endmember=None, high_endmember=None):
 
     asymmetry = (area_left - area_right) / (area_left + area_right)
     return asymmetry
+
+
+# Vectorized versions of the band parameters, for (nspectra, nwavelengths) arrays
+# of spectra that share the wavelengths x. Spectra without a valid result get NaN.
+
+def _window(x, low_endmember=None, high_endmember=None):
+    # Boolean mask of the wavelengths between the end members (inclusive)
+    x = np.asarray(x)
+    if not low_endmember:
+        low_endmember = x[0]
+    if not high_endmember:
+        high_endmember = x[-1]
+    return (x >= low_endmember) & (x <= high_endmember)
+
+
+def _area(values, mask):
+    # The trapezoidal area under -values, using only the values where mask is True
+    # (compacted, with unit spacing, as np.trapz(-ny[ny <= 1.0]) does for one spectrum)
+    mask = mask & (values <= 1.0)
+    count = mask.sum(axis=1)
+    rows = np.arange(values.shape[0])
+    first = values[rows, mask.argmax(axis=1)]
+    last = values[rows, values.shape[1] - 1 - mask[:, ::-1].argmax(axis=1)]
+    total = np.where(mask, values, 0).sum(axis=1)
+    return np.where(count >= 2, -(total - (first + last) / 2), 0.0)
+
+
+def band_minima_many(x, spectra, low_endmember=None, high_endmember=None):
+    """
+    Vectorized band_minima
+
+    Returns
+    =======
+    minidx : ndarray
+             The wavelength of the minimum value of each spectrum
+
+    minvalue : ndarray
+               The minimum value of each spectrum
+    """
+    window = _window(x, low_endmember, high_endmember)
+    nx = np.asarray(x)[window]
+    ny = spectra[:, window]
+    valid = ~np.isnan(ny).all(axis=1)
+    i = np.where(np.isnan(ny), np.inf, ny).argmin(axis=1)
+    minidx = np.where(valid, nx[i], np.nan)
+    minvalue = np.where(valid, ny[np.arange(len(ny)), i], np.nan)
+    return minidx, minvalue
+
+
+def band_center_many(x, spectra, low_endmember=None, high_endmember=None, degree=3):
+    """
+    Vectorized band_center, a polynomial is fit to every spectrum with a
+    single least squares solve
+
+    Returns
+    =======
+    center : ndarray
+             The wavelength of the minimum of the fit for each spectrum
+
+    center_value : ndarray
+                   The minimum of the fit for each spectrum
+    """
+    window = _window(x, low_endmember, high_endmember)
+    nx = np.asarray(x, dtype=np.float64)[window]
+    ny = spectra[:, window]
+    center = np.full(len(ny), np.nan)
+    center_value = np.full(len(ny), np.nan)
+    valid = np.isfinite(ny).all(axis=1)
+    if valid.any():
+        fit = np.polyfit(nx, ny[valid].T, degree)
+        center_fit = np.vander(nx, degree + 1).dot(fit)
+        i = center_fit.argmin(axis=0)
+        center[valid] = nx[i]
+        center_value[valid] = center_fit[i, np.arange(len(i))]
+    return center, center_value
+
+
+def band_area_many(x, spectra, low_endmember=None, high_endmember=None):
+    """
+    Vectorized band_area
+    """
+    window = _window(x, low_endmember, high_endmember)
+    return _area(spectra[:, window], np.ones((len(spectra), window.sum()), dtype=bool))
+
+
+def band_asymmetry_many(x, spectra, low_endmember=None, high_endmember=None, center=None):
+    """
+    Compute the symmetry of an absorption feature in each spectrum as
+
+    (left_area - right_area) / total_area
+
+    where the areas are either side of the band center (see band_center_many),
+    which is included in both.
+    """
+    if center is None:
+        center, _ = band_center_many(x, spectra, low_endmember, high_endmember)
+    window = _window(x, low_endmember, high_endmember)
+    nx = np.asarray(x)[window]
+    ny = spectra[:, window]
+    with np.errstate(invalid='ignore'):
+        area_left = _area(ny, nx <= center[:, np.newaxis])
+        area_right = _area(ny, nx >= center[:, np.newaxis])
+        asymmetry = (area_left - area_right) / (area_left + area_right)
+    return np.where(np.isnan(center), np.nan, asymmetry)
@@ -1,45 +1,70 @@
+import copy
+
 import numpy as np
 from libpysat.spectral.baseline_code.common import WhittakerSmoother, Baseline
 
 
 def airpls_baseline(intensities, smoothness_param=100, max_iters=10,
-                    conv_thresh=0.001, verbose=False):
+                    conv_thresh=0.001, verbose=False, init_baseline=None, warn=True,
+                    return_iters=False):
     '''
     Baseline corr. using adaptive iteratively reweighted penalized least squares.
     Also known as airPLS, 2010.
     http://pubs.rsc.org/EN/content/articlehtml/2010/an/b922045c
     https://code.google.com/p/airpls/
     https://airpls.googlecode.com/svn/trunk/airPLS.py
+
+    init_baseline: an approximate baseline to take the initial weights from,
+                   as if after a first iteration, instead of uniform weights
+    warn: whether to report a spectrum that did not converge
+    return_iters: also return the number of iterations taken
     '''
     smoother = WhittakerSmoother(intensities, smoothness_param)
     total_intensity = np.abs(intensities).sum()
     w = np.ones(intensities.shape[0])
-    for i in range(1, int(max_iters + 1)):
+    first = 1
+    if init_baseline is not None:
+        corrected = intensities - init_baseline
+        mask = corrected < 0
+        # A spectrum that is nowhere below its initial baseline starts over
+        if mask.any():
+            _airpls_weights(w, corrected, mask, 1)
+            first = 2
+    for i in range(first, int(max_iters + first)):
         baseline = smoother.smooth(w)
         # Compute error (sum of distances below the baseline).
         corrected = intensities - baseline
         mask = corrected < 0
-        baseline_error = -corrected[mask]
-        total_error = baseline_error.sum()
+        total_error = -corrected[mask].sum()
         # Check convergence as a fraction of total intensity.
         conv = total_error / total_intensity
         if verbose:
             print(i, conv)
         if conv < conv_thresh:
             break
-        # Set peak weights to zero.
-        w[~mask] = 0
-        # Set baseline weights.
-        baseline_error /= total_error
-        w[mask] = np.exp(i * baseline_error)
-        w[0] = np.exp(i * baseline_error.min())
-        w[-1] = w[0]
+        _airpls_weights(w, corrected, mask, i)
     else:
-        print('airPLS did not converge in %d iterations' % max_iters)
+        if warn:
+            print('airPLS did not converge in %d iterations' % max_iters)
+    if return_iters:
+        return baseline, i - first + 1
     return baseline
 
 
+def _airpls_weights(w, corrected, mask, i):
+    # Set peak weights to zero.
+    w[~mask] = 0
+    # Set baseline weights.
+    baseline_error = -corrected[mask]
+    baseline_error /= baseline_error.sum()
+    w[mask] = np.exp(i * baseline_error)
+    w[0] = np.exp(i * baseline_error.min())
+    w[-1] = w[0]
+
+
 class AirPLS(Baseline):
+    _counts_iters = True
+
     def __init__(self, smoothness_param=100, max_iters=10,
                  conv_thresh=0.001, verbose=False):
         self.smoothness_ = smoothness_param
@@ -51,6 +76,25 @@ class AirPLS(Baseline):
         return airpls_baseline(intensities, self.smoothness_, self.max_iters_,
                                self.conv_thresh_, self.verbose_)
 
+    def _coarse(self, factor):
+        # The first difference penalty grows as factor ** 2 on a coarser grid
+        br = copy.copy(self)
+        br.smoothness_ = self.smoothness_ / factor ** 2
+        return br
+
+    def _refine_many(self, bands, intensities, baseline=None, max_iters=None, warn=False):
+        max_iters = self.max_iters_ if max_iters is None else max_iters
+        if max_iters == 0:
+            return baseline.copy(), np.zeros(len(intensities), dtype=int)
+        refined = np.zeros_like(intensities, dtype=np.float64)
+        n_iters = np.zeros(len(intensities), dtype=int)
+        for i, y in enumerate(intensities):
+            refined[i], n_iters[i] = airpls_baseline(y, self.smoothness_, max_iters, self.conv_thresh_,
+                                                     self.verbose_,
+                                                     init_baseline=None if baseline is None else baseline[i],
+                                                     warn=warn, return_iters=True)
+        return refined, n_iters
+
     def param_ranges(self):
         return {
             'smoothness_': (1, 1e4, 'log')
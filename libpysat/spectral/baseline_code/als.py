@@ -1,21 +1,31 @@
+import copy
+
 import numpy as np
 from libpysat.spectral.baseline_code.common import WhittakerSmoother, Baseline
 
 
 def als_baseline(intensities, asymmetry_param=0.05, smoothness_param=1e6,
-                 max_iters=10, conv_thresh=1e-5, verbose=False):
+                 max_iters=10, conv_thresh=1e-5, verbose=False, init_baseline=None,
+                 warn=True, return_iters=False):
     '''Perform asymmetric least squares baseline removal.
     * http://www.science.uva.nl/~hboelens/publications/draftpub/Eilers_2005.pdf
 
     smoothness_param: Relative importance of smoothness of the predicted response.
     asymmetry_param (p): if y > z, w = p, otherwise w = 1-p.
                          Setting p=1 is effectively a hinge loss.
+    init_baseline: an approximate baseline to take the initial weights from,
+                   instead of uniform weights
+    warn: whether to report a spectrum that did not converge
+    return_iters: also return the number of iterations taken
     '''
     smoother = WhittakerSmoother(intensities, smoothness_param, deriv_order=2)
     # Rename p for concision.
     p = asymmetry_param
     # Initialize weights.
-    w = np.ones(intensities.shape[0])
+    if init_baseline is None:
+        w = np.ones(intensities.shape[0])
+    else:
+        w = np.where(intensities > init_baseline, p, 1 - p)
     for i in range(max_iters):
         z = smoother.smooth(w)
         mask = intensities > z
@@ -27,11 +37,16 @@ def als_baseline(intensities, asymmetry_param=0.05, smoothness_param=1e6,
             break
         w = new_w
     else:
-        print('ALS did not converge in %d iterations' % max_iters)
+        if warn:
+            print('ALS did not converge in %d iterations' % max_iters)
+    if return_iters:
+        return z, i + 1
     return z
 
 
 class ALS(Baseline):
+    _counts_iters = True
+
     def __init__(self, asymmetry_param=0.05, smoothness_param=1e6, max_iters=10,
                  conv_thresh=1e-5, verbose=False):
         self.asymmetry_ = asymmetry_param
@@ -44,6 +59,25 @@ class ALS(Baseline):
         return als_baseline(intensities, self.asymmetry_, self.smoothness_,
                             self.max_iters_, self.conv_thresh_, self.verbose_)
 
+    def _coarse(self, factor):
+        # The second difference penalty grows as factor ** 4 on a coarser grid
+        br = copy.copy(self)
+        br.smoothness_ = self.smoothness_ / factor ** 4
+        return br
+
+    def _refine_many(self, bands, intensities, baseline=None, max_iters=None, warn=False):
+        max_iters = self.max_iters_ if max_iters is None else max_iters
+        if max_iters == 0:
+            return baseline.copy(), np.zeros(len(intensities), dtype=int)
+        refined = np.zeros_like(intensities, dtype=np.float64)
+        n_iters = np.zeros(len(intensities), dtype=int)
+        for i, y in enumerate(intensities):
+            refined[i], n_iters[i] = als_baseline(y, self.asymmetry_, self.smoothness_, max_iters,
+                                                  self.conv_thresh_, self.verbose_,
+                                                  init_baseline=None if baseline is None else baseline[i],
+                                                  warn=warn, return_iters=True)
+        return refined, n_iters
+
     def param_ranges(self):
         return {
             'asymmetry_': (1e-3, 1e-1, 'log'),
@@ -51,12 +51,14 @@ Translation to Python begun on Tue Nov 04 16:31:33 2014 by Ryan Anderson
 ;      
 
 """
+import copy
+
 import numpy
 import libpysat.spectral.baseline_code.spl_init as spl_init
 import libpysat.spectral.baseline_code.spl_interp as spl_interp
 import libpysat.spectral.baseline_code.watrous as watrous
 import scipy
-from libpysat.spectral.baseline_code.common import Baseline
+from libpysat.spectral.baseline_code.common import Baseline, MULTIRES_MIN_CHANNELS
 
 
 # import pywt <- this needs to be fixed, it doesn't exist in and outside libpysat
@@ -135,7 +137,10 @@ def chemcam_continuum(x, sp, int_flag, lvmin=-9999):
     return yf
 
 
-def ccam_remove_continuum(x, y, lv, lvmin=2, int_flag=2):
+def ccam_remove_continuum(x, y, lv, lvmin=2, int_flag=2, init_baseline=None, return_iters=False):
+    # init_baseline: an approximate continuum that is removed before the
+    # wavelet levels are worked through, and is part of the returned baseline
+    # return_iters: also return the number of continuum estimates made
     x = numpy.array(x, dtype='float64')
     y = numpy.array(y, dtype='float64')
     y_old = y
@@ -165,10 +170,15 @@ def ccam_remove_continuum(x, y, lv, lvmin=2, int_flag=2):
         print("Valid values of the interpolation flag are 0, 1, or 2")
         return
 
+    y_old = y
+    if init_baseline is not None:
+        y = y - init_baseline
     stdb0 = numpy.std(y, ddof=1)
     stdb = stdb0
-    y_old = y
 
+    n_iters = 0
+    # A constant (residual) spectrum has no continuum left to remove
+    sc = numpy.zeros_like(y)
     for il in range(lv, lvmin - 1, -1):
         counter = 0
         while stdb > stdb0 * 1e-2:
@@ -178,15 +188,23 @@ def ccam_remove_continuum(x, y, lv, lvmin=2, int_flag=2):
             # print(sc[1000])
             y = y - sc
             stdb = numpy.std(sc, ddof=1)
+        n_iters += counter
         stdb0 = numpy.std(y, ddof=1)
         stdb = stdb0
         y = y - sc
 
     baseline = y_old - y
+    if return_iters:
+        return baseline, n_iters
     return baseline
 
 
 class ccam_br(Baseline):
+    # The continuum removal keeps peeling minima off whatever residual a seed
+    # leaves, so seeding from the previous shot takes more iterations, not fewer
+    _warm_seed = False
+    _counts_iters = True
+
     def __init__(self, lv=7, lvmin=2, int_flag=2):
         self.lv_ = lv
         self.lvmin_ = lvmin
@@ -195,3 +213,30 @@ class ccam_br(Baseline):
     def _fit_one(self, x, y):
         return ccam_remove_continuum(x, y, self.lv_, lvmin=self.lvmin_,
                                      int_flag=self.int_flag_)
+
+    def _coarse(self, factor):
+        # Decimating by 2 ** s moves every wavelet scale down s levels
+        s = int(round(numpy.log2(factor)))
+        if 2 ** s != factor or self.lv_ - s < 2:
+            raise ValueError('ccam_br can only be decimated by powers of 2 up to 2 ** (lv - 2)')
+        br = copy.copy(self)
+        br.lv_ = self.lv_ - s
+        br.lvmin_ = max(2, min(self.lvmin_ - s, br.lv_))
+        return br
+
+    def _min_coarse_channels(self):
+        # ccam_remove_continuum needs lv <= log2(n - 1)
+        return max(MULTIRES_MIN_CHANNELS, 2 ** self.lv_ + 1)
+
+    def _refine_many(self, bands, intensities, baseline=None, max_iters=None, warn=False):
+        if max_iters == 0:
+            return baseline.copy(), numpy.zeros(len(intensities), dtype=int)
+        # Each refining iteration works through one of the finest wavelet levels
+        lv = self.lv_ if max_iters is None else min(self.lv_, self.lvmin_ + max_iters - 1)
+        refined = numpy.zeros_like(intensities)
+        n_iters = numpy.zeros(len(intensities), dtype=int)
+        for i, y in enumerate(intensities):
+            refined[i], n_iters[i] = ccam_remove_continuum(bands, y, lv, lvmin=self.lvmin_, int_flag=self.int_flag_,
+                                                           init_baseline=None if baseline is None else baseline[i],
+                                                           return_iters=True)
+        return refined, n_iters
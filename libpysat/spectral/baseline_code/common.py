@@ -1,8 +1,34 @@
+import copy
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-from scipy.linalg import solveh_banded
+from scipy.linalg.lapack import dpbtrf, dpbtrs, dpttrf, dpttrs
+
+from libpysat.utils.utils import effective_n_jobs
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8: the chunks are pickled to the workers instead
+    shared_memory = None
+
+# Penalty bands built by whittaker_bands, most recently used last
+_penalty_bands = OrderedDict()
+_MAX_PENALTY_BANDS = 16
+
+# Fewest channels a decimated spectrum (or segment) may have; shorter ones are fit at full resolution
+MULTIRES_MIN_CHANNELS = 16
 
 
 class Baseline(object):
+    # Whether warm_start seeds each spectrum with the previous baseline of its
+    # group; methods that do not gain from a seed fit every spectrum from scratch
+    _warm_seed = True
+    # Whether _refine_many counts the iterations each spectrum takes, so that
+    # fit() can record them for cold fits too
+    _counts_iters = False
+
     def _fit_one(self, bands, intensities):
         '''bands: array of length n
            intensities: array of length n
@@ -23,27 +49,233 @@ class Baseline(object):
             baseline[i] = self._fit_one(bands, y)
         return baseline
 
+    def _fit_counted(self, bands, intensities):
+        '''Fits the baselines as _fit_many does, and also returns the number
+        of iterations each spectrum took, or None if the method does not
+        count them.'''
+        if not self._counts_iters:
+            return self._fit_many(bands, intensities), None
+        baseline, n_iters = self._refine_many(bands, np.atleast_2d(intensities), warn=True)
+        return baseline.reshape(intensities.shape), n_iters
+
+    def _coarse(self, factor):
+        '''Returns a copy of this baseline remover with its parameters scaled
+        for spectra decimated by factor, for multiresolution fitting.'''
+        raise NotImplementedError('%s does not support multiresolution fitting' % type(self).__name__)
+
+    def _min_coarse_channels(self):
+        '''Returns the fewest channels this (coarse) baseline remover is
+        given in multiresolution fitting.'''
+        return MULTIRES_MIN_CHANNELS
+
+    def _refine_many(self, bands, intensities, baseline=None, max_iters=None, warn=False):
+        '''bands: array of length n
+           intensities: 2d array of shape (k, n)
+           baseline: approximate baselines of shape (k, n) to start from, or
+                     None to start from scratch
+           max_iters: the most iterations to refine them with, or None for the
+                      method's own limit
+           warn: whether to report the spectra that did not converge
+           Returns baseline array of shape (k, n) and the number of
+           iterations each spectrum took
+        '''
+        raise NotImplementedError('%s does not support warm-started fitting' % type(self).__name__)
+
     def param_ranges(self):
         '''Returns a dict of parameter -> (min,max,scale) mappings.
         Min and max are scalars, scale is one of {'linear','log','integer'}.'''
         raise NotImplementedError()
 
-    def fit(self, bands, intensities, segment=False):
+    def fit(self, bands, intensities, segment=False, n_jobs=1, decimate=1, refine_iters=3,
+            warm_start=False, groups=None):
         '''Fits one baseline per spectrum and stores them as self.baseline.
         When segment=True, automatically detects discontinuities in the bands
-        and fits a separate baseline per segment.'''
-        if segment:
-            segments = _segment(bands, intensities)
-            self.baseline = np.hstack([self._fit_many(*s) for s in segments])
+        and fits a separate baseline per segment.
+        With n_jobs > 1, the spectra are split into chunks that are fit in
+        parallel worker processes (see libpysat.utils.utils.effective_n_jobs).
+        With decimate > 1, the baselines are first fit to spectra averaged over
+        blocks of decimate channels, then upsampled and refined at full
+        resolution with at most refine_iters iterations (see multires_error).
+        With warm_start=True, the spectra are fit one after the other, each
+        starting from the baseline of the previous spectrum in its group
+        (groups: one label per spectrum, e.g. the sclock, or None for a single
+        group). Methods whose iterations a seed does not save (ccam_br) still
+        fit every spectrum from scratch.
+        The iterations each spectrum took (summed over its segments, and over
+        the coarse fit and the refinement when decimate > 1) are stored as
+        self.n_iters, or None for methods that do not count them.'''
+        n_jobs = effective_n_jobs(n_jobs)
+        if warm_start:
+            if n_jobs > 1 or decimate > 1:
+                raise ValueError('warm_start fits the spectra in order, it cannot be combined with n_jobs or decimate')
+            self.baseline = self._fit_warm(bands, intensities, segment, groups)
+        elif n_jobs > 1 and intensities.ndim == 2 and intensities.shape[0] > 1:
+            self.baseline, self.n_iters = _fit_parallel(self, bands, intensities, segment, n_jobs, decimate,
+                                                        refine_iters)
         else:
-            self.baseline = self._fit_many(bands, intensities)
+            self.baseline, self.n_iters = self._fit_segments(bands, intensities, segment, decimate, refine_iters)
         return self
 
-    def fit_transform(self, bands, intensities, segment=False):
-        self.fit(bands, intensities, segment=segment)
+    def _fit_segments(self, bands, intensities, segment, decimate=1, refine_iters=3):
+        # Returns the baselines and the iterations each spectrum took, or None
+        if decimate > 1:
+            def fit_many(x, y):
+                return self._fit_multires(x, y, decimate, refine_iters)
+        else:
+            fit_many = self._fit_counted
+        if segment:
+            fits = [fit_many(*s) for s in _segment(bands, intensities)]
+            n_iters = None if fits[0][1] is None else sum(n for _, n in fits)
+            return np.hstack([baseline for baseline, _ in fits]), n_iters
+        return fit_many(bands, intensities)
+
+    def _fit_multires(self, bands, intensities, decimate, refine_iters):
+        y = np.atleast_2d(intensities)
+        coarse_bands, coarse = _decimate(bands, y, decimate)
+        coarse_br = self._coarse(decimate)
+        if len(coarse_bands) < coarse_br._min_coarse_channels():
+            return self._fit_counted(bands, intensities)
+        coarse_baseline, coarse_iters = coarse_br._fit_counted(coarse_bands, coarse)
+        baseline = _upsample(coarse_bands, np.atleast_2d(coarse_baseline), bands)
+        baseline, n_iters = self._refine_many(bands, y, baseline, refine_iters)
+        if coarse_iters is not None:
+            n_iters = n_iters + coarse_iters
+        return baseline.reshape(intensities.shape), n_iters
+
+    def _fit_warm(self, bands, intensities, segment, groups):
+        y = np.atleast_2d(intensities)
+        groups = np.zeros(len(y)) if groups is None else np.asarray(groups)
+        if len(groups) != len(y):
+            raise ValueError('groups has %d labels for %d spectra' % (len(groups), len(y)))
+        self.n_iters = np.zeros(len(y), dtype=int)
+        segments = _segment(bands, y) if segment else [(bands, y)]
+        baselines = []
+        for x, ys in segments:
+            baseline = np.empty_like(ys)
+            last = {}  # group -> its most recently fit row
+            totals = np.abs(ys).sum(axis=1)
+            for i, g in enumerate(groups):
+                # Shots mostly differ in their total intensity, so the previous baseline is scaled to match.
+                # There is nothing to scale from an empty previous shot.
+                init = None
+                if self._warm_seed and g in last and totals[last[g]] > 0:
+                    init = baseline[last[g]][None] * (totals[i] / totals[last[g]])
+                refined, n_iters = self._refine_many(x, ys[i][None], init, warn=True)
+                baseline[i] = refined[0]
+                self.n_iters[i] += n_iters[0]
+                last[g] = i
+            baselines.append(baseline)
+        return np.hstack(baselines).reshape(intensities.shape)
+
+    def multires_error(self, bands, intensities, decimate=4, refine_iters=3, segment=False):
+        '''Fits the baselines both at full resolution and with the given
+        decimate and refine_iters, and returns a dict of how they compare:
+           rms_error: rms of the difference between the two fits
+           max_error: largest absolute difference
+           relative_error: rms_error over the rms of the full resolution fit
+           full_time, multires_time: fitting times in seconds
+        self.baseline is left untouched.'''
+        start = time.time()
+        full, _ = self._fit_segments(bands, intensities, segment)
+        full_time = time.time() - start
+        start = time.time()
+        multires, _ = self._fit_segments(bands, intensities, segment, decimate, refine_iters)
+        multires_time = time.time() - start
+        rms_error = np.sqrt(np.mean((multires - full) ** 2))
+        return {'rms_error': rms_error,
+                'max_error': np.abs(multires - full).max(),
+                'relative_error': rms_error / np.sqrt(np.mean(full ** 2)),
+                'full_time': full_time,
+                'multires_time': multires_time}
+
+    def fit_transform(self, bands, intensities, segment=False, n_jobs=1, decimate=1, refine_iters=3,
+                      warm_start=False, groups=None):
+        self.fit(bands, intensities, segment=segment, n_jobs=n_jobs, decimate=decimate, refine_iters=refine_iters,
+                 warm_start=warm_start, groups=groups)
         return intensities - self.baseline
 
 
+def _decimate(bands, intensities, factor):
+    # Averages bands and intensities (k, n) over blocks of factor channels, the last block taking what is left
+    starts = np.arange(0, len(bands), factor)
+    counts = np.diff(np.append(starts, len(bands)))
+    return (np.add.reduceat(bands, starts) / counts,
+            np.add.reduceat(intensities, starts, axis=1) / counts)
+
+
+def _upsample(coarse_bands, coarse, bands):
+    # Linearly interpolates the rows of coarse from coarse_bands to bands, constant beyond the ends
+    i = np.clip(np.searchsorted(coarse_bands, bands) - 1, 0, max(len(coarse_bands) - 2, 0))
+    j = np.minimum(i + 1, len(coarse_bands) - 1)
+    span = coarse_bands[j] - coarse_bands[i]
+    t = np.clip(np.divide(bands - coarse_bands[i], span, out=np.zeros(len(bands)), where=span != 0), 0, 1)
+    return coarse[:, i] * (1 - t) + coarse[:, j] * t
+
+
+def _attach(block):
+    # (name, shape) of a shared memory block -> (SharedMemory, array view of it)
+    name, shape = block
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+
+
+def _fit_chunk(args):
+    # Fit the baselines of rows start:stop, reading the spectra from and writing the baselines to shared
+    # memory if the blocks are given, otherwise returning the baselines of the pickled spectra.
+    # The iterations each spectrum took are returned either way.
+    br, bands, spectra, baseline, start, stop, segment, decimate, refine_iters = args
+    if baseline is None:
+        return br._fit_segments(bands, spectra, segment, decimate, refine_iters)
+    spectra_shm, spectra = _attach(spectra)
+    baseline_shm, baseline = _attach(baseline)
+    try:
+        baseline[start:stop], n_iters = br._fit_segments(bands, spectra[start:stop], segment, decimate,
+                                                         refine_iters)
+        return n_iters
+    finally:
+        del spectra, baseline
+        spectra_shm.close()
+        baseline_shm.close()
+
+
+def _concat_iters(n_iters):
+    # The iteration counts of the chunks, in order, or None if the method does not count them
+    return None if n_iters[0] is None else np.concatenate(n_iters)
+
+
+def _fit_parallel(br, bands, intensities, segment, n_jobs, decimate=1, refine_iters=3):
+    # The spectra are split into a few chunks per worker, so that uneven fitting times even out
+    n = intensities.shape[0]
+    step = max(1, -(-n // (n_jobs * 4)))
+    starts = list(range(0, n, step))
+    # the workers only need the parameters, not the result of an earlier fit
+    br = copy.copy(br)
+    br.__dict__.pop('baseline', None)
+
+    if shared_memory is None:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            tasks = [(br, bands, intensities[s:s + step], None, s, s + step, segment, decimate, refine_iters)
+                     for s in starts]
+            fits = list(pool.map(_fit_chunk, tasks))
+        return np.vstack([baseline for baseline, _ in fits]), _concat_iters([n for _, n in fits])
+
+    size = max(1, n * intensities.shape[1] * 8)
+    spectra_shm = shared_memory.SharedMemory(create=True, size=size)
+    baseline_shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        np.ndarray(intensities.shape, dtype=np.float64, buffer=spectra_shm.buf)[:] = intensities
+        blocks = [(shm.name, intensities.shape) for shm in (spectra_shm, baseline_shm)]
+        tasks = [(br, bands, blocks[0], blocks[1], s, s + step, segment, decimate, refine_iters) for s in starts]
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            n_iters = list(pool.map(_fit_chunk, tasks))
+        baseline = np.ndarray(intensities.shape, dtype=np.float64, buffer=baseline_shm.buf).copy()
+        return baseline, _concat_iters(n_iters)
+    finally:
+        for shm in (spectra_shm, baseline_shm):
+            shm.close()
+            shm.unlink()
+
+
 def _segment(x, y):
     '''Splits y into segments based on sharp jumps in x.
     Returns an iterable of chunks of (x,y)'''
@@ -73,17 +305,21 @@ def iterative_threshold(signal, num_stds=3):
     return ~mask
 
 
-class WhittakerSmoother(object):
-    def __init__(self, signal, smoothness_param, deriv_order=1):
-        self.y = signal
-        assert deriv_order > 0, 'deriv_order must be an int > 0'
+def whittaker_bands(n, smoothness_param, deriv_order=1):
+    '''Returns the upper bands of s * D.T.dot(D), where D is the deriv_order
+    difference matrix of length n, in the (deriv_order + 1, n) form used by
+    scipy.linalg.solveh_banded. The bands only depend on their arguments, so
+    the most recently used ones are cached and returned read-only.'''
+    assert deriv_order > 0, 'deriv_order must be an int > 0'
+    key = (int(n), float(smoothness_param), int(deriv_order))
+    upper_bands = _penalty_bands.pop(key, None)
+    if upper_bands is None:
+        n, s, deriv_order = key
         # Compute the fixed derivative of identity (D).
         d = np.zeros(deriv_order * 2 + 1, dtype=int)
         d[deriv_order] = 1
         d = np.diff(d, n=deriv_order)
-        n = self.y.shape[0]
         k = len(d)
-        s = float(smoothness_param)
 
         # Here be dragons: essentially we're faking a big banded matrix D,
         # doing s * D.T.dot(D) with it, then taking the upper triangular bands.
@@ -94,9 +330,63 @@ class WhittakerSmoother(object):
         upper_bands[:, :k] = diag_sums
         for i, ds in enumerate(diag_sums):
             upper_bands[i, -i - 1:] = ds[::-1][:i + 1]
+        upper_bands.flags.writeable = False
+    _penalty_bands[key] = upper_bands
+    while len(_penalty_bands) > _MAX_PENALTY_BANDS:
+        _penalty_bands.popitem(last=False)
+    return upper_bands
+
+
+class _BandedWhittakerSolver(object):
+    '''Solves the Whittaker system (P + diag(w)) z = w * y for the penalty
+    bands P, one spectrum at a time, with the LAPACK routines for symmetric
+    positive definite band matrices. Order 1 systems are tridiagonal and use
+    dpttrf and dpttrs, higher orders the banded Cholesky dpbtrf and dpbtrs.
+    The work buffers are allocated once and reused by every solve.'''
+    def __init__(self, upper_bands):
         self.upper_bands = upper_bands
+        self.order = upper_bands.shape[0] - 1
+        self._allocate()
+
+    def _allocate(self):
+        n = self.upper_bands.shape[1]
+        self.rhs = np.empty(n)
+        if self.order == 1:
+            self.d = np.empty(n)
+            self.e = np.empty(max(n - 1, 0))
+        else:
+            # In Fortran order, so that dpbtrf factors it in place
+            self.ab = np.empty(self.upper_bands.shape, order='F')
+
+    def solve(self, w, y):
+        '''w, y: weights and signal of length n
+           Returns the solution z, a view of the work buffers that is
+           overwritten by the next solve. Raises numpy.linalg.LinAlgError if
+           the system is not positive definite.
+        '''
+        np.multiply(w, y, out=self.rhs)
+        if self.order == 1:
+            np.add(self.upper_bands[1], w, out=self.d)
+            self.e[:] = self.upper_bands[0, 1:]
+            d, e, info = dpttrf(self.d, self.e, overwrite_d=1, overwrite_e=1)
+            if info == 0:
+                z, info = dpttrs(d, e, self.rhs, overwrite_b=1)
+        else:
+            self.ab[:] = self.upper_bands
+            self.ab[-1] += w  # last row is the diagonal
+            ab, info = dpbtrf(self.ab, overwrite_ab=1)
+            if info == 0:
+                z, info = dpbtrs(ab, self.rhs, overwrite_b=1)
+        if info != 0:
+            raise np.linalg.LinAlgError('Whittaker system is not positive definite (LAPACK info %d)' % info)
+        return z
+
+
+class WhittakerSmoother(object):
+    def __init__(self, signal, smoothness_param, deriv_order=1):
+        self.y = signal
+        self.upper_bands = whittaker_bands(self.y.shape[0], smoothness_param, deriv_order)
+        self._solver = _BandedWhittakerSolver(self.upper_bands)
 
     def smooth(self, w):
-        foo = self.upper_bands.copy()
-        foo[-1] += w  # last row is the diagonal
-        return solveh_banded(foo, w * self.y, overwrite_ab=True, overwrite_b=True)
+        return self._solver.solve(w, self.y).copy()
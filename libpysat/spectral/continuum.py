@@ -115,3 +115,62 @@ def cubic(spectrum, nodes):
 correction_methods = {'linear': linear,
                       'regression': regression,
                       'cubic': cubic}
+
+
+def continuum_correct_many(x, spectra, nodes=None, method='linear'):
+    """
+    Apply a continuum correction to many spectra at once
+
+    Parameters
+    ==========
+    x : array_like
+        The (increasing) wavelengths
+
+    spectra : ndarray
+              (nspectra, nwavelengths) array
+
+    nodes: list
+           A list of the nodes between which piecewise continuum
+           will be fit. The first segment is extended to the start of the
+           spectrum and the last to the end, as in continuum_correct.
+
+    method : {'linear', 'regression'}
+             'linear' joins the values at the ends of each segment and
+             'regression' is an Ordinary Least Squares fit to each segment.
+
+    Returns
+    =======
+     : ndarray
+       The continuum corrected spectra
+
+     : ndarray
+       The continua
+    """
+    x = np.asarray(x, dtype=np.float64)
+    spectra = np.asarray(spectra, dtype=np.float64)
+    if not nodes:
+        nodes = [x[0], x[-1]]
+
+    continuum = np.empty_like(spectra)
+    # the segment each wavelength is corrected with, a wavelength on a node belongs to the segment below it
+    segment = np.searchsorted(np.asarray(nodes[1:-1], dtype=np.float64), x, side='left')
+    for i, (n0, n1) in enumerate(zip(nodes, nodes[1:])):
+        idx = np.flatnonzero((x >= n0) & (x <= n1))
+        if method == 'linear':
+            y1 = spectra[:, idx[0]]
+            y2 = spectra[:, idx[-1]]
+            m = (y2 - y1) / (x[idx[-1]] - x[idx[0]])
+            b = y1 - m * x[idx[0]]
+        elif method == 'regression':
+            nx = x[idx]
+            ny = spectra[:, idx]
+            xmean = nx.mean()
+            ymean = ny.mean(axis=1)
+            m = ((nx - xmean) * (ny - ymean[:, np.newaxis])).sum(axis=1) / ((nx - xmean) ** 2).sum()
+            b = ymean - m * xmean
+        else:
+            raise ValueError('Unsupported continuum method: {}'.format(method))
+        cols = segment == i
+        continuum[:, cols] = m[:, np.newaxis] * x[cols] + b[:, np.newaxis]
+
+    return spectra / continuum, continuum
@@ -0,0 +1,130 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from libpysat.spectral import analytics
+from libpysat.spectral.continuum import continuum_correct_many
+from libpysat.utils.utils import effective_n_jobs
+
+# The maps produced by band_parameter_maps
+BAND_PARAMETERS = ['band_minimum', 'band_minimum_value', 'band_center', 'band_area', 'band_asymmetry']
+
+
+def _process_tile(args):
+    # Continuum correct every pixel of a (lines, samples, bands) tile and compute the band parameters
+    tile, wavelengths, low, high, nodes, method, degree = args
+    lines, samples, bands = tile.shape
+    spectra = tile.reshape(-1, bands).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corrected, _ = continuum_correct_many(wavelengths, spectra, nodes=nodes, method=method)
+        minimum, minimum_value = analytics.band_minima_many(wavelengths, corrected, low, high)
+        center, _ = analytics.band_center_many(wavelengths, corrected, low, high, degree=degree)
+        area = analytics.band_area_many(wavelengths, corrected, low, high)
+        asymmetry = analytics.band_asymmetry_many(wavelengths, corrected, low, high, center=center)
+    maps = [minimum, minimum_value, center, area, asymmetry]
+    return np.stack(maps).reshape(len(maps), lines, samples)
+
+
+def band_parameter_maps(cube, low_endmember=None, high_endmember=None, nodes=None, method='linear', degree=3,
+                        wavelengths=None, max_bytes=2 ** 26, n_jobs=1, outpath=None):
+    """
+    Map band parameters over a spectral cube, a tile of whole lines at a time
+
+    Every pixel of a tile is continuum corrected (see continuum.continuum_correct_many)
+    and its band minimum, center, area and asymmetry between the end members computed
+    (see the *_many functions in analytics). Only a few tiles are in memory at once, so
+    peak memory depends on max_bytes and n_jobs rather than on the size of the image.
+
+    Parameters
+    ----------
+    cube : object
+           A (lines, samples, bands) array, or any object with a shape attribute
+           that returns (lines, samples, bands) windows when sliced by line, such
+           as a libpysat.fileio.io_moon_minerology_mapper.M3Cube
+
+    low_endmember, high_endmember : float
+                                    The wavelength range of the band
+
+    nodes : list
+            The continuum nodes, see continuum.continuum_correct_many
+
+    method : {'linear', 'regression'}
+             The continuum method
+
+    degree : int
+             The degree of the polynomial fit to find the band center
+
+    wavelengths : array_like
+                  The wavelength of each band, by default cube.wavelengths
+
+    max_bytes : int
+                The approximate size of each tile in memory
+
+    n_jobs : int
+             The number of worker processes the tiles are spread across, see
+             libpysat.utils.utils.effective_n_jobs
+
+    outpath : str
+              If given, each map is written to outpath/<parameter>.npy as it is
+              computed, and the returned maps are memory mapped from those files
+
+    Returns
+    -------
+    maps : dict
+           parameter name (see BAND_PARAMETERS) -> (lines, samples) array
+    """
+    if wavelengths is None:
+        wavelengths = cube.wavelengths
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    order = np.argsort(wavelengths, kind='mergesort')
+    if np.all(order == np.arange(len(order))):
+        order = None
+    else:
+        wavelengths = wavelengths[order]
+
+    lines, samples, bands = cube.shape
+    if outpath is not None:
+        if not os.path.isdir(outpath):
+            os.makedirs(outpath)
+        maps = {p: np.lib.format.open_memmap(os.path.join(outpath, p + '.npy'), mode='w+', dtype=np.float64,
+                                             shape=(lines, samples))
+                for p in BAND_PARAMETERS}
+    else:
+        maps = {p: np.empty((lines, samples)) for p in BAND_PARAMETERS}
+
+    step = max(1, int(max_bytes // (samples * bands * 8)))
+    starts = list(range(0, lines, step))
+
+    def task(start):
+        tile = np.asarray(cube[start:start + step])
+        if order is not None:
+            tile = tile[:, :, order]
+        return tile, wavelengths, low_endmember, high_endmember, nodes, method, degree
+
+    def store(start, result):
+        for p, values in zip(BAND_PARAMETERS, result):
+            maps[p][start:start + values.shape[0]] = values
+
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs > 1 and len(starts) > 1:
+        # only a couple of tiles per worker are read ahead, to bound memory
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            pending = deque()
+            for start in starts:
+                pending.append((start, pool.submit(_process_tile, task(start))))
+                if len(pending) >= n_jobs * 2:
+                    start, future = pending.popleft()
+                    store(start, future.result())
+            while pending:
+                start, future = pending.popleft()
+                store(start, future.result())
+    else:
+        for start in starts:
+            store(start, _process_tile(task(start)))
+
+    if outpath is not None:
+        for m in maps.values():
+            m.flush()
+    return maps
@@ -0,0 +1,112 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from libpysat.utils.utils import file_signature
+
+# masks read by read_mask, keyed on the file, so that each mask file is parsed once per process.
+# Most recently used last.
+_masks = OrderedDict()
+_MAX_MASKS = 16
+
+
+class WavelengthMask(object):
+    """
+    A set of wavelength ranges to mask out of spectra. The ranges are resolved to
+    columns once for each wavelength grid the mask is used with, and reused after that.
+
+    Attributes
+    ----------
+    ranges : ndarray
+             (n, 2) array of the (min, max) wavelength of each range, inclusive
+    """
+
+    # the number of wavelength grids each mask remembers
+    max_grids = 8
+
+    def __init__(self, ranges):
+        self.ranges = np.asarray(ranges, dtype=np.float64).reshape(-1, 2)
+        self._grids = OrderedDict()
+
+    def masked(self, wvl):
+        """
+        Return a boolean array that is True for the wavelengths in any of the ranges
+
+        Parameters
+        ----------
+        wvl : array_like
+              The wavelength grid
+
+        Returns
+        -------
+        masked : ndarray
+                 Read only boolean array, the same length as wvl
+        """
+        wvl = np.ascontiguousarray(wvl, dtype=np.float64)
+        key = wvl.tobytes()
+        masked = self._grids.pop(key, None)
+        if masked is None:
+            masked = np.zeros(len(wvl), dtype=bool)
+            if np.all(wvl[1:] >= wvl[:-1]):
+                # a sorted grid: each range is a block of columns
+                for start, stop in self.slices(wvl):
+                    masked[start:stop] = True
+            else:
+                for low, high in self.ranges:
+                    masked |= (wvl >= low) & (wvl <= high)
+            masked.flags.writeable = False
+        self._grids[key] = masked
+        while len(self._grids) > self.max_grids:
+            self._grids.popitem(last=False)
+        return masked
+
+    def slices(self, wvl):
+        """
+        Return the (start, stop) column range of each mask range on a sorted wavelength grid
+
+        Parameters
+        ----------
+        wvl : array_like
+              The sorted wavelength grid
+
+        Returns
+        -------
+        slices : list
+                 (start, stop) tuples, one per range, that may be empty or overlap
+        """
+        starts = np.searchsorted(wvl, self.ranges[:, 0], side='left')
+        stops = np.maximum(starts, np.searchsorted(wvl, self.ranges[:, 1], side='right'))
+        return list(zip(starts.tolist(), stops.tolist()))
+
+
+def read_mask(maskfile, sep=','):
+    """
+    Read a mask file with min_wvl and max_wvl columns, reusing the mask read by an
+    earlier call if the file is unchanged
+
+    Parameters
+    ----------
+    maskfile : str
+               PATH to the mask file
+
+    sep : str
+          The field separator
+
+    Returns
+    -------
+    mask : WavelengthMask
+    """
+    path = os.path.abspath(maskfile)
+    signature = file_signature(path)
+    cached = _masks.pop((path, sep), None)
+    if cached is not None and cached[0] == signature:
+        mask = cached[1]
+    else:
+        ranges = pd.read_csv(path, sep=sep)
+        mask = WavelengthMask(np.column_stack([ranges['min_wvl'].values, ranges['max_wvl'].values]))
+    _masks[(path, sep)] = (signature, mask)
+    while len(_masks) > _MAX_MASKS:
+        _masks.popitem(last=False)
+    return mask
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+# The methods a Resampler can be built with
+RESAMPLE_METHODS = ('linear', 'bin')
+
+# Resamplers built by get_resampler, most recently used last
+_resamplers = OrderedDict()
+_MAX_RESAMPLERS = 16
+
+
+def _bin_edges(x):
+    # The edges of bins centered on the sorted points x: half way between neighbours, with the outer bins
+    # as wide as their neighbours
+    if len(x) < 2:
+        raise ValueError('At least two wavelengths are needed to define bins')
+    mid = (x[1:] + x[:-1]) / 2
+    return np.concatenate([[2 * x[0] - mid[0]], mid, [2 * x[-1] - mid[-1]]])
+
+
+def _linear_weights(source, target):
+    # Weights of the two neighbouring source points of each target, for targets strictly inside the source range
+    valid = (target > source[0]) & (target < source[-1])
+    rows = np.where(valid)[0]
+    hi = np.clip(np.searchsorted(source, target[rows], side='right'), 1, len(source) - 1)
+    lo = hi - 1
+    dx = source[hi] - source[lo]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(dx > 0, (target[rows] - source[lo]) / dx, 0)
+    return np.concatenate([rows, rows]), np.concatenate([lo, hi]), np.concatenate([1 - t, t]), valid
+
+
+def _bin_weights(source, target):
+    # Each target bin is the width-weighted mean of the source bins it overlaps,
+    # for target bins that lie entirely within the source bins
+    source_edges = _bin_edges(source)
+    target_edges = _bin_edges(target)
+    valid = (target_edges[:-1] >= source_edges[0]) & (target_edges[1:] <= source_edges[-1])
+    targets = np.where(valid)[0]
+    first = np.clip(np.searchsorted(source_edges, target_edges[targets], side='right') - 1, 0, len(source) - 1)
+    last = np.clip(np.searchsorted(source_edges, target_edges[targets + 1], side='left') - 1, 0, len(source) - 1)
+    counts = np.maximum(last - first + 1, 0)
+
+    # one entry per (target, overlapping source bin) pair
+    pairs = np.repeat(np.arange(len(targets)), counts)
+    offsets = np.arange(len(pairs)) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = targets[pairs]
+    cols = first[pairs] + offsets
+    overlap = np.minimum(source_edges[cols + 1], target_edges[rows + 1]) - \
+              np.maximum(source_edges[cols], target_edges[rows])
+    weights = np.maximum(overlap, 0) / (target_edges[rows + 1] - target_edges[rows])
+    return rows, cols, weights, valid
+
+
+class Resampler(object):
+    """
+    A linear operator that resamples spectra from a source wavelength grid onto a
+    target grid, stored as a sparse (target x source) weight matrix so that applying
+    it is a single sparse-dense product. Build it once and apply it to any number of
+    spectra on the same source grid; see get_resampler for a cached constructor.
+
+    Attributes
+    ----------
+    source, target : ndarray
+                     The source and target wavelengths
+
+    method : str
+             'linear' interpolates between the two neighbouring source points. Targets
+             outside the open interval (source.min(), source.max()) are NaN.
+
+             'bin' treats both grids as bin centers (with edges half way between
+             neighbouring points) and sets each target bin to the mean of the source
+             bins it overlaps, weighted by the overlap. This conserves the integrated
+             flux, so it is the method to use to bring finely sampled spectra down to a
+             coarser grid. Target bins not entirely covered by the source are NaN.
+
+    matrix : scipy.sparse.csr_matrix
+             The (len(target), len(source)) weights
+
+    valid : ndarray
+            True for the targets that get a value, False for those set to NaN
+    """
+
+    def __init__(self, source, target, method='linear'):
+        if method not in RESAMPLE_METHODS:
+            raise ValueError('method must be one of {}, not {}'.format(RESAMPLE_METHODS, method))
+        self.source = source = np.asarray(source, dtype=np.float64)
+        self.target = target = np.asarray(target, dtype=np.float64)
+        self.method = method
+
+        # the weights are found on sorted copies of the grids, then mapped back to the original order
+        source_order = np.argsort(source, kind='mergesort')
+        target_order = np.argsort(target, kind='mergesort')
+        build = _linear_weights if method == 'linear' else _bin_weights
+        rows, cols, weights, valid = build(source[source_order], target[target_order])
+
+        keep = weights != 0
+        self.matrix = sparse.csr_matrix((weights[keep], (target_order[rows[keep]], source_order[cols[keep]])),
+                                        shape=(len(target), len(source)))
+        self.valid = np.empty(len(target), dtype=bool)
+        self.valid[target_order] = valid
+
+    def apply(self, spectra, chunksize=256):
+        """
+        Resample spectra onto the target grid
+
+        Parameters
+        ----------
+        spectra : array_like
+                  A (spectra x source wavelengths) array, or a single spectrum
+
+        chunksize : int
+                    The number of spectra multiplied at a time, which bounds the
+                    temporary memory used
+
+        Returns
+        -------
+        resampled : ndarray
+                    (spectra x target wavelengths) array, or a single spectrum
+        """
+        spectra = np.asarray(spectra, dtype=np.float64)
+        if spectra.ndim == 1:
+            return self.apply(spectra[None, :])[0]
+        if spectra.shape[1] != len(self.source):
+            raise ValueError('Expected spectra with {} wavelengths, got {}'.format(len(self.source), spectra.shape[1]))
+
+        resampled = np.empty((spectra.shape[0], len(self.target)))
+        for start in range(0, spectra.shape[0], chunksize):
+            chunk = spectra[start:start + chunksize]
+            resampled[start:start + chunksize] = self.matrix.dot(chunk.T).T
+        resampled[:, ~self.valid] = np.nan
+        return resampled
+
+
+def get_resampler(source, target, method='linear'):
+    """
+    Return a Resampler from source to target, reusing the one built by an earlier
+    call with the same grids and method. The most recently used resamplers are kept.
+
+    Parameters
+    ----------
+    source, target : array_like
+                     The source and target wavelengths
+
+    method : {'linear', 'bin'}
+             See Resampler
+
+    Returns
+    -------
+    resampler : Resampler
+    """
+    source = np.ascontiguousarray(source, dtype=np.float64)
+    target = np.ascontiguousarray(target, dtype=np.float64)
+    key = (method, source.tobytes(), target.tobytes())
+    resampler = _resamplers.pop(key, None)
+    if resampler is None:
+        resampler = Resampler(source, target, method=method)
+    _resamplers[key] = resampler
+    while len(_resamplers) > _MAX_RESAMPLERS:
+        _resamplers.popitem(last=False)
+    return resampler
@@ -4,6 +4,9 @@ Created on Fri Dec  4 14:53:23 2015
 
 @author: rbanderson
 """
+import json
+import os
+
 import numpy as np
 import pandas as pd
 import scipy as sp
@@ -20,6 +23,8 @@ from libpysat.spectral.baseline_code.polyfit import PolyFit
 from libpysat.spectral.baseline_code.rubberband import Rubberband
 from libpysat.spectral.jade import jadeR as jade
 from libpysat.spectral.lra import low_rank_align as LRA
+from libpysat.spectral.mask import WavelengthMask, read_mask
+from libpysat.spectral.resample import get_resampler
 from sklearn import cross_validation
 from sklearn.decomposition import PCA, FastICA
 from sklearn.preprocessing import StandardScaler
@@ -29,57 +34,310 @@ from sklearn.manifold.t_sne import TSNE
 from sklearn.manifold.locally_linear import LocallyLinearEmbedding
 
 
-def norm_total(df):
-    df = df.div(df.sum(axis=1), axis=0)
-    return df
+_BINARY_LAYOUT_VERSION = 1
 
+# Preset ranges for norm(): the ChemCam spectrometers normalized together ('norm1') or each on its own ('norm3')
+NORM_RANGES = {'norm1': [(240.1, 906.5)],
+               'norm3': [(240.1, 342.2), (382.1, 469.3), (474.0, 906.5)]}
 
-class spectral_data(object):
-    def __init__(self, df):
-
-        try:
-            uppercols = df.columns.levels[0]
-            lowercols = list(df.columns.levels[1].values)
-        except:
-            df.columns = pd.MultiIndex.from_tuples(list(df.columns))
-            uppercols = df.columns.levels[0]
-            lowercols = list(df.columns.levels[1].values)
-
-        for i, val in enumerate(lowercols):
-            try:
-                lowercols[i] = float(val)
-            except:
-                lowercols[i] = val
 
-        levels = [uppercols, lowercols]
-        df.columns.set_levels(levels, inplace=True)
-        self.df = df
+def _to_json_label(label):
+    # numpy scalars in column labels aren't JSON serializable
+    if isinstance(label, np.generic):
+        return label.item()
+    return label
 
-    def interp(self, xnew):
-        xnew = np.array(xnew, dtype='float')
 
-        metadata_cols = self.df.columns.levels[0] != 'wvl'
-        metadata = self.df[self.df.columns.levels[0][metadata_cols]]
-        old_wvls = np.array(self.df['wvl'].columns, dtype='float')
-        old_spectra = np.array(self.df['wvl'])
-        new_spectra = np.empty([len(old_spectra[:, 0]), len(xnew)]) * np.nan
-        interp_index = (xnew > min(old_wvls)) & (xnew < max(old_wvls))
+def norm_total(df):
+    df = df.div(df.sum(axis=1), axis=0)
+    return df
 
-        f = sp.interpolate.interp1d(old_wvls, old_spectra, axis=1)
-        new_spectra[:, interp_index] = f(xnew[interp_index])
 
-        xnew = list(xnew)
-        for i, x in enumerate(xnew):
-            xnew[i] = ('wvl', x)
+def _label(val):
+    # column labels that look like numbers (e.g. wavelengths read from a csv header) are stored as floats
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return val
+
+
+def _empty_columns():
+    return pd.MultiIndex.from_arrays([[], []])
+
+
+def _split_frame(df):
+    # Split a data frame with two level columns into (spectra, wavelengths, other columns, position of the
+    # spectra among the other columns). The 'wvl' columns become one contiguous float array.
+    columns = df.columns
+    if not isinstance(columns, pd.MultiIndex):
+        columns = pd.MultiIndex.from_tuples(list(columns))
+    upper = np.asarray(columns.get_level_values(0), dtype=object)
+    lower = np.array([_label(val) for val in columns.get_level_values(1)], dtype=object)
+
+    is_wvl = upper == 'wvl'
+    wvl = np.asarray(lower[is_wvl], dtype=np.float64)
+    spectra = np.asarray(df.iloc[:, np.where(is_wvl)[0]].values, dtype=np.float64)
+    other = df.iloc[:, np.where(~is_wvl)[0]].copy()
+    other.columns = pd.MultiIndex.from_arrays([upper[~is_wvl], lower[~is_wvl]]) if len(other.columns) \
+        else _empty_columns()
+    wvl_pos = int(np.argmax(is_wvl)) if is_wvl.any() else len(other.columns)
+    return spectra, wvl, other, wvl_pos
+
+
+def _take_columns(arr, cols):
+    # arr[:, cols], copied a run of consecutive columns at a time. For the few long runs of a wavelength
+    # mask this is much faster than fancy indexing, which gathers element by element.
+    cols = np.asarray(cols, dtype=int)
+    breaks = np.where(np.diff(cols) != 1)[0] + 1
+    if not len(cols) or len(breaks) > 64:
+        return arr[:, cols]
+    starts = np.r_[0, breaks]
+    stops = np.r_[breaks, len(cols)]
+    return np.concatenate([arr[:, cols[a]:cols[b - 1] + 1] for a, b in zip(starts, stops)], axis=1)
+
+
+def _row_sums(arr):
+    # the sum of each row, ignoring NaNs (as pandas does), without the copy nansum makes when there are none
+    sums = arr.sum(axis=1)
+    bad = np.isnan(sums)
+    if bad.any():
+        sums[bad] = np.nansum(arr[bad], axis=1)
+    return sums
+
+
+def _segment_sums(spectra, segments):
+    # The sum of each row over each (start, stop) column segment, in one pass over the array with reduceat.
+    # The segments must be sorted, non-empty and not overlap. NaNs are ignored, as pandas does.
+    bounds = [i for segment in segments for i in segment]
+    if bounds[-1] == spectra.shape[1]:
+        bounds = bounds[:-1]
+    # reduceat also sums the gaps between the segments, which are dropped
+    sums = np.add.reduceat(spectra, bounds, axis=1)[:, ::2]
+    for k, (start, stop) in enumerate(segments):
+        bad = np.isnan(sums[:, k])
+        if bad.any():
+            sums[bad, k] = np.nansum(spectra[bad, start:stop], axis=1)
+    return sums
+
+
+def _join_frame(spectra, wvl, other, wvl_pos):
+    # The inverse of _split_frame: one data frame with the spectra under 'wvl', placed among the other columns
+    columns = pd.MultiIndex.from_arrays([['wvl'] * len(wvl), wvl])
+    df_spectra = pd.DataFrame(spectra, index=other.index, columns=columns, copy=False)
+    if not len(other.columns):
+        return df_spectra
+    parts = [other.iloc[:, :wvl_pos], df_spectra, other.iloc[:, wvl_pos:]]
+    return pd.concat([p for p in parts if len(p.columns)], axis=1)
 
-        new_df = pd.DataFrame(new_spectra, columns=pd.MultiIndex.from_tuples(xnew), index=self.df.index)
-        new_df = pd.concat([new_df, metadata], axis=1)
 
-        self.df = new_df
+class spectral_data(object):
+    # The spectra are held as a contiguous (spectra x wavelengths) float array with a sorted wavelength vector,
+    # and all other columns (metadata, compositions, results) in a separate data frame. The methods below work
+    # on those arrays directly. The combined data frame (self.df) is only built when it is asked for; after
+    # that the data frame is the master copy (so it can be edited in place) until the next method call
+    # splits it into arrays again.
+    def __init__(self, df):
+        self._df = None
+        self._baseline = None
+        self._set_arrays(*_split_frame(df))
+
+    # Build a spectral_data object directly from arrays, without going through a data frame.
+    # spectra is (spectra x wavelengths) and is not copied if it is already a contiguous float array
+    # with sorted wavelengths, so methods such as norm() may modify it in place.
+    # other is an optional data frame of the non-spectral columns.
+    @classmethod
+    def from_arrays(cls, spectra, wvl, other=None, index=None):
+        data = cls.__new__(cls)
+        data._df = None
+        data._baseline = None
+        if other is None:
+            other = pd.DataFrame(index=index if index is not None else pd.RangeIndex(len(spectra)),
+                                 columns=_empty_columns())
+        elif not isinstance(other.columns, pd.MultiIndex):
+            other = other.copy()
+            other.columns = pd.MultiIndex.from_tuples(list(other.columns)) if len(other.columns) \
+                else _empty_columns()
+        if index is not None:
+            other = other.copy()
+            other.index = index
+        data._set_arrays(spectra, wvl, other, len(other.columns))
+        return data
+
+    def _set_arrays(self, spectra, wvl, other, wvl_pos):
+        wvl = np.asarray(wvl, dtype=np.float64)
+        spectra = np.asarray(spectra, dtype=np.float64)
+        if spectra.ndim != 2 or spectra.shape != (len(other.index), len(wvl)):
+            raise ValueError('spectra must have one row per row of the other columns and one column per wavelength')
+        order = np.argsort(wvl, kind='mergesort')
+        if np.any(order != np.arange(len(wvl))):
+            wvl = wvl[order]
+            spectra = spectra[:, order]
+        self._spectra = np.ascontiguousarray(spectra)
+        self._wvl = wvl
+        self._other = other
+        self._wvl_pos = wvl_pos
+        # columns of the spectra still to be kept by a pending mask(), or None
+        self._active = None
+
+    def _sync_frame(self):
+        # make the arrays the master copy again if the data frame has been handed out
+        if self._df is not None:
+            self._set_arrays(*_split_frame(self._df))
+            self._df = None
+
+    def _sync(self):
+        # as _sync_frame, and move the columns masked out by mask() out of the spectra
+        self._sync_frame()
+        if self._active is not None:
+            active = self._active
+            self._active = None
+            if not active.all():
+                self._copy_to_other(~active)
+                self._spectra = _take_columns(self._spectra, np.where(active)[0])
+                self._wvl = self._wvl[active]
+
+    @property
+    def df(self):
+        if self._df is None:
+            self._sync()
+            self._df = _join_frame(self._spectra, self._wvl, self._other, self._wvl_pos)
+            # the data frame now holds the only copy of the data
+            self._spectra = self._wvl = self._other = None
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+        self._spectra = self._wvl = self._other = self._active = None
+
+    # The spectra as a (spectra x wavelengths) float array
+    @property
+    def spectra(self):
+        self._sync()
+        return self._spectra
+
+    # The sorted wavelengths of the spectra
+    @property
+    def wvl(self):
+        self._sync()
+        return self._wvl
+
+    # The baselines found by remove_baseline, as a data frame laid out like self.df
+    @property
+    def df_baseline(self):
+        if self._baseline is None:
+            raise AttributeError('df_baseline is only available after remove_baseline()')
+        return _join_frame(*self._baseline)
+
+    def _wvl_slice(self, low, high):
+        # the columns with low <= wavelength <= high
+        start = np.searchsorted(self._wvl, low, side='left')
+        stop = np.searchsorted(self._wvl, high, side='right')
+        return slice(start, max(start, stop))
+
+    def _column(self, key):
+        # a single column, as a Series
+        if key[0] == 'wvl':
+            idx = np.searchsorted(self._wvl, _label(key[1]))
+            if idx == len(self._wvl) or self._wvl[idx] != _label(key[1]):
+                raise KeyError(key)
+            return pd.Series(self._spectra[:, idx], index=self._other.index)
+        return self._other[key]
+
+    def _values(self, col):
+        # the values of a column, a group of columns (e.g. 'wvl' or 'comp') or a list of columns, as an array
+        if isinstance(col, str) and col == 'wvl':
+            return self._spectra
+        try:
+            return self._other[col].values
+        except KeyError:
+            return _join_frame(self._spectra, self._wvl, self._other, self._wvl_pos)[col].values
+
+    def _take(self, rows):
+        # a new object holding the given rows
+        other = self._other.take(rows)
+        data = spectral_data.from_arrays(self._spectra[rows], self._wvl, other)
+        data._wvl_pos = self._wvl_pos
+        return data
+
+    def _copy_to_other(self, masked, name='masked'):
+        # copy the spectral columns where masked is True to the end of the other columns, under the given name
+        if masked.any():
+            block = pd.DataFrame(_take_columns(self._spectra, np.where(masked)[0]), index=self._other.index,
+                                 columns=pd.MultiIndex.from_arrays([[name] * int(masked.sum()), self._wvl[masked]]))
+            self._other = pd.concat([self._other, block], axis=1)
+
+    # This function saves the data in a binary layout that can be memory mapped when it is read back:
+    # a contiguous float array of the spectra, the wavelength vector, and one array per remaining column.
+    # The column order and index are recorded in a small JSON file.
+    def save(self, path):
+        self._sync()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'spectra.npy'), self._spectra)
+        np.save(os.path.join(path, 'wvl.npy'), self._wvl)
+        np.save(os.path.join(path, 'index.npy'), np.asarray(self._other.index.values), allow_pickle=True)
+
+        other_cols = list(self._other.columns)
+        columns = other_cols[:self._wvl_pos] + [('wvl', w) for w in self._wvl] + other_cols[self._wvl_pos:]
+        columns = [[col[0], _to_json_label(col[1])] for col in columns]
+        table = []
+        for i, col in enumerate(other_cols):
+            # numbered by position in the full column list, as earlier versions of save() wrote them
+            filename = 'col{}.npy'.format(i if i < self._wvl_pos else i + len(self._wvl))
+            np.save(os.path.join(path, filename), np.asarray(self._other.iloc[:, i].values), allow_pickle=True)
+            table.append(filename)
+
+        layout = {'version': _BINARY_LAYOUT_VERSION, 'columns': columns, 'table': table,
+                  'index_name': self._other.index.name}
+        with open(os.path.join(path, 'layout.json'), 'w') as f:
+            json.dump(layout, f)
+
+    # This function reads data written by save(). With mmap=True the arrays are memory mapped copy-on-write,
+    # so nothing is read from disk until it is used and the files are never modified.
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, 'layout.json')) as f:
+            layout = json.load(f)
+        if layout['version'] != _BINARY_LAYOUT_VERSION:
+            raise ValueError('Unsupported spectral_data layout version: ' + str(layout['version']))
+        mmap_mode = 'c' if mmap else None
+
+        spectra = np.load(os.path.join(path, 'spectra.npy'), mmap_mode=mmap_mode)
+        wvls = np.load(os.path.join(path, 'wvl.npy'))
+        index = pd.Index(np.load(os.path.join(path, 'index.npy'), allow_pickle=True), name=layout['index_name'])
+
+        columns = [tuple(c) for c in layout['columns']]
+        other_cols = [c for c in columns if c[0] != 'wvl']
+        table = {}
+        for col, filename in zip(other_cols, layout['table']):
+            filename = os.path.join(path, filename)
+            try:
+                table[col] = np.load(filename, mmap_mode=mmap_mode)
+            except ValueError:
+                # object columns (e.g. strings) are pickled and can't be memory mapped
+                table[col] = np.load(filename, allow_pickle=True)
+
+        other = pd.DataFrame(table, index=index, columns=pd.MultiIndex.from_tuples(other_cols)) \
+            if other_cols else None
+        data = cls.from_arrays(spectra, wvls, other, index=None if other_cols else index)
+        is_wvl = [c[0] == 'wvl' for c in columns]
+        data._wvl_pos = is_wvl.index(True) if True in is_wvl else len(other_cols)
+        return data
+
+    # Resample the spectra onto new wavelengths, either by linear interpolation or, with method='bin', by
+    # flux conserving binning (see resample.Resampler). Wavelengths outside the range of the data are set to NaN.
+    # The resampling weights are cached, so resampling more data between the same grids is a single product.
+    def interp(self, xnew, method='linear'):
+        self._sync()
+        xnew = np.sort(np.array(xnew, dtype='float'))
+        self._spectra = get_resampler(self._wvl, xnew, method=method).apply(self._spectra)
+        self._wvl = xnew
 
     def cal_tran(self, refdata, matchcol_ref, matchcol_transform, method, methodparams):
+        self._sync()
         C_matrix = []
-        col = np.array([j.upper() for j in self.df[('meta', matchcol_transform)]])
+        col = np.array([j.upper() for j in self._column(('meta', matchcol_transform))])
         col_ref = np.array([j.upper() for j in refdata[('meta', matchcol_ref)]])
         for i in col:
             matches = np.where(col_ref == i, 1, 0)
@@ -88,7 +346,7 @@ class spectral_data(object):
         C_matrix = np.transpose(np.array(C_matrix))
 
         if method == 'LRA - Low Rank Alignment':
-            refdata_trans, transdata_trans = LRA(np.array(refdata['wvl']), np.array(self.df['wvl']), C_matrix,
+            refdata_trans, transdata_trans = LRA(np.array(refdata['wvl']), self._spectra, C_matrix,
                                                  methodparams['d'])
             refdata_trans = pd.DataFrame(refdata_trans)
             transdata_trans = pd.DataFrame(transdata_trans)
@@ -98,43 +356,42 @@ class spectral_data(object):
 
         pass
 
-    # This function masks out specified ranges of the data
+    # This function masks out specified ranges of the data. maskfile is a csv file of the min_wvl and max_wvl of
+    # each range, or a WavelengthMask. The masked columns are moved under 'masked'.
     def mask(self, maskfile, maskvar='wvl'):
-        df_spectra = self.df[maskvar]  # extract just the spectra from the data frame
-        metadata_cols = self.df.columns.levels[0] != maskvar  # extract just the metadata
-        metadata = self.df[self.df.columns.levels[0][metadata_cols]]
-
-        mask = pd.read_csv(maskfile, sep=',')  # read the mask file
-        tmp = []
-        for i in mask.index:
-            tmp.append((np.array(self.df[maskvar].columns, dtype='float') >= mask.ix[i, 'min_wvl']) & (
-                np.array(self.df[maskvar].columns, dtype='float') <= mask.ix[i, 'max_wvl']))
-
-        # combine the indexes for each range in the mask file into a single masking vector and use that to mask the spectra
-        masked = np.any(np.array(tmp), axis=0)
-        spectcols = list(df_spectra.columns)  # get the list of columns in the spectra dataframe
-        for i, j in enumerate(masked):  # change the first level of the tuple from 'wvl' to 'masked' where appropriate
-            if j == True:
-                spectcols[i] = ('masked', spectcols[i])
-            else:
-                spectcols[i] = (maskvar, spectcols[i])
-        df_spectra.columns = pd.MultiIndex.from_tuples(
-            spectcols)  # assign the multiindex columns based on the new tuples
-        self.df = pd.concat([df_spectra, metadata], axis=1)  # merge the masked spectra back with the metadata
+        mask = maskfile if isinstance(maskfile, WavelengthMask) else read_mask(maskfile)
+
+        if maskvar != 'wvl':
+            df_spectra = self.df[maskvar]  # extract just the spectra from the data frame
+            metadata_cols = self.df.columns.levels[0] != maskvar  # extract just the metadata
+            metadata = self.df[self.df.columns.levels[0][metadata_cols]]
+            masked = mask.masked(np.array(df_spectra.columns, dtype='float'))
+            # change the first level of the tuple from maskvar to 'masked' where appropriate
+            df_spectra.columns = pd.MultiIndex.from_arrays([np.where(masked, 'masked', maskvar),
+                                                            df_spectra.columns])
+            self.df = pd.concat([df_spectra, metadata], axis=1)  # merge the masked spectra back with the metadata
+            return
+
+        # Only the columns to keep are recorded here. The spectra are not copied until they are next used,
+        # so several masks in a row cost one copy.
+        self._sync_frame()
+        keep = ~mask.masked(self._wvl)
+        self._active = keep if self._active is None else self._active & keep
 
     def multiply_vector(self, vectorfile):
-        df_spectra = self.df['wvl']
+        self._sync()
         # TODO: check to make sure wavelengths match before multiplying
 
         vector = np.array(pd.read_csv(vectorfile, sep=',', header=None))[:, 1]
-        if df_spectra.shape[1] == vector.shape[0]:
-            self.df['wvl'] = df_spectra.multiply(vector, axis=1)
+        if self._spectra.shape[1] == vector.shape[0]:
+            self._spectra = self._spectra * vector
         else:
             print('Vector is not the same size as the spectra!')
 
     def peak_area(self, peaks_mins_file=None):
-        df = self.df  # create a copy of the data
-        wvls = df['wvl'].columns.values  # get the wavelengths
+        self._sync()
+        wvls = self._wvl  # get the wavelengths
+        spectra = self._spectra
 
         if peaks_mins_file is not None:
             peaks_mins = pd.read_csv(peaks_mins_file, sep=',')
@@ -142,14 +399,11 @@ class spectral_data(object):
             mins = peaks_mins['mins']
             pass
         else:
-            ave_spect = np.average(np.array(df['wvl']), axis=0)  # find the average of the spectra in the data frame
+            ave_spect = np.average(spectra, axis=0)  # find the average of the spectra in the data frame
             peaks = wvls[
                 sp.signal.argrelextrema(ave_spect, np.greater_equal)[0]]  # find the maxima in the average spectrum
             mins = wvls[sp.signal.argrelextrema(ave_spect, np.less_equal)[0]]  # find the maxima in the average spectrum
 
-        wvls = df['wvl'].columns.values  # get the wavelengths
-
-        spectra = np.array(df['wvl'])
         for i in range(len(peaks)):
 
             # get the wavelengths between two minima
@@ -163,21 +417,19 @@ class spectral_data(object):
             except:
                 high = mins[-1]
 
-            peak_indices = np.all((wvls > low, wvls < high), axis=0)
-            # plot.plot(wvls,ave_spect)
-            # plot.plot(wvls[peak_indices],ave_spect[peak_indices])
-            # plot.show()
-            df[('peak_area', peaks[i])] = spectra[:, peak_indices].sum(axis=1)
+            # the wavelengths are sorted, so the peak is a contiguous block of columns
+            start = np.searchsorted(wvls, low, side='right')
+            stop = max(start, np.searchsorted(wvls, high, side='left'))
+            self._other[('peak_area', peaks[i])] = spectra[:, start:stop].sum(axis=1)
 
-        self.df = df
         return peaks, mins
 
     # This function divides the data up into a specified number of random folds
     def random_folds(self, nfolds=5, seed=10, groupby=None):
-        self.df[('meta', 'Folds')] = np.nan  # Create an entry in the data frame that holds the folds
-        foldslist = np.array(self.df[('meta', 'Folds')])
+        self._sync()
+        foldslist = np.full(len(self._other.index), np.nan)  # holds the folds
         if groupby == None:  # if no column name is listed to group on, just create random folds
-            n = len(self.df.index)
+            n = len(self._other.index)
             folds = cross_validation.KFold(n, nfolds, shuffle=True, random_state=seed)
             i = 1
             for train, test in folds:
@@ -188,46 +440,39 @@ class spectral_data(object):
             # if a column name is provided, get all the unique values and define folds
             # so that all rows of a given value fall in the same fold
             # (this is useful to ensure that training and test data are truly independent)
-            unique_inds = np.unique(self.df[groupby])
+            tmp_full_list = np.array(self._column(groupby))
+            unique_inds = np.unique(tmp_full_list)
             folds = cross_validation.KFold(len(unique_inds), nfolds, shuffle=True, random_state=seed)
-            foldslist = np.array(self.df[('meta', 'Folds')])
             i = 1
             for train, test in folds:
                 tmp = unique_inds[test]
-                tmp_full_list = np.array(self.df[groupby])
                 tmp_ind = np.in1d(tmp_full_list, tmp)
                 foldslist[tmp_ind] = i
                 i = i + 1
 
-        self.df[('meta', 'Folds')] = foldslist
+        self._other[('meta', 'Folds')] = foldslist
 
     # this function divides the data up into a specified number of folds, using sorting
     # To try to get folds that look similar to each other
     def stratified_folds(self, nfolds=5, sortby=None):
-        self.df[('meta', 'Folds')] = np.NaN  # Create an entry in the data frame that holds the folds
-        self.df.sort_values(by=sortby, inplace=True)  # sort the data frame by the column of interest
-        uniqvals = np.unique(self.df[sortby])  # get the unique values from the column of interest
-
-        # assign folds by stepping through the unique values
-        fold_num = 1
-        for i in uniqvals:
-            ind = self.df[sortby] == i  # find where the data frame matches the unique value
-            self.df.set_value(self.df.index[ind], ('meta', 'Folds'), fold_num)
-            # Inrement the fold number, reset to 1 if it is greater than the desired number of folds
-            fold_num = fold_num + 1
-            if fold_num > nfolds:
-                fold_num = 1
-
-        # sort by index to return the df to its original order
-        self.df.sort_index(inplace=True)
-        self.folds_hist(sortby,50)
-
+        self._sync()
+        values = np.array(self._column(sortby))
+        uniqvals, inverse = np.unique(values, return_inverse=True)  # get the unique values from the column of interest
+
+        # assign folds by stepping through the unique values in order,
+        # going back to fold 1 after the desired number of folds
+        folds = (inverse % nfolds + 1).astype(float)
+        if values.dtype.kind == 'f':
+            folds[np.isnan(values)] = np.nan
+        self._other[('meta', 'Folds')] = folds
+        self.folds_hist(sortby, 50)
 
     def folds_hist(self, col_to_plot, nbins, xlabel='wt.%', ylabel='# of spectra'):
-        folds_uniq = np.unique(self.df[('meta', 'Folds')])
+        self._sync()
+        folds = np.array(self._column(('meta', 'Folds')))
+        folds_uniq = np.unique(folds)
         for f in folds_uniq:
-            temp = self.rows_match(('meta', 'Folds'), [f])
-            vals = np.array(temp.df[col_to_plot])
+            vals = np.array(self._column(col_to_plot))[folds == f]
             bins = np.linspace(0, np.max(vals), nbins)
             plot.hist(vals, linewidth=0.5, edgecolor='k')
             plot.xlabel(xlabel)
@@ -237,8 +482,62 @@ class spectral_data(object):
             fig.savefig('hist_fold_' + str(f) + '_' + col_to_plot[1] + '.png')
             plot.close()
 
-    # This function normalizes specified ranges of the data by their respective sums
+    # This function normalizes specified ranges of the data by their respective sums.
+    # ranges is a list of (min, max) wavelengths, or the name of one of the NORM_RANGES presets.
+    # Columns outside all of the ranges are moved under 'masked'.
     def norm(self, ranges, col_var='wvl'):
+        if isinstance(ranges, str):
+            ranges = NORM_RANGES[ranges]
+        if col_var != 'wvl':
+            self._norm_frame(ranges, col_var)
+            return
+
+        self._sync()
+        # the wavelengths are sorted, so each range is a contiguous block of columns
+        blocks = [self._wvl_slice(low, high) for low, high in ranges]
+        used = np.zeros(len(self._wvl), dtype=bool)
+        for block in blocks:
+            used[block] = True
+
+        segments = sorted((block.start, block.stop) for block in blocks if block.stop > block.start)
+        if any(a[1] > b[0] for a, b in zip(segments[:-1], segments[1:])):
+            self._norm_overlapping(blocks, used)
+            return
+
+        # sum every range in one pass, then divide into a new array in a second one: the spectra may be
+        # shared with the caller of from_arrays, or be a read-only memory map
+        if segments:
+            sums = _segment_sums(self._spectra, segments)
+            spectra = np.empty_like(self._spectra)
+            prev = 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for k, (start, stop) in enumerate(segments):
+                    spectra[:, prev:start] = self._spectra[:, prev:start]
+                    np.divide(self._spectra[:, start:stop], sums[:, k:k + 1], out=spectra[:, start:stop])
+                    prev = stop
+            spectra[:, prev:] = self._spectra[:, prev:]
+            self._spectra = spectra
+        # the columns that are not in any range are moved out as if they were masked
+        if not used.all():
+            self._active = used
+
+    def _norm_overlapping(self, blocks, used):
+        # Ranges that overlap each give a normalized copy of the columns they share
+        cols = np.concatenate([np.arange(block.start, block.stop) for block in blocks])
+        normed = _take_columns(self._spectra, cols)
+        start = 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for block in blocks:
+                stop = start + block.stop - block.start
+                normed[:, start:stop] /= _row_sums(normed[:, start:stop])[:, None]
+                start = stop
+        wvl = self._wvl[cols]
+
+        # columns that are not in any range are kept as 'masked'
+        self._copy_to_other(~used)
+        self._set_arrays(normed, wvl, self._other, self._wvl_pos)
+
+    def _norm_frame(self, ranges, col_var):
         df_tonorm = self.df[col_var]
         top_level_cols = self.df.columns.levels[0]
         top_level_cols = top_level_cols[top_level_cols != col_var]
@@ -250,17 +549,13 @@ class spectral_data(object):
         for i in ranges:
             # Find the indices for the range
             ind = (np.array(cols, dtype='float') >= i[0]) & (np.array(cols, dtype='float') <= i[1])
-            # find the columns for the range
-            normcols = cols[ind]
             # keep track of the indices used for all ranges
             allind.append(ind)
             # normalize over the current range
-            df_sub_norm.append(norm_total(df_tonorm[normcols]))
+            df_sub_norm.append(norm_total(df_tonorm[cols[ind]]))
 
-        # collapse the list of indices used to a single array
-        allind = np.sum(allind, axis=0)
-        # identify columns that were not used by where the allind array is less than 1
-        cols_excluded = cols[np.where(allind < 1)]
+        # identify columns that were not used by any range
+        cols_excluded = cols[np.sum(allind, axis=0) < 1]
         # create a separate data frame containing the un-normalized columns
         df_masked = df_tonorm[cols_excluded]
         # combine the normalized data frames into one
@@ -271,13 +566,15 @@ class spectral_data(object):
         df_norm.columns = [[col_var] * len(df_norm.columns), df_norm.columns.values]
 
         # combine the normalized data frames, the excluded columns, and the metadata into a single data frame
-        df_new = pd.concat([df_other, df_norm, df_masked], axis=1)
-        self.df = df_new
+        self.df = pd.concat([df_other, df_norm, df_masked], axis=1)
 
-    # This function applies baseline removal to the data
-    def remove_baseline(self, method='ALS', segment=True, params=None):
-        wvls = np.array(self.df['wvl'].columns.values, dtype='float')
-        spectra = np.array(self.df['wvl'], dtype='float')
+    # This function applies baseline removal to the data. With n_jobs > 1 the spectra are split across
+    # worker processes (see Baseline.fit). With warm_start=True the spectra are fit in order, each starting from
+    # the previous one in its group; groups is a column (e.g. ('meta', 'sclock')) or one label per spectrum.
+    # The fitted baseline object is returned, so its n_iters can be inspected.
+    def remove_baseline(self, method='ALS', segment=True, params=None, n_jobs=1, decimate=1, refine_iters=3,
+                        warm_start=False, groups=None):
+        self._sync()
 
         # set baseline removal object (br) to the specified method
         if method == 'ALS':
@@ -315,50 +612,53 @@ class spectral_data(object):
                     print(br.__dict__.keys())
                     print('Exiting without removing baseline!')
                     return
-        br.fit(wvls, spectra, segment=segment)
-        self.df_baseline = self.df.copy()
-        self.df_baseline['wvl'] = br.baseline
-        self.df['wvl'] = self.df['wvl']-self.df_baseline['wvl']
+        if isinstance(groups, tuple):
+            groups = self._column(groups).values
+        br.fit(self._wvl, self._spectra, segment=segment, n_jobs=n_jobs, decimate=decimate,
+               refine_iters=refine_iters, warm_start=warm_start, groups=groups)
+        # df_baseline is built from these when it is asked for
+        self._baseline = (br.baseline, self._wvl, self._other.copy(deep=False), self._wvl_pos)
+        self._spectra = self._spectra - br.baseline
+        return br
+
     # This function finds rows of the data frame where a specified column has
     # values matching a specified set of values
     # (Useful for extracting folds)
     def rows_match(self, column_name, isin_array, invert=False):
+        self._sync()
+        match = self._column(column_name).isin(isin_array).values
         if invert:
-            new_df = self.df.loc[-self.df[column_name].isin(isin_array)]
-        else:
-            new_df = self.df.loc[self.df[column_name].isin(isin_array)]
-        return spectral_data(new_df)
+            match = ~match
+        return self._take(np.where(match)[0])
 
     # This function takes the sum of data over two specified wavelength ranges,
     # calculates the ratio of the sums, and adds the ratio as a column in the data frame
     def ratio(self, range1, range2, rationame=''):
-        cols = self.df['wvl'].columns.values
-        cols1 = cols[(cols >= range1[0]) & (cols <= range1[1])]
-        cols2 = cols[(cols >= range2[0]) * (cols <= range2[1])]
-
-        df1 = self.df['wvl'].loc[:, cols1]
-        df2 = self.df['wvl'].loc[:, cols2]
+        self._sync()
+        sum1 = _row_sums(self._spectra[:, self._wvl_slice(*range1)])
+        sum2 = _row_sums(self._spectra[:, self._wvl_slice(*range2)])
 
-        sum1 = df1.sum(axis=1)
-        sum2 = df2.sum(axis=1)
-
-        ratio = sum1 / sum2
-
-        self.df[('ratio', rationame)] = ratio
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._other[('ratio', rationame)] = sum1 / sum2
 
     def standard_scale(self, col):
-        self.df[col] = StandardScaler().fit_transform(self.df[col])
+        self._sync()
+        scaled = StandardScaler().fit_transform(self._values(col))
+        if isinstance(col, str) and col == 'wvl':
+            self._spectra = scaled
+        else:
+            self._other[col] = scaled
 
     def deriv(self):
-        new_df=self.df.copy()
-        wvls=self.df['wvl'].columns.values
-        new_df['wvl'] = self.df['wvl'].diff(axis=1)/wvls
-        foo=new_df['wvl'].columns.values
-        new_df=new_df.drop(('wvl',self.df['wvl'].columns.values[0]),axis=1)
-        foo2=new_df['wvl'].columns.values
-        return spectral_data(new_df)
+        self._sync()
+        # the difference between neighbouring columns, divided by the wavelength
+        new = spectral_data.from_arrays(np.diff(self._spectra, axis=1) / self._wvl[1:], self._wvl[1:],
+                                        self._other.copy())
+        new._wvl_pos = self._wvl_pos
+        return new
 
     def dim_red(self, col, method, params, kws, load_fit=None):
+        self._sync()
         if method == 'PCA':
             self.do_dim_red = PCA(*params, **kws)
         if method == 'FastICA':
@@ -370,60 +670,69 @@ class spectral_data(object):
         if method == 'JADE-ICA':
             self.do_dim_red = JADE(*params, **kws)
         # TODO: Add ICA-JADE here
+        values = self._values(col)
         if load_fit:
             self.do_dim_red = load_fit
         else:
             if method != 't-SNE':
-                self.do_dim_red.fit(self.df[col])
-                dim_red_result = self.do_dim_red.transform(self.df[col])
+                self.do_dim_red.fit(values)
+                dim_red_result = self.do_dim_red.transform(values)
             else:
-                dim_red_result = self.do_dim_red.fit_transform(self.df[col])
+                dim_red_result = self.do_dim_red.fit_transform(values)
 
         for i in list(range(1, dim_red_result.shape[1] + 1)):  # will need to revisit this for other methods that don't use n_components to make sure column names still mamke sense
-            self.df[(method, str(i))] = dim_red_result[:, i - 1]
+            self._other[(method, str(i))] = dim_red_result[:, i - 1]
 
         return self.do_dim_red
 
     def outlier_removal(self, col, method, params):
+        self._sync()
         if method == 'Isolation Forest':
             self.do_outlier_removal = IsolationForest(**params)
         else:
             method == None
-        self.do_outlier_removal.fit(np.array(self.df[col]))
-        outlier_scores = self.do_outlier_removal.decision_function(np.array(self.df[col]))
-        self.df[('meta','Outlier Scores - '+method+str(params))] = outlier_scores
-        #is_outlier = self.do_outlier_removal.predict(np.array(self.df[col]))
-        #self.df[('meta', 'Outliers - ' + method + str(params))] = is_outlier
+        values = self._values(col)
+        self.do_outlier_removal.fit(values)
+        outlier_scores = self.do_outlier_removal.decision_function(values)
+        self._other[('meta','Outlier Scores - '+method+str(params))] = outlier_scores
+        #is_outlier = self.do_outlier_removal.predict(values)
+        #self._other[('meta', 'Outliers - ' + method + str(params))] = is_outlier
 
         return self.do_outlier_removal
 
     def pca(self, col, nc=None, load_fit=None):
+        self._sync()
+        values = self._values(col)
         if nc:
             self.do_pca = PCA(n_components=nc)
-            self.do_pca.fit(self.df[col])
+            self.do_pca.fit(values)
         if load_fit:  # use this to load a previous fit rather than fit the current data
             self.do_pca = load_fit
-        pca_result = self.do_pca.transform(self.df[col])
+        pca_result = self.do_pca.transform(values)
         for i in list(range(1, self.do_pca.n_components + 1)):
-            self.df[('PCA', i)] = pca_result[:, i - 1]
+            self._other[('PCA', i)] = pca_result[:, i - 1]
 
     def ica(self, col, nc=None, load_fit=None):
+        self._sync()
+        values = self._values(col)
         if nc:
             self.do_ica = FastICA(n_components=nc)
-            self.do_ica.fit(self.df[col])
+            self.do_ica.fit(values)
         if load_fit:  # use this to load a previous fit rather than fit the current data
             self.do_ica = load_fit
-        ica_result = self.do_ica.transform(self.df[col])
+        ica_result = self.do_ica.transform(values)
         for i in list(range(1, self.do_ica.n_components + 1)):
-            self.df[('ICA', i)] = ica_result[:, i - 1]
+            self._other[('ICA', i)] = ica_result[:, i - 1]
 
 
     def ica_jade(self, col, nc=None, load_fit=None, corrcols=None):
+        self._sync()
+        values = self._values(col)
         if load_fit is not None:  # use this to load a previous fit rather than fit the current data
-            scores = np.dot(load_fit, self.df[col])
+            scores = np.dot(load_fit, values)
         else:
-            scores = jade(self.df[col].values, m=nc, verbose=False)
-        loadings = np.dot(scores, self.df[col])
+            scores = jade(values, m=nc, verbose=False)
+        loadings = np.dot(scores, values)
 
         icacols = []
         for i in list(range(1, len(scores[:, 0]) + 1)):
@@ -432,12 +741,12 @@ class spectral_data(object):
                 loadings[i - 1, :] = loadings[i - 1, :] * -1
                 scores[i - 1, :] = scores[i - 1, :] * -1
             icacols.append(('ICA-JADE', i))
-            self.df[('ICA-JADE', i)] = scores[i - 1, :].T
+            self._other[('ICA-JADE', i)] = scores[i - 1, :].T
         self.ica_jade_loadings = loadings
 
         if corrcols:
             combined_cols = corrcols + icacols
-            corrdf = self.df[combined_cols].corr().drop(icacols, 1).drop(corrcols, 0)
+            corrdf = self._other[combined_cols].corr().drop(icacols, 1).drop(corrcols, 0)
             ica_jade_ids = []
             for i in corrdf.loc['ICA-JADE'].index:
                 tmp = corrdf.loc[('ICA-JADE', i)]
@@ -448,22 +757,27 @@ class spectral_data(object):
             self.ica_jade_ids = ica_jade_ids
 
     def col_within_range(self, rangevals, col):
-        mask = (self.df[('meta', col)] > rangevals[0]) & (self.df[('meta', col)] < rangevals[1])
-        return self.df.loc[mask]
+        self._sync()
+        values = self._column(('meta', col))
+        mask = (values > rangevals[0]) & (values < rangevals[1])
+        # only the matching rows are assembled into a data frame
+        data = self._take(np.where(mask.values)[0])
+        return _join_frame(data._spectra, data._wvl, data._other, data._wvl_pos)
 
     def enumerate_duplicates(self, col):
-        rows = self.df[('meta', col)]
+        self._sync()
+        rows = self._other[('meta', col)]
         rows = rows.fillna('-')
         rows = [str(x) for x in rows]
         unique_rows = np.unique(rows)
         rows=np.array(rows)
         rows_list=list(rows)
         for i in unique_rows:
-            if i is not '-':
+            if i != '-':
                 matchindex = np.where(rows == i)[0]
 
                 if len(matchindex) > 1:
                     for n, name in enumerate(rows[matchindex]):
                         rows_list[matchindex[n]] = i+ ' - ' + str(n + 1)
 
-        self.df[('meta', col)] = rows_list
+        self._other[('meta', col)] = rows_list
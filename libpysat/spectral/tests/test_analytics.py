@@ -35,5 +35,30 @@ class Test_Analytics(unittest.TestCase):
         pass
 
 
+class Test_Analytics_Many(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = np.linspace(500, 2500, 80)
+        self.spectra = 1 + 0.1 * rng.rand(5, 80) - 0.5 * np.exp(-((self.x - 1000) / 150) ** 2)
+        self.spectra[4] = np.nan
+
+    def test_matches_series_versions(self):
+        minidx, minvalue = analytics.band_minima_many(self.x, self.spectra, 700, 1400)
+        center, center_value = analytics.band_center_many(self.x, self.spectra, 700, 1400)
+        area = analytics.band_area_many(self.x, self.spectra, 700, 1400)
+        asymmetry = analytics.band_asymmetry_many(self.x, self.spectra, 700, 1400)
+        for i in range(4):
+            series = pd.Series(self.spectra[i], index=self.x)
+            self.assertEqual((minidx[i], minvalue[i]), analytics.band_minima(series, 700, 1400))
+            (c, cv), _ = analytics.band_center(series, 700, 1400)
+            self.assertEqual(center[i], c)
+            self.assertAlmostEqual(center_value[i], cv)
+            self.assertAlmostEqual(area[i], analytics.band_area(series, 700, 1400))
+            left = analytics.band_area(series[700:c])
+            right = analytics.band_area(series[c:1400])
+            self.assertAlmostEqual(asymmetry[i], (left - right) / (left + right))
+        self.assertTrue(np.isnan([minidx[4], center[4], asymmetry[4]]).all())
+
+
 if __name__ == '__main__':
     unittest.main()
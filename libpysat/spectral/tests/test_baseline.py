@@ -0,0 +1,230 @@
+import contextlib
+import io
+import unittest
+
+import numpy as np
+import pandas as pd
+from scipy.linalg import solveh_banded
+
+from libpysat.spectral.baseline_code import common
+from libpysat.spectral.baseline_code.airpls import AirPLS
+from libpysat.spectral.baseline_code.als import ALS
+from libpysat.spectral.baseline_code.ccam_remove_continuum import ccam_br, ccam_remove_continuum
+from libpysat.spectral.baseline_code.polyfit import PolyFit
+from libpysat.spectral.spectral_data import spectral_data
+
+
+def make_spectra(nspectra=9, nbands=300, seed=0):
+    # Gaussian peaks on a sloped continuum, over two spectrometers with a gap between them
+    rng = np.random.RandomState(seed)
+    bands = np.concatenate([np.linspace(240, 340, nbands // 2), np.linspace(380, 470, nbands - nbands // 2)])
+    centers = rng.uniform(250, 460, (nspectra, 5))
+    peaks = (rng.rand(nspectra, 5, 1) * np.exp(-((bands - centers[:, :, None]) / 2.) ** 2)).sum(axis=1)
+    continuum = 1 + rng.rand(nspectra, 1) * (bands / 400.) ** 2
+    return bands, continuum + peaks + 0.01 * rng.rand(nspectra, nbands)
+
+
+class TestParallelFit(unittest.TestCase):
+    def setUp(self):
+        self.bands, self.spectra = make_spectra()
+
+    def test_matches_serial(self):
+        for br in (ALS(), PolyFit()):
+            for segment in (False, True):
+                expected = br.fit(self.bands, self.spectra, segment=segment).baseline
+                baseline = br.fit(self.bands, self.spectra, segment=segment, n_jobs=2).baseline
+                np.testing.assert_allclose(baseline, expected)
+
+    def test_without_shared_memory(self):
+        expected = ALS().fit(self.bands, self.spectra)
+        shared_memory = common.shared_memory
+        common.shared_memory = None
+        try:
+            parallel = ALS().fit(self.bands, self.spectra, n_jobs=2)
+        finally:
+            common.shared_memory = shared_memory
+        np.testing.assert_allclose(parallel.baseline, expected.baseline)
+        np.testing.assert_array_equal(parallel.n_iters, expected.n_iters)
+
+    def test_remove_baseline(self):
+        columns = pd.MultiIndex.from_arrays([['wvl'] * len(self.bands), self.bands])
+        serial = spectral_data(pd.DataFrame(self.spectra, columns=columns))
+        parallel = spectral_data(pd.DataFrame(self.spectra, columns=columns))
+        serial.remove_baseline('ALS')
+        parallel.remove_baseline('ALS', n_jobs=2)
+        np.testing.assert_allclose(parallel.spectra, serial.spectra)
+        np.testing.assert_allclose(parallel.df_baseline['wvl'].values, serial.df_baseline['wvl'].values)
+
+
+class TestWhittakerBands(unittest.TestCase):
+    def test_bands_are_cached(self):
+        bands = common.whittaker_bands(301, 1e6, 2)
+        self.assertIs(common.whittaker_bands(301, 1e6, 2), bands)
+        self.assertIsNot(common.whittaker_bands(301, 1e6, 1), bands)
+        self.assertFalse(bands.flags.writeable)
+
+
+class TestBandedWhittakerSolver(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(2)
+        self.y = rng.rand(301)
+        self.w = rng.rand(301)
+
+    def test_matches_solveh_banded(self):
+        for deriv_order in (1, 2, 3):
+            bands = common.whittaker_bands(301, 1e4, deriv_order)
+            ab = bands.copy()
+            ab[-1] += self.w
+            expected = solveh_banded(ab, self.w * self.y)
+            solver = common._BandedWhittakerSolver(bands)
+            np.testing.assert_allclose(solver.solve(self.w, self.y), expected)
+            np.testing.assert_allclose(common.WhittakerSmoother(self.y, 1e4, deriv_order).smooth(self.w), expected)
+
+    def test_reuses_buffers(self):
+        for deriv_order in (1, 2):
+            solver = common._BandedWhittakerSolver(common.whittaker_bands(301, 1e4, deriv_order))
+            buffers = dict(solver.__dict__)
+            z = solver.solve(self.w, self.y)
+            self.assertTrue(np.shares_memory(z, solver.rhs))
+            solver.solve(self.w[::-1], self.y)
+            for name, buffer in buffers.items():
+                self.assertIs(getattr(solver, name), buffer)
+
+    def test_not_positive_definite(self):
+        for deriv_order in (1, 2):
+            solver = common._BandedWhittakerSolver(common.whittaker_bands(301, 1e4, deriv_order))
+            with self.assertRaises(np.linalg.LinAlgError):
+                solver.solve(-1e6 * np.ones(301), self.y)
+
+
+class TestMultires(unittest.TestCase):
+    def setUp(self):
+        self.bands, self.spectra = make_spectra(nbands=600)
+
+    def test_decimate_upsample(self):
+        bands, y = common._decimate(np.arange(7.), np.arange(14.).reshape(2, 7), 3)
+        np.testing.assert_allclose(bands, [1, 4, 6])
+        np.testing.assert_allclose(y, [[1, 4, 6], [8, 11, 13]])
+        np.testing.assert_allclose(common._upsample(bands, y, np.arange(7.)),
+                                   [[1, 1, 2, 3, 4, 5, 6], [8, 8, 9, 10, 11, 12, 13]])
+
+    def test_close_to_full_resolution(self):
+        for br in (ALS(max_iters=30), AirPLS(max_iters=30)):
+            report = br.multires_error(self.bands, self.spectra, decimate=4, segment=True)
+            self.assertLess(report['relative_error'], 0.02)
+            self.assertEqual(br.fit(self.bands, self.spectra[0], decimate=4).baseline.shape, self.bands.shape)
+
+    def test_no_refinement(self):
+        for br in (ALS(), AirPLS()):
+            coarse_bands, coarse = common._decimate(self.bands, self.spectra, 4)
+            expected = common._upsample(coarse_bands, br._coarse(4)._fit_many(coarse_bands, coarse), self.bands)
+            np.testing.assert_allclose(br.fit(self.bands, self.spectra, decimate=4, refine_iters=0).baseline, expected)
+
+    def test_short_spectra(self):
+        # too few channels to decimate: fit at full resolution
+        expected = ALS().fit(self.bands[:5], self.spectra[:, :5]).baseline
+        np.testing.assert_allclose(ALS().fit(self.bands[:5], self.spectra[:, :5], decimate=8).baseline, expected)
+        bands = np.concatenate([self.bands[:300], self.bands[-5:] + 100])
+        spectra = np.hstack([self.spectra[:, :300], self.spectra[:, -5:]])
+        baseline = ALS().fit(bands, spectra, segment=True, decimate=8).baseline
+        np.testing.assert_allclose(baseline[:, -5:], ALS().fit(bands[-5:], spectra[:, -5:]).baseline)
+
+    def test_ccam(self):
+        br = ccam_br(lv=6)
+        report = br.multires_error(self.bands, self.spectra[:2], decimate=2)
+        self.assertLess(report['relative_error'], 0.05)
+        coarse_bands, coarse = common._decimate(self.bands, self.spectra[:2], 2)
+        expected = common._upsample(coarse_bands, br._coarse(2)._fit_many(coarse_bands, coarse), self.bands)
+        np.testing.assert_allclose(br.fit(self.bands, self.spectra[:2], decimate=2, refine_iters=0).baseline,
+                                   expected)
+
+    def test_ccam_constant_residual(self):
+        y = self.spectra[0]
+        np.testing.assert_allclose(ccam_remove_continuum(self.bands, y, 6, init_baseline=y), y)
+
+    def test_matches_serial(self):
+        expected = ALS().fit(self.bands, self.spectra, segment=True, decimate=4).baseline
+        baseline = ALS().fit(self.bands, self.spectra, segment=True, n_jobs=2, decimate=4).baseline
+        np.testing.assert_allclose(baseline, expected)
+
+    def test_unsupported(self):
+        with self.assertRaises(NotImplementedError):
+            PolyFit().fit(self.bands, self.spectra, decimate=4)
+
+
+class TestWarmStart(unittest.TestCase):
+    def setUp(self):
+        # Two points of five shots each, the shots of a point differing in intensity and noise
+        bands, spectra = make_spectra(nspectra=2, nbands=600)
+        rng = np.random.RandomState(3)
+        self.bands = bands
+        self.spectra = np.repeat(spectra, 5, axis=0) * rng.uniform(0.95, 1.05, (10, 1))
+        self.spectra += 0.01 * rng.rand(*self.spectra.shape)
+        self.groups = np.repeat(['a', 'b'], 5)
+
+    def test_fewer_iterations(self):
+        br = ALS(max_iters=30)
+        cold = br.fit(self.bands, self.spectra, segment=True, warm_start=True, groups=np.arange(10))
+        cold_iters, cold_baseline = cold.n_iters.copy(), cold.baseline
+        warm = br.fit(self.bands, self.spectra, segment=True, warm_start=True, groups=self.groups)
+        np.testing.assert_allclose(warm.baseline, cold_baseline, atol=1e-8)
+        self.assertEqual(warm.n_iters[0], cold_iters[0])
+        self.assertEqual(warm.n_iters[5], cold_iters[5])
+        self.assertLess(warm.n_iters.sum(), cold_iters.sum())
+        np.testing.assert_allclose(cold_baseline, ALS(max_iters=30).fit(self.bands, self.spectra, segment=True).baseline)
+
+    def test_cold_fit_records_iterations(self):
+        for br in (ALS(max_iters=30), AirPLS(max_iters=30)):
+            warm = br.fit(self.bands, self.spectra, segment=True, warm_start=True, groups=np.arange(10)).n_iters
+            # a cold fit after a warm one records its own counts
+            cold = br.fit(self.bands, self.spectra, segment=True).n_iters
+            np.testing.assert_array_equal(cold, warm)
+            parallel = br.fit(self.bands, self.spectra, segment=True, n_jobs=2).n_iters
+            np.testing.assert_array_equal(parallel, cold)
+            multires = br.fit(self.bands, self.spectra, segment=True, decimate=4).n_iters
+            self.assertEqual(multires.shape, (10,))
+            self.assertTrue((multires > 0).all())
+        br = PolyFit()
+        br.n_iters = np.ones(10)
+        self.assertIsNone(br.fit(self.bands, self.spectra).n_iters)
+
+    def test_airpls(self):
+        br = AirPLS(max_iters=30).fit(self.bands, self.spectra, warm_start=True, groups=self.groups)
+        self.assertEqual(br.baseline.shape, self.spectra.shape)
+        self.assertEqual(br.n_iters.shape, (10,))
+
+    def test_empty_shot(self):
+        # an all-zero shot gives no seed to scale, the next one starts cold
+        self.spectra[1] = 0
+        with np.errstate(all='raise'):
+            warm = ALS(max_iters=30).fit(self.bands, self.spectra, warm_start=True, groups=self.groups)
+        cold = ALS(max_iters=30).fit(self.bands, self.spectra[2:3], warm_start=True)
+        self.assertEqual(warm.n_iters[2], cold.n_iters[0])
+        np.testing.assert_allclose(warm.baseline[2], cold.baseline[0])
+
+    def test_ccam_starts_cold(self):
+        br = ccam_br(lv=6)
+        warm = br.fit(self.bands, self.spectra[:3], warm_start=True).baseline
+        n_iters = br.n_iters.copy()
+        np.testing.assert_allclose(warm, br.fit(self.bands, self.spectra[:3]).baseline)
+        cold = ccam_br(lv=6).fit(self.bands, self.spectra[:3], warm_start=True, groups=[0, 1, 2])
+        np.testing.assert_array_equal(n_iters, cold.n_iters)
+        self.assertTrue((n_iters > 0).all())
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            ALS().fit(self.bands, self.spectra, warm_start=True, decimate=4)
+        for groups in (self.groups[:2], np.append(self.groups, 'c')):
+            with self.assertRaises(ValueError):
+                ALS().fit(self.bands, self.spectra, warm_start=True, groups=groups)
+
+    def test_warns(self):
+        # Warm-started spectra still report when they stop at max_iters
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            ALS(max_iters=1).fit(self.bands, self.spectra, warm_start=True, groups=self.groups)
+        self.assertEqual(out.getvalue().count('did not converge'), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
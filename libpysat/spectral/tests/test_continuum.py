@@ -0,0 +1,33 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from libpysat.spectral import continuum
+
+
+class Test_Continuum_Many(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = np.linspace(500, 2500, 50)
+        self.spectra = 1 + 0.0002 * self.x + 0.1 * rng.rand(4, 50)
+
+    def test_linear_matches_continuum_correct(self):
+        corrected, continua = continuum.continuum_correct_many(self.x, self.spectra)
+        for i, spectrum in enumerate(self.spectra):
+            c, cont = continuum.continuum_correct(pd.Series(spectrum, index=self.x))
+            np.testing.assert_array_almost_equal(corrected[i], c.values)
+            np.testing.assert_array_almost_equal(continua[i], cont.values)
+
+    def test_piecewise_regression(self):
+        nodes = [self.x[0], self.x[20], self.x[-1]]
+        corrected, continua = continuum.continuum_correct_many(self.x, self.spectra, nodes=nodes, method='regression')
+        for i, spectrum in enumerate(self.spectra):
+            for idx, cols in [(slice(0, 21), slice(0, 21)), (slice(20, 50), slice(21, 50))]:
+                fit = np.polyfit(self.x[idx], spectrum[idx], 1)
+                np.testing.assert_array_almost_equal(continua[i, cols], np.polyval(fit, self.x[cols]))
+        np.testing.assert_array_almost_equal(corrected * continua, self.spectra)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from libpysat.fileio import io_utils
+from libpysat.spectral import analytics
+from libpysat.spectral import cube
+from libpysat.spectral.continuum import continuum_correct
+
+
+class Test_Band_Parameter_Maps(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.wavelengths = np.linspace(500, 2500, 40)
+        depth = rng.rand(9, 6, 1) * 0.5
+        band = np.exp(-((self.wavelengths - 1000) / 150) ** 2)
+        self.cube = 1 + 0.01 * rng.rand(9, 6, 40) - depth * band
+
+    def test_matches_per_pixel(self):
+        maps = cube.band_parameter_maps(self.cube, 700, 1400, wavelengths=self.wavelengths, max_bytes=2 * 6 * 40 * 8)
+        for line, sample in [(0, 0), (4, 5), (8, 3)]:
+            corrected, _ = continuum_correct(pd.Series(self.cube[line, sample], index=self.wavelengths))
+            minidx, minvalue = analytics.band_minima(corrected, 700, 1400)
+            self.assertEqual(maps['band_minimum'][line, sample], minidx)
+            self.assertAlmostEqual(maps['band_minimum_value'][line, sample], minvalue)
+            self.assertAlmostEqual(maps['band_area'][line, sample], analytics.band_area(corrected, 700, 1400))
+
+    def test_parallel_and_written(self):
+        outpath = io_utils.create_dir()
+        try:
+            # bands given in reverse order are sorted by wavelength
+            maps = cube.band_parameter_maps(self.cube[:, :, ::-1], 700, 1400, wavelengths=self.wavelengths[::-1],
+                                            max_bytes=6 * 40 * 8, n_jobs=2, outpath=outpath)
+            serial = cube.band_parameter_maps(self.cube, 700, 1400, wavelengths=self.wavelengths)
+            for p in cube.BAND_PARAMETERS:
+                np.testing.assert_array_equal(maps[p], serial[p])
+                np.testing.assert_array_equal(np.load(os.path.join(outpath, p + '.npy')), serial[p])
+        finally:
+            io_utils.delete_dir(outpath)
+
+
+if __name__ == '__main__':
+    unittest.main()
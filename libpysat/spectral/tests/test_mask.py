@@ -0,0 +1,68 @@
+import os
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from libpysat.fileio import io_utils
+from libpysat.spectral import mask
+from libpysat.spectral.spectral_data import spectral_data
+
+
+class TestWavelengthMask(unittest.TestCase):
+    def setUp(self):
+        self.directory = io_utils.create_dir()
+        self.maskfile = os.path.join(self.directory, 'mask.csv')
+        pd.DataFrame({'min_wvl': [200, 600], 'max_wvl': [300, 700]}).to_csv(self.maskfile, index=False)
+        self.wvl = np.linspace(240.811, 905.5, 40)
+
+    def tearDown(self):
+        io_utils.delete_dir(self.directory)
+
+    def test_masked(self):
+        wavelength_mask = mask.read_mask(self.maskfile)
+        expected = ((self.wvl >= 200) & (self.wvl <= 300)) | ((self.wvl >= 600) & (self.wvl <= 700))
+        masked = wavelength_mask.masked(self.wvl)
+        np.testing.assert_array_equal(masked, expected)
+        self.assertFalse(masked.flags.writeable)
+        # resolved once per grid
+        self.assertIs(wavelength_mask.masked(self.wvl.copy()), masked)
+        # unsorted grids give the same answer
+        order = np.random.RandomState(0).permutation(len(self.wvl))
+        np.testing.assert_array_equal(wavelength_mask.masked(self.wvl[order]), expected[order])
+
+    def test_read_mask_is_cached(self):
+        first = mask.read_mask(self.maskfile)
+        self.assertIs(mask.read_mask(self.maskfile), first)
+        pd.DataFrame({'min_wvl': [200.5], 'max_wvl': [300]}).to_csv(self.maskfile, index=False)
+        np.testing.assert_array_equal(mask.read_mask(self.maskfile).ranges, [[200.5, 300]])
+
+    def test_read_mask_bounded(self):
+        others = [os.path.join(self.directory, 'other{}.csv'.format(i)) for i in range(mask._MAX_MASKS)]
+        first = mask.read_mask(self.maskfile)
+        for path in others:
+            pd.DataFrame({'min_wvl': [200], 'max_wvl': [300]}).to_csv(path, index=False)
+            mask.read_mask(path)
+            # the first mask is used again, so it stays most recent
+            self.assertIs(mask.read_mask(self.maskfile), first)
+        self.assertEqual(len(mask._masks), mask._MAX_MASKS)
+        self.assertNotIn(os.path.abspath(others[0]), [path for path, sep in mask._masks])
+
+    def test_spectral_data_mask(self):
+        rng = np.random.RandomState(0)
+        spectra = rng.rand(5, len(self.wvl))
+        data = spectral_data.from_arrays(spectra, self.wvl, pd.DataFrame({('meta', 'Target'): list('abcde')}))
+        data.mask(self.maskfile)
+        data.mask(mask.WavelengthMask([[800, 850]]))
+        # nothing is copied until the spectra are used
+        self.assertTrue(np.shares_memory(data._spectra, spectra))
+
+        masked = mask.read_mask(self.maskfile).masked(self.wvl) | ((self.wvl >= 800) & (self.wvl <= 850))
+        np.testing.assert_array_equal(data.wvl, self.wvl[~masked])
+        np.testing.assert_array_equal(data.spectra, spectra[:, ~masked])
+        np.testing.assert_array_equal(data.df['masked'].columns.values, self.wvl[masked])
+        np.testing.assert_array_equal(data.df['masked'].values, spectra[:, masked])
+
+
+if __name__ == '__main__':
+    unittest.main()
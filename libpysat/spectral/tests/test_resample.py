@@ -0,0 +1,71 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from libpysat.spectral import resample
+from libpysat.spectral.spectral_data import spectral_data
+
+
+class TestResampler(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.source = np.sort(rng.uniform(400, 900, 200))
+        self.spectra = rng.rand(5, 200)
+
+    def test_linear(self):
+        target = np.linspace(300, 1000, 141)
+        resampled = resample.Resampler(self.source, target).apply(self.spectra)
+        inside = (target > self.source[0]) & (target < self.source[-1])
+        for spectrum, result in zip(self.spectra, resampled):
+            np.testing.assert_allclose(result[inside], np.interp(target[inside], self.source, spectrum))
+        self.assertTrue(np.isnan(resampled[:, ~inside]).all())
+
+    def test_unsorted_grids(self):
+        target = np.linspace(450, 850, 30)[::-1]
+        order = np.random.RandomState(1).permutation(len(self.source))
+        expected = resample.Resampler(self.source, target).apply(self.spectra)
+        shuffled = resample.Resampler(self.source[order], target).apply(self.spectra[:, order])
+        np.testing.assert_allclose(shuffled, expected)
+
+    def test_bin_conserves_flux(self):
+        source = np.linspace(400, 900, 501)
+        target = np.linspace(420, 880, 47)
+        resampler = resample.Resampler(source, target, method='bin')
+        spectrum = np.sin(source / 20) + 2
+        result = resampler.apply(spectrum)
+        self.assertTrue(resampler.valid.all())
+
+        # the flux in the target bins equals the flux of the source bins over the same range
+        source_edges = resample._bin_edges(source)
+        target_edges = resample._bin_edges(target)
+        overlap = np.minimum(source_edges[1:], target_edges[-1]) - np.maximum(source_edges[:-1], target_edges[0])
+        np.testing.assert_allclose((result * np.diff(target_edges)).sum(), (spectrum * overlap.clip(0)).sum())
+
+        np.testing.assert_allclose(resampler.apply(np.full(501, 3.0)), 3.0)
+
+    def test_bin_outside_source(self):
+        resampler = resample.Resampler(np.linspace(400, 900, 51), np.array([300., 500., 700., 950.]), method='bin')
+        np.testing.assert_array_equal(resampler.valid, [False, True, True, False])
+
+    def test_get_resampler_is_cached(self):
+        target = np.linspace(450, 850, 30)
+        first = resample.get_resampler(self.source, target)
+        self.assertIs(resample.get_resampler(self.source.copy(), target.copy()), first)
+        self.assertIsNot(resample.get_resampler(self.source, target, method='bin'), first)
+        with self.assertRaises(ValueError):
+            resample.Resampler(self.source, target, method='cubic')
+
+    def test_spectral_data_interp(self):
+        df = pd.DataFrame(self.spectra, columns=pd.MultiIndex.from_arrays([['wvl'] * 200, self.source]))
+        df[('meta', 'Target')] = list('abcde')
+        data = spectral_data(df)
+        data.interp([850., 500., 600.], method='bin')
+        np.testing.assert_array_equal(data.wvl, [500., 600., 850.])
+        expected = resample.Resampler(self.source, [500., 600., 850.], method='bin').apply(self.spectra)
+        np.testing.assert_allclose(data.df['wvl'].values, expected)
+        self.assertEqual(list(data.df[('meta', 'Target')]), list('abcde'))
+
+
+if __name__ == '__main__':
+    unittest.main()
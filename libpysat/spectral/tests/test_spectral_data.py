@@ -0,0 +1,162 @@
+import os
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from libpysat.fileio import io_utils
+from libpysat.spectral.spectral_data import NORM_RANGES, spectral_data
+
+
+def make_data(nspectra=6, nwvl=20, seed=0):
+    rng = np.random.RandomState(seed)
+    wvls = np.linspace(240.811, 905.5, nwvl).round(4)
+    spectra = pd.DataFrame(rng.rand(nspectra, nwvl),
+                           columns=pd.MultiIndex.from_arrays([['wvl'] * nwvl, wvls]))
+    meta = pd.DataFrame({('meta', 'Target'): ['Target{}'.format(i % 3) for i in range(nspectra)],
+                         ('meta', 'sclock'): np.arange(nspectra) + 398736801,
+                         ('comp', 'SiO2'): rng.rand(nspectra) * 100})
+    return pd.concat([meta, spectra], axis=1)
+
+
+class TestBinaryIO(unittest.TestCase):
+    def setUp(self):
+        self.directory = io_utils.create_dir()
+        self.path = os.path.join(self.directory, 'data')
+
+    def tearDown(self):
+        io_utils.delete_dir(self.directory)
+
+    def test_round_trip(self):
+        data = spectral_data(make_data())
+        data.save(self.path)
+        for mmap in (True, False):
+            loaded = spectral_data.load(self.path, mmap=mmap)
+            pd.testing.assert_frame_equal(loaded.df, data.df)
+            self.assertEqual(list(loaded.df.columns.levels[0]), ['comp', 'meta', 'wvl'])
+
+    def test_mmap_is_copy_on_write(self):
+        data = spectral_data(make_data())
+        data.save(self.path)
+        loaded = spectral_data.load(self.path)
+        loaded.df['wvl'] = loaded.df['wvl'] * 0
+        np.testing.assert_array_equal(spectral_data.load(self.path).df['wvl'].values, data.df['wvl'].values)
+
+
+class TestArrayStorage(unittest.TestCase):
+    def setUp(self):
+        self.frame = make_data()
+        self.data = spectral_data(make_data())
+
+    def test_arrays(self):
+        # csv style string labels, out of order
+        frame = self.frame.iloc[:, ::-1].copy()
+        frame.columns = pd.MultiIndex.from_tuples([(a, str(b)) for a, b in frame.columns])
+        data = spectral_data(frame)
+        self.assertTrue(data.spectra.flags['C_CONTIGUOUS'])
+        np.testing.assert_array_equal(data.wvl, self.frame['wvl'].columns.values)
+        np.testing.assert_array_equal(data.spectra, self.frame['wvl'].values)
+        self.assertEqual(list(data.df['wvl'].columns), list(data.wvl))
+        pd.testing.assert_series_equal(data.df[('comp', 'SiO2')], self.frame[('comp', 'SiO2')])
+
+    def test_df_edits_are_kept(self):
+        self.data.df[('meta', 'Edited')] = 1
+        self.data.df.loc[0, ('wvl', self.data.df['wvl'].columns[0])] = -1
+        self.data.ratio((240, 500), (500, 906), 'r')
+        self.assertEqual(self.data.spectra[0, 0], -1)
+        self.assertTrue((self.data.df[('meta', 'Edited')] == 1).all())
+        self.assertIn(('ratio', 'r'), self.data.df.columns)
+
+    def test_from_arrays(self):
+        spectra = np.random.RandomState(1).rand(4, 5)
+        meta = pd.DataFrame({('meta', 'Target'): ['a', 'b', 'a', 'c']})
+        data = spectral_data.from_arrays(spectra, [1., 2., 3., 4., 5.], meta)
+        self.assertTrue(np.shares_memory(data.spectra, spectra))
+        self.assertEqual(list(data.df.columns[:2]), [('meta', 'Target'), ('wvl', 1.0)])
+
+        subset = data.rows_match(('meta', 'Target'), ['a'])
+        np.testing.assert_array_equal(subset.spectra, spectra[[0, 2]])
+        self.assertEqual(list(subset.df.index), [0, 2])
+        self.assertEqual(len(data.rows_match(('meta', 'Target'), ['a'], invert=True).df), 2)
+
+    def test_missing_wavelength(self):
+        data = spectral_data.from_arrays(np.ones((2, 3)), [400., 500., 600.])
+        for wvl in (450., 700.):
+            with self.assertRaises(KeyError):
+                data._column(('wvl', wvl))
+        self.assertEqual(list(data._column(('wvl', 500.))), [1, 1])
+
+    def test_norm(self):
+        self.data.norm([(240, 500), (600, 906)])
+        wvls = self.frame['wvl'].columns.values
+        expected = self.frame['wvl'].values[:, wvls <= 500]
+        np.testing.assert_allclose(self.data.df['wvl'].values[:, :expected.shape[1]],
+                                   expected / expected.sum(axis=1)[:, None])
+        np.testing.assert_array_equal(self.data.df['masked'].columns.values, wvls[(wvls > 500) & (wvls < 600)])
+
+    def test_mask(self):
+        directory = io_utils.create_dir()
+        try:
+            maskfile = os.path.join(directory, 'mask.csv')
+            pd.DataFrame({'min_wvl': [200, 600], 'max_wvl': [300, 700]}).to_csv(maskfile, index=False)
+            self.data.mask(maskfile)
+        finally:
+            io_utils.delete_dir(directory)
+        wvls = self.frame['wvl'].columns.values
+        masked = ((wvls >= 200) & (wvls <= 300)) | ((wvls >= 600) & (wvls <= 700))
+        np.testing.assert_array_equal(self.data.wvl, wvls[~masked])
+        np.testing.assert_array_equal(self.data.df['masked'].values, self.frame['wvl'].values[:, masked])
+
+    def test_remove_baseline(self):
+        self.data.remove_baseline('Polyfit', segment=False)
+        np.testing.assert_allclose(self.data.df['wvl'].values + self.data.df_baseline['wvl'].values,
+                                   self.frame['wvl'].values)
+        self.assertEqual(list(self.data.df_baseline.columns), list(self.data.df.columns))
+
+
+class TestNorm(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.wvl = np.linspace(240.811, 905.5, 60)
+        self.spectra = rng.rand(5, 60)
+
+    def expected(self, ranges):
+        spectra = self.spectra.copy()
+        for low, high in ranges:
+            cols = (self.wvl >= low) & (self.wvl <= high)
+            spectra[:, cols] /= np.nansum(spectra[:, cols], axis=1)[:, None]
+        return spectra
+
+    def test_presets(self):
+        for preset, ranges in NORM_RANGES.items():
+            data = spectral_data.from_arrays(self.spectra.copy(), self.wvl)
+            data.norm(preset)
+            used = np.any([(self.wvl >= low) & (self.wvl <= high) for low, high in ranges], axis=0)
+            np.testing.assert_allclose(data.spectra, self.expected(ranges)[:, used])
+            if not used.all():
+                np.testing.assert_array_equal(data.df['masked'].values, self.spectra[:, ~used])
+
+    def test_with_nans(self):
+        self.spectra[1, 3] = np.nan
+        spectra = self.spectra.copy()
+        data = spectral_data.from_arrays(spectra, self.wvl)
+        data.norm([(600, 906), (240, 500)])
+        expected = self.expected([(240, 500), (600, 906)])
+        used = (self.wvl <= 500) | (self.wvl >= 600)
+        np.testing.assert_allclose(data.spectra, expected[:, used])
+        # the array handed to from_arrays is left alone
+        np.testing.assert_array_equal(spectra, self.spectra)
+
+    def test_overlapping_ranges(self):
+        data = spectral_data.from_arrays(self.spectra.copy(), self.wvl)
+        data.norm([(240, 600), (500, 906)])
+        # columns in both ranges appear once for each
+        shared = (self.wvl >= 500) & (self.wvl <= 600)
+        self.assertEqual(len(data.wvl), 60 + shared.sum())
+        self.assertEqual(data.df[('wvl', self.wvl[shared][0])].shape, (5, 2))
+        # each range sums to one
+        np.testing.assert_allclose(data.spectra.sum(axis=1), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
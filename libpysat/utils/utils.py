@@ -1,3 +1,4 @@
+import os
 from functools import reduce
 
 import numpy as np
@@ -237,3 +238,45 @@ def remove_field_name(a, name):
         names.remove(name)
     b = a[names]
     return b
+
+
+def effective_n_jobs(n_jobs=1):
+    """
+    Resolve a user supplied worker count into a concrete number of processes.
+
+    Parameters
+    ----------
+    n_jobs : int or None
+             The requested number of workers.  None or 1 means serial
+             execution, negative values count back from the number of
+             available CPUs (-1 uses every CPU, -2 all but one, ...)
+
+    Returns
+    -------
+     : int
+       The number of workers to use (always >= 1)
+    """
+    if n_jobs is None or n_jobs == 0:
+        return 1
+    if n_jobs < 0:
+        n_jobs = (os.cpu_count() or 1) + 1 + n_jobs
+    return max(int(n_jobs), 1)
+
+
+def file_signature(path):
+    """
+    Return the size and modification time of a file, used by the readers
+    that cache parsed files to decide whether a file has changed
+
+    Parameters
+    ----------
+    path : str
+           PATH to the file
+
+    Returns
+    -------
+     : dict
+       With the absolute 'path', 'size' and 'mtime' of the file
+    """
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}